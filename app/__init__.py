@@ -6,6 +6,17 @@ from flask_sqlalchemy import SQLAlchemy
 from config import config
 from flask_login import LoginManager
 from flask_pagedown import PageDown
+from .timeline import Timeline
+from .rendering import RenderService
+from .cache import Cache
+from .activity import ActivityTracker
+from .usercache import UserLoader
+from .avatars import Avatars
+from .search import Search
+from .profiling import Profiler
+from .metrics import Metrics
+from .passwords import Passwords
+from .follow_graph import FollowGraph
 
 
 bootstrap = Bootstrap()
@@ -13,6 +24,17 @@ mail = Mail()
 moment = Moment()
 db = SQLAlchemy()
 pagedown = PageDown()
+timeline = Timeline()
+renderer = RenderService()
+cache = Cache()
+activity = ActivityTracker()
+user_cache = UserLoader()
+avatars = Avatars()
+search = Search()
+profiler = Profiler()
+metrics = Metrics()
+passwords = Passwords()
+follow_graph = FollowGraph()
 
 login_manager = LoginManager()
 
@@ -26,10 +48,23 @@ def create_app(config_name):
 
     bootstrap.init_app(app)
     mail.init_app(app)
+    from .email import mail_queue
+    mail_queue.init_app(app)
     moment.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    passwords.init_app(app)
+    timeline.init_app(app)
+    renderer.init_app(app)
+    cache.init_app(app)
+    activity.init_app(app)
+    user_cache.init_app(app)
+    follow_graph.init_app(app)
+    avatars.init_app(app)
+    search.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -40,5 +75,8 @@ def create_app(config_name):
     from .photo import photo as photo_blueprint
     app.register_blueprint(photo_blueprint, url_prefix='/photo')
 
+    from .api_1_0 import api as api_1_0_blueprint
+    app.register_blueprint(api_1_0_blueprint, url_prefix='/api/v1.0')
+
 
     return app
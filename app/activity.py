@@ -0,0 +1,109 @@
+# coding: utf-8
+# 用户最后访问时间（last_seen）的批量写入：ping 只记在内存里，
+# 由后台线程按时间间隔或积攒的数量批量 UPDATE，不再每个请求写一次 users 表。
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class ActivityBuffer(object):
+    def __init__(self, app, resolution=60, interval=30, threshold=500):
+        self.app = app
+        self.resolution = timedelta(seconds=resolution)
+        self.interval = interval
+        self.threshold = threshold
+        self._pending = {}      # user_id -> 还没写入的 last_seen
+        self._seen = {}         # user_id -> 最近一次记录的 last_seen
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, user, now=None):
+        now = now or datetime.utcnow()
+        last = self._seen.get(user.id) or user.__dict__.get('last_seen')
+        if last is not None and now - last < self.resolution:
+            return False        # 分辨率之内的访问不产生任何写入
+        with self._lock:
+            self._pending[user.id] = now
+            self._seen[user.id] = now
+            full = len(self._pending) >= self.threshold
+        # 只更新内存里的值，不把对象标记为已修改
+        set_committed_value(user, 'last_seen', now)
+        self._start()
+        if full:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """把积攒的 last_seen 一次性写入数据库，返回写入的用户数。"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # 超过分辨率的记录已经没用了，顺便清掉
+            horizon = datetime.utcnow() - self.resolution
+            self._seen = dict((k, v) for k, v in self._seen.items() if v > horizon)
+        if not pending:
+            return 0
+        from . import db
+        from .models import User
+        users = User.__table__
+        statement = users.update().where(users.c.id == db.bindparam('user_id')) \
+            .values(last_seen=db.bindparam('seen'))
+        # 不压入新的应用上下文，否则退出时会把当前线程的 db.session 关掉
+        with db.get_engine(self.app).begin() as connection:
+            connection.execute(statement, [
+                {'user_id': user_id, 'seen': seen}
+                for user_id, seen in pending.items()])
+        return len(pending)
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run,
+                                                    name='last-seen-flusher')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self._safe_flush)
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception('Flushing last_seen failed')
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._safe_flush()
+
+
+class ActivityTracker(object):
+    """扩展：activity.init_app(app)，User.ping 通过它记录访问时间。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_LAST_SEEN_RESOLUTION', 60)
+        app.config.setdefault('FLASKY_LAST_SEEN_FLUSH_INTERVAL', 30)
+        app.config.setdefault('FLASKY_LAST_SEEN_FLUSH_THRESHOLD', 500)
+        app.extensions['activity'] = ActivityBuffer(
+            app,
+            resolution=app.config['FLASKY_LAST_SEEN_RESOLUTION'],
+            interval=app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'],
+            threshold=app.config['FLASKY_LAST_SEEN_FLUSH_THRESHOLD'])
+
+    @property
+    def buffer(self):
+        return current_app.extensions['activity']
+
+    def record(self, user, now=None):
+        return self.buffer.record(user, now)
+
+    def flush(self):
+        return self.buffer.flush()
@@ -0,0 +1,15 @@
+from flask import Blueprint
+
+api = Blueprint('api', __name__)
+
+
+@api.record_once
+def init_config(state):
+    config = state.app.config
+    config.setdefault('FLASKY_API_MAX_PER_PAGE', 100)
+    config.setdefault('FLASKY_API_TOKEN_EXPIRATION', 3600)
+    config.setdefault('FLASKY_API_GZIP_MIN_SIZE', 500)
+    config.setdefault('FLASKY_API_GZIP_LEVEL', 6)
+    config.setdefault('FLASKY_API_ETAG_TTL', config.get('CACHE_DEFAULT_TIMEOUT', 300))
+
+from . import authentication, responses, posts, users, comments, errors
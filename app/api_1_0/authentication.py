@@ -0,0 +1,73 @@
+# coding: utf-8
+# API 不用会话和 Cookie：每个请求带 "Authorization: Bearer 令牌"，
+# 或者 HTTP Basic（邮箱和密码；用户名填令牌、密码留空也可以）。
+# 没带凭据的请求按匿名用户处理，只能读公开的数据。
+from functools import wraps
+
+from flask import g, request, current_app
+
+from . import api
+from .errors import unauthorized, forbidden
+from .responses import json_response
+from ..models import User
+
+
+def _credentials():
+    header = request.headers.get('Authorization', '')
+    if header[:7].lower() == 'bearer ':
+        return header[7:].strip(), None
+    auth = request.authorization
+    if auth is None:
+        return None, None
+    return auth.username, auth.password
+
+
+@api.before_request
+def authenticate():
+    g.current_user = None
+    g.token_used = False
+    username, password = _credentials()
+    if not username:
+        return
+    if not password:
+        g.token_used = True
+        user = User.verify_auth_token(username)
+    else:
+        user = User.query.filter_by(email=username).first()
+        if user is not None and not user.verify_password(password):
+            user = None
+    if user is None:
+        return unauthorized('Invalid credentials')
+    if not user.confirmed:
+        return forbidden('Unconfirmed account')
+    g.current_user = user
+
+
+def auth_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.current_user is None:
+            return unauthorized('Authentication required')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def owner_required(f):
+    """地址里的 id 必须是当前用户，放在 conditional 外面，别人带着 ETag 来也是 403。"""
+    @wraps(f)
+    @auth_required
+    def decorated_function(*args, **kwargs):
+        if g.current_user.id != kwargs['id']:
+            return forbidden('Insufficient permissions')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@api.route('/tokens/', methods=['POST'])
+@auth_required
+def get_token():
+    if g.token_used:        # 令牌不能用来换新令牌，否则令牌永远不会过期
+        return unauthorized('Invalid credentials')
+    expiration = current_app.config['FLASKY_API_TOKEN_EXPIRATION']
+    return json_response({'token': g.current_user.generate_auth_token(expiration),
+                          'expiration': expiration})
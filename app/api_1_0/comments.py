@@ -0,0 +1,14 @@
+from . import api
+from .responses import conditional, page_args, paginated
+from ..models import Comment
+from ..pagination import keyset_paginate
+
+
+@api.route('/comments/')
+@conditional('pages')
+def get_comments():
+    after, before, per_page = page_args()
+    pagination = keyset_paginate(
+        Comment.query.filter(Comment.visible()), (Comment.timestamp, Comment.id),
+        after=after, before=before, per_page=per_page)
+    return paginated(pagination, 'comments')
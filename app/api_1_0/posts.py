@@ -0,0 +1,34 @@
+from . import api
+from .responses import conditional, page_args, paginated, pick, requested_fields, \
+    json_response
+from ..models import Post, Comment
+from ..pagination import keyset_paginate, approximate_count
+
+
+@api.route('/posts/')
+@conditional('pages')
+def get_posts():
+    after, before, per_page = page_args()
+    pagination = keyset_paginate(
+        Post.query, (Post.timestamp, Post.id), after=after, before=before,
+        per_page=per_page, total=approximate_count('posts', Post.query))
+    return paginated(pagination, 'posts')
+
+
+@api.route('/posts/<int:id>')
+@conditional('post:{id}')
+def get_post(id):
+    post = Post.query.get_or_404(id)
+    return json_response(pick(post.to_json(), requested_fields()))
+
+
+@api.route('/posts/<int:id>/comments/')
+@conditional('post:{id}')
+def get_post_comments(id):
+    # 文章的版本号在评论增删、屏蔽时都会更新（见 Comment.on_changed），可以用来做 ETag
+    Post.query.get_or_404(id)
+    after, before, per_page = page_args()
+    query = Comment.query.filter(Comment.post_id == id, Comment.visible())
+    pagination = keyset_paginate(query, (Comment.timestamp, Comment.id), after=after,
+                                 before=before, per_page=per_page, descending=False)
+    return paginated(pagination, 'comments')
@@ -0,0 +1,133 @@
+# coding: utf-8
+# API 响应的公共部分：紧凑的 JSON、?fields= 选择字段、游标分页的链接、
+# 由缓存版本号算出的 ETag（客户端带 If-None-Match 且没变化时不查数据库，直接 304），
+# 以及较大响应的 gzip 压缩。
+import gzip
+import hashlib
+import json
+import time
+from functools import wraps
+
+from flask import current_app, g, request, url_for
+
+from . import api
+from .errors import ValidationError
+from .. import cache
+from ..pagination import decode_cursor
+
+# 表示格式变化时改这个值，让客户端手里的 ETag 全部失效
+REPRESENTATION_VERSION = '1'
+
+
+def json_response(data, status=200):
+    body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    return current_app.response_class(body.encode('utf-8'), status=status,
+                                      mimetype='application/json')
+
+
+def requested_fields():
+    """?fields=id,body 里的字段名，没给时返回 None 表示全部字段。"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return [name.strip() for name in fields.split(',') if name.strip()]
+
+
+def pick(data, fields):
+    if fields is None:
+        return data
+    unknown = [name for name in fields if name not in data]
+    if unknown:
+        raise ValidationError('Unknown fields: %s' % ', '.join(unknown))
+    return dict((name, data[name]) for name in fields)
+
+
+def page_args(arity=2):
+    """(after, before, per_page)，per_page 不超过 FLASKY_API_MAX_PER_PAGE。
+
+    网页上解析不了的游标当作第一页，API 直接返回 400。
+    """
+    config = current_app.config
+    per_page = request.args.get('per_page', config['FLASKY_POSTS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, config['FLASKY_API_MAX_PER_PAGE']))
+    after, before = request.args.get('after'), request.args.get('before')
+    for cursor in (after, before):
+        if cursor and decode_cursor(cursor, arity) is None:
+            raise ValidationError('Invalid cursor')
+    return after, before, per_page
+
+
+def _page_url(name, cursor):
+    if cursor is None:
+        return None
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args[name] = cursor
+    args.update(request.view_args)
+    return url_for(request.endpoint, _external=True, **args)
+
+
+def paginated(pagination, name, serialize=None):
+    """一页列表：{name: [...], prev, next, count}，prev 和 next 是带游标的地址。"""
+    fields = requested_fields()
+    serialize = serialize or (lambda item: item.to_json())
+    data = {
+        name: [pick(serialize(item), fields) for item in pagination.items],
+        'prev': _page_url('before', pagination.prev_cursor),
+        'next': _page_url('after', pagination.next_cursor),
+    }
+    if pagination.total is not None:
+        data['count'] = pagination.total
+    return json_response(data)
+
+
+def conditional(*names):
+    """按缓存版本号给响应加弱 ETag，names 里可以用视图参数，如 'post:{id}'。
+
+    版本号在事务提交后才换（见 Cache.after_commit），If-None-Match 命中时视图函数和
+    数据库查询都不执行。不经过本进程 session 的修改（别的进程提交、缓存后端是进程内的
+    memory 时）换不了版本号，所以 ETag 里还带着 FLASKY_API_ETAG_TTL 秒一换的时间段，
+    过期的 304 最多持续这么久。响应内容和看的人无关，只跟地址有关
+    （时间线只有本人能看，地址里已经有用户 id）。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            versions = cache.versions(*[name.format(**kwargs) for name in names])
+            ttl = current_app.config['FLASKY_API_ETAG_TTL']
+            bucket = str(int(time.time() // ttl)) if ttl else ''
+            raw = '|'.join([REPRESENTATION_VERSION, bucket] + versions +
+                           [request.full_path])
+            etag = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = f(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # 客户端每次都要来验证，但验证通过时只回一个 304
+            response.headers['Cache-Control'] = 'private, no-cache' \
+                if g.current_user is not None else 'no-cache'
+            response.vary.add('Authorization')
+            return response
+        return decorated_function
+    return decorator
+
+
+@api.after_request
+def compress(response):
+    if response.status_code != 200 or response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    config = current_app.config
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+    data = response.get_data()
+    if len(data) < config['FLASKY_API_GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, config['FLASKY_API_GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,73 @@
+from flask import g, url_for
+
+from . import api
+from .authentication import owner_required
+from .responses import conditional, page_args, paginated, pick, requested_fields, \
+    json_response
+from .. import db, timeline
+from ..models import User, Post, Follow, isoformat
+from ..pagination import keyset_paginate
+
+
+@api.route('/users/<int:id>')
+@conditional('pages')
+def get_user(id):
+    user = User.query.get_or_404(id)
+    return json_response(pick(user.to_json(), requested_fields()))
+
+
+@api.route('/users/<int:id>/posts/')
+@conditional('pages')
+def get_user_posts(id):
+    User.query.get_or_404(id)
+    after, before, per_page = page_args()
+    pagination = keyset_paginate(Post.query.filter_by(author_id=id),
+                                 (Post.timestamp, Post.id), after=after, before=before,
+                                 per_page=per_page)
+    return paginated(pagination, 'posts')
+
+
+@api.route('/users/<int:id>/timeline/')
+@owner_required
+@conditional('pages')
+def get_timeline(id):
+    # 关注动态只给本人看，直接读写扩散好的时间线（见 app/timeline.py）
+    after, before, per_page = page_args()
+    query, columns = timeline.posts_for(g.current_user)
+    pagination = keyset_paginate(query, columns, after=after, before=before,
+                                 per_page=per_page,
+                                 key=lambda post: (post.timestamp, post.id))
+    return paginated(pagination, 'posts')
+
+
+def _follow_json(row):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'url': url_for('api.get_user', id=row.id, _external=True),
+        'timestamp': isoformat(row.timestamp),
+    }
+
+
+def _follows(id, mine, theirs):
+    """关注关系的一页，只取对方的 id 和用户名，不加载整个用户对象。"""
+    User.query.get_or_404(id)
+    after, before, per_page = page_args()
+    query = db.session.query(Follow.timestamp, User.id, User.username) \
+        .join(User, User.id == theirs).filter(mine == id)
+    pagination = keyset_paginate(query, (Follow.timestamp, theirs),
+                                 after=after, before=before, per_page=per_page,
+                                 key=lambda row: (row.timestamp, row.id))
+    return paginated(pagination, 'users', _follow_json)
+
+
+@api.route('/users/<int:id>/followers/')
+@conditional('pages')
+def get_followers(id):
+    return _follows(id, Follow.followed_id, Follow.follower_id)
+
+
+@api.route('/users/<int:id>/following/')
+@conditional('pages')
+def get_following(id):
+    return _follows(id, Follow.follower_id, Follow.followed_id)
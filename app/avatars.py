@@ -0,0 +1,143 @@
+# coding: utf-8
+# 本地头像：按 User.avatar_hash 生成对称的 5x5 identicon，每个标准尺寸渲染一次后存在磁盘上。
+# FLASKY_AVATAR_SOURCE 为 'gravatar' 时仍然使用 Gravatar，不依赖这个模块。
+import colorsys
+import os
+import re
+import tempfile
+
+from flask import current_app, url_for
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:     # pragma: no cover
+    Image = None
+
+_hash_re = re.compile(r'^[0-9a-f]{32}$')
+
+BACKGROUND = (240, 240, 240)
+
+
+def identicon_cells(digest):
+    """返回要涂色的 (列, 行)，左右对称：前三列由哈希决定，后两列是镜像。"""
+    cells = []
+    for i in range(15):
+        if int(digest[i], 16) % 2 == 0:
+            col, row = divmod(i, 5)
+            cells.append((col, row))
+            if col < 2:
+                cells.append((4 - col, row))
+    return cells
+
+
+def identicon_color(digest):
+    hue = int(digest[-7:], 16) / float(0xfffffff)
+    r, g, b = colorsys.hls_to_rgb(hue, 0.5, 0.55)
+    return int(r * 255), int(g * 255), int(b * 255)
+
+
+def render_svg(digest, size):
+    color = '#%02x%02x%02x' % identicon_color(digest)
+    path = ''.join('M%d %dh1v1h-1z' % cell for cell in identicon_cells(digest))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+            'viewBox="-0.5 -0.5 6 6" shape-rendering="crispEdges">'
+            '<rect x="-0.5" y="-0.5" width="6" height="6" fill="#f0f0f0"/>'
+            '<path fill="{color}" d="{path}"/></svg>').format(
+                size=size, color=color, path=path).encode('utf-8')
+
+
+def render_png(digest, size):
+    import io
+    image = Image.new('RGB', (size, size), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    color = identicon_color(digest)
+    cell = size / 6.0
+    for col, row in identicon_cells(digest):
+        x = (col + 0.5) * cell
+        y = (row + 0.5) * cell
+        draw.rectangle([int(x), int(y), int(x + cell) - 1, int(y + cell) - 1], fill=color)
+    buf = io.BytesIO()
+    image.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+class AvatarStore(object):
+    """渲染好的头像按 (哈希, 尺寸) 存成文件，请求的尺寸向上取到最近的标准尺寸。"""
+
+    def __init__(self, cache_dir, sizes=(32, 40, 100, 256), fmt='svg'):
+        if fmt == 'png' and Image is None:
+            fmt = 'svg'     # 没装 Pillow 时退回 SVG
+        self.cache_dir = cache_dir
+        self.sizes = sorted(sizes)
+        self.fmt = fmt
+        self.renders = 0
+
+    @staticmethod
+    def valid_hash(digest):
+        return bool(digest and _hash_re.match(digest))
+
+    @property
+    def mimetype(self):
+        return 'image/svg+xml' if self.fmt == 'svg' else 'image/png'
+
+    def standard_size(self, size):
+        for s in self.sizes:
+            if s >= size:
+                return s
+        return self.sizes[-1]
+
+    def _file(self, digest, size):
+        return os.path.join(self.cache_dir, str(self.standard_size(size)),
+                            '%s.%s' % (digest, self.fmt))
+
+    def cached(self, digest, size):
+        return os.path.exists(self._file(digest, size))
+
+    def path(self, digest, size):
+        """返回渲染好的头像文件，第一次请求这个尺寸时渲染并写入磁盘。
+
+        调用方要保证 digest 属于某个用户，否则随便编的哈希也会占用磁盘。
+        """
+        size = self.standard_size(size)
+        path = self._file(digest, size)
+        directory = os.path.dirname(path)
+        if not os.path.exists(path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+            data = render_svg(digest, size) if self.fmt == 'svg' else render_png(digest, size)
+            self.renders += 1
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return path
+
+
+class Avatars(object):
+    """扩展：avatars.init_app(app)，User.gravatar 通过它生成头像地址。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_AVATAR_SOURCE', 'gravatar')
+        app.config.setdefault('FLASKY_AVATAR_SIZES', (32, 40, 100, 256))
+        app.config.setdefault('FLASKY_AVATAR_FORMAT', 'svg')
+        app.config.setdefault('FLASKY_AVATAR_CACHE_DIR',
+                              os.path.join(app.instance_path, 'avatars'))
+        app.extensions['avatars'] = AvatarStore(
+            app.config['FLASKY_AVATAR_CACHE_DIR'],
+            sizes=app.config['FLASKY_AVATAR_SIZES'],
+            fmt=app.config['FLASKY_AVATAR_FORMAT'])
+
+    @property
+    def store(self):
+        return current_app.extensions['avatars']
+
+    @property
+    def local(self):
+        return current_app.config['FLASKY_AVATAR_SOURCE'] == 'local'
+
+    def url(self, digest, size):
+        return url_for('main.avatar', hash=digest, s=self.store.standard_size(size))
@@ -0,0 +1,261 @@
+# coding: utf-8
+# 缓存：进程内 LRU（带过期时间），或者换成多进程共享的后端。
+# 提供匿名 GET 请求的整页缓存和文章列表项的片段缓存，
+# 文章、评论、作者资料变化时按"版本号"自动失效。
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from markupsafe import Markup
+from werkzeug.utils import import_string
+
+
+class NullCache(object):
+    """不缓存任何东西，用来关闭缓存。"""
+
+    hits = misses = 0
+
+    def get(self, key):
+        return None
+
+    def get_many(self, keys):
+        return [None] * len(keys)
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryCache(NullCache):
+    """进程内的 LRU 缓存，超过 max_entries 时淘汰最久没用的条目。"""
+
+    def __init__(self, max_entries=10000, default_timeout=300):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()      # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else None
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[0] is not None and item[0] < time.time()):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data[key] = (self._expires(timeout), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileSystemCache(NullCache):
+    """把缓存存成文件，同一台机器上的多个进程可以共享。
+
+    作为 memcached / redis 之类共享缓存的本地替代品，过期的文件在读取时删除。
+    """
+
+    def __init__(self, cache_dir=None, default_timeout=300):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'flasky-cache')
+        self.default_timeout = default_timeout
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.PickleError):
+            self.misses += 1
+            return None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else None
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))    # 原子替换，读者不会读到半个文件
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+
+backends = {
+    'null': NullCache,
+    'memory': MemoryCache,
+    'filesystem': FileSystemCache,
+}
+
+
+class Cache(object):
+    """缓存扩展：cache.init_app(app)。
+
+    CACHE_BACKEND 可以是 'null'、'memory'、'filesystem'，也可以是
+    'package.module:Class' 形式的类路径，CACHE_OPTIONS 作为构造参数传入。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_OPTIONS', {})
+        app.config.setdefault('CACHE_DEFAULT_TIMEOUT', 300)
+        app.config.setdefault('FLASKY_CACHE_PAGES', True)
+        app.config.setdefault('FLASKY_PAGE_CACHE_TIMEOUT', 60)
+        name = app.config['CACHE_BACKEND']
+        cls = backends.get(name) or import_string(name)
+        options = dict(app.config['CACHE_OPTIONS'])
+        if cls is not NullCache:
+            options.setdefault('default_timeout', app.config['CACHE_DEFAULT_TIMEOUT'])
+        app.extensions['cache'] = cls(**options)
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    # 版本号：每个对象一个随机版本号，变化时换一个新的，旧的缓存键自然失效。
+    # 用随机值而不是自增计数，版本号被淘汰后也不会和旧缓存撞上。
+
+    def versions(self, *names):
+        keys = ['version:%s' % name for name in names]
+        values = self.backend.get_many(keys)
+        result = []
+        for key, value in zip(keys, values):
+            if value is None:
+                value = uuid.uuid4().hex[:12]
+                self.backend.set(key, value, 0)
+            result.append(value)
+        return result
+
+    def touch(self, *names):
+        for name in names:
+            self.backend.set('version:%s' % name, uuid.uuid4().hex[:12], 0)
+
+    # 整页缓存 -------------------------------------------------------------
+
+    def cached_page(self, timeout=None):
+        """缓存匿名用户 GET 请求的完整响应，任何内容变化都会让整页缓存失效。"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method != 'GET' or current_user.is_authenticated or \
+                        not current_app.config['FLASKY_CACHE_PAGES'] or \
+                        session.get('_flashes'):
+                    return f(*args, **kwargs)
+                version, = self.versions('pages')
+                key = 'page:%s:%s:%s' % (version, request.scheme, request.full_path)
+                cached = self.backend.get(key)
+                if cached is not None:
+                    body, status, headers = cached
+                    response = make_response(body, status, headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    headers = [(k, v) for k, v in response.headers
+                               if k.lower() != 'set-cookie']
+                    self.backend.set(key, (response.get_data(), response.status_code,
+                                           headers),
+                                     timeout or current_app.config['FLASKY_PAGE_CACHE_TIMEOUT'])
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return decorated_function
+        return decorator
+
+    # 片段缓存 -------------------------------------------------------------
+
+    def fragment(self, key, render, timeout=None):
+        html = self.backend.get(key)
+        if html is None:
+            html = render()
+            self.backend.set(key, html, timeout)
+        return Markup(html)
+
+    # 由模型事件调用：先记在 session 里，事务提交后再换版本号，
+    # 避免提交前别的请求把旧内容重新写进缓存。
+
+    def invalidate_on_commit(self, session, *names):
+        session.info.setdefault('cache_touched', set()).update(names)
+
+    def after_commit(self, session):
+        names = session.info.pop('cache_touched', None)
+        if names is not None:
+            self.touch('pages', *names)
+
+    def after_rollback(self, session):
+        session.info.pop('cache_touched', None)
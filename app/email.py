@@ -1,19 +1,444 @@
+# coding: utf-8
+# 邮件发送队列：固定数量的工作线程从有界队列里取邮件，复用 SMTP 连接，
+# 失败后按指数退避重试，等待重试的邮件放在按到期时间排序的堆里，由同一批工作线程取出。
+# 配置了 FLASKY_MAIL_SPOOL_DIR 时邮件先写入磁盘，进程重启后继续发送：
+# 磁盘上的文件名里带着负责发送的进程号，几个进程共用一个目录时先用 rename 原子地认领，
+# 只有认领成功的进程才发送，进程不在了的邮件由别的进程接手。
+# 邮件模板在启动时预编译，群发时在工作线程里批量渲染。
+import heapq
+import itertools
+import os
+import pickle
+import threading
+import time
+import uuid
+from queue import Queue, Empty, Full
+
 from flask_mail import Message
 from . import mail
-from flask import render_template,current_app
-from threading import Thread
+from flask import current_app, request, has_request_context
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
 
-def send_email(to, subject, template, **kwargs):
+class MailTemplates(object):
+    """邮件模板：启动时预编译，批量渲染时模板上下文只准备一次。"""
+
+    def __init__(self, app, prefix='auth/email/'):
+        self.app = app
+        self.prefix = prefix
+        self._templates = {}
+
+    def precompile(self):
+        env = self.app.jinja_env
+        for name in env.list_templates(filter_func=lambda n: n.startswith(self.prefix)):
+            self._templates[name] = env.get_template(name)
+        return len(self._templates)
+
+    def get(self, name):
+        template = self._templates.get(name)
+        if template is None:
+            template = self._templates[name] = self.app.jinja_env.get_template(name)
+        return template
+
+    def render_batch(self, template, contexts, **common):
+        """给每个收件人的上下文渲染 (文本, HTML)，上下文处理器只执行一次。"""
+        txt = self.get(template + '.txt')
+        html = self.get(template + '.html')
+        base = {}
+        self.app.update_template_context(base)
+        base.update(common)
+        result = []
+        for context in contexts:
+            ctx = dict(base)
+            ctx.update(context)
+            result.append((txt.render(ctx), html.render(ctx)))
+        return result
+
+
+class MailJob(object):
+    def __init__(self, msg=None, path=None, render=None):
+        self.msg = msg
+        self.render = render    # 群发任务：(标题, 模板, 收件人列表, 公共参数, url_root)
+        self.path = path        # 持久化模式下邮件在磁盘上的文件
+        self.attempts = 0
+        self.queued_at = time.time()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:         # 没有权限，说明进程存在
+        return True
+    return True
+
+
+class MailDispatcher(object):
+    def __init__(self, app, workers=2, queue_size=1000, batch_size=50,
+                 max_retries=5, backoff=2.0, idle_timeout=30, spool_dir=None,
+                 enqueue_timeout=5):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.spool_dir = spool_dir
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = Queue(queue_size)
+        self.templates = MailTemplates(app)
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0,
+                      'connections': 0, 'send_seconds': 0.0,
+                      'delivery_seconds': 0.0}
+        self._outstanding = 0       # 还没有最终结果（发出或放弃）的邮件数
+        self._delayed = []          # 等待重试的 (到期时间, 序号, 任务)，用 _cond 保护
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = None        # 启动工作线程的进程号，fork 出来的子进程要自己启动
+        self._claimed = set()       # 本实例认领的文件，recover 时跳过
+        if spool_dir and not os.path.isdir(os.path.join(spool_dir, 'failed')):
+            os.makedirs(os.path.join(spool_dir, 'failed'))
+
+    # 入队 ------------------------------------------------------------------
+
+    def start(self):
+        with self._cond:
+            if self._started == os.getpid():
+                return
+            self._started = os.getpid()
+            self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name='mail-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        if self.spool_dir:
+            self.recover()
+
+    # 磁盘上的文件：<时间>-<uuid>.<进程号>.sending，进程号是负责发送的进程
+
+    def _claim_path(self, base):
+        return os.path.join(self.spool_dir, '%s.%d.sending' % (base, os.getpid()))
+
+    def _claim(self, name):
+        """认领一个别的进程留下的文件，返回新路径；已经被别人认领时返回 None。"""
+        if name.endswith('.msg'):       # 旧版本写的文件，没有人认领
+            base = name[:-len('.msg')]
+        elif name.endswith('.sending'):
+            base, pid = name[:-len('.sending')].rsplit('.', 1)
+            path = os.path.join(self.spool_dir, name)
+            if path in self._claimed or not pid.isdigit() or \
+                    (int(pid) != os.getpid() and _pid_alive(int(pid))):
+                return None
+        else:
+            return None
+        path = self._claim_path(base)
+        try:
+            os.rename(os.path.join(self.spool_dir, name), path)
+        except OSError:         # 被别的进程抢先了
+            return None
+        self._claimed.add(path)
+        return path
+
+    def recover(self):
+        """认领磁盘上进程已经不在了的邮件，重新放进队列，返回认领的数量。"""
+        count = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = self._claim(name)
+            if path is None:
+                continue
+            count += 1
+            try:
+                with open(path, 'rb') as f:
+                    msg, render = pickle.load(f)
+            except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
+                self.app.logger.exception('Cannot load spooled mail %s', path)
+                continue
+            self._enqueue(MailJob(msg, path, render))
+        return count
+
+    def _spool(self, msg, render=None):
+        # 写好以后直接以本进程认领的名字出现，别的进程不会拿去发
+        path = self._claim_path('%.6f-%s' % (time.time(), uuid.uuid4().hex))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((msg, render), f, pickle.HIGHEST_PROTOCOL)
+        self._claimed.add(path)
+        os.rename(tmp, path)
+        return path
+
+    def _unspool(self, path):
+        self._claimed.discard(path)
+        os.remove(path)
+
+    def _enqueue(self, job):
+        with self._cond:
+            self._outstanding += 1
+        try:
+            self.queue.put(job, timeout=self.enqueue_timeout)
+        except Full:
+            # 持久化模式下文件还在磁盘上，重启后会再发
+            self.stats['dropped'] += 1
+            self.app.logger.error('Mail queue is full, dropping a message')
+            self._finish()
+
+    def submit(self, msg):
+        self.start()
+        path = self._spool(msg) if self.spool_dir else None
+        job = MailJob(msg, path)
+        self._enqueue(job)
+        return job
+
+    def submit_many(self, msgs):
+        return [self.submit(msg) for msg in msgs]
+
+    def submit_batch(self, subject, template, recipients, context=None,
+                     url_root=None):
+        """群发：recipients 是 (邮箱, 模板参数) 列表，参数里只能放可以 pickle 的普通数据。
+
+        渲染和发送都在工作线程里完成，请求线程只负责入队。
+        """
+        self.start()
+        render = (subject, template, list(recipients), context or {}, url_root)
+        path = self._spool(None, render) if self.spool_dir else None
+        job = MailJob(path=path, render=render)
+        self._enqueue(job)
+        return job
+
+    # 发送 ------------------------------------------------------------------
+
+    def _finish(self):
+        with self._cond:
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def _retry_later(self, job):
+        # 不为每封邮件开定时器线程：放进堆里，调用这里的工作线程取下一批时会算上它的到期时间
+        due = time.time() + self.backoff ** job.attempts
+        self.stats['retried'] += 1
+        with self._cond:
+            heapq.heappush(self._delayed, (due, next(self._sequence), job))
+
+    def _due(self):
+        """取出已经到期的重试，返回 (任务列表, 离下一个到期还有几秒或 None)。"""
+        now = time.time()
+        jobs = []
+        with self._cond:
+            while self._delayed and self._delayed[0][0] <= now:
+                jobs.append(heapq.heappop(self._delayed)[2])
+            wait = self._delayed[0][0] - now if self._delayed else None
+        return jobs, wait
+
+    def _next_batch(self):
+        """返回 (到期的重试, 从队列取的新邮件)，都没有时等到下一个重试到期或空闲超时。"""
+        retries, wait = self._due()
+        batch = []
+        if not retries:
+            timeout = self.idle_timeout if wait is None else min(wait, self.idle_timeout)
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                if wait is None or wait >= self.idle_timeout:
+                    raise
+                return self._due()[0], batch
+        while len(retries) + len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return retries, batch
+
+    def _worker(self):
+        connection = None
+        with self.app.app_context():
+            while True:
+                try:
+                    retries, batch = self._next_batch()
+                except Empty:
+                    # 空闲太久就关掉连接，下次有邮件再连
+                    connection = self._close(connection)
+                    continue
+                for job in retries:
+                    connection = self._process(job, connection)
+                for job in batch:
+                    try:
+                        connection = self._process(job, connection)
+                    finally:
+                        self.queue.task_done()
+
+    def _process(self, job, connection):
+        if job.render is None:
+            return self._deliver(job, connection)
+        for sub_job in self._expand(job):
+            connection = self._deliver(sub_job, connection)
+        return connection
+
+    def _expand(self, job):
+        """渲染群发任务，拆成每个收件人一封邮件。"""
+        subject, template, recipients, context, url_root = job.render
+        try:
+            with self.app.test_request_context(base_url=url_root):
+                rendered = self.templates.render_batch(
+                    template, [ctx for to, ctx in recipients], **context)
+        except Exception:
+            self.app.logger.exception('Rendering mail %s failed', template)
+            self._failed(job)
+            return []
+        jobs = []
+        for (to, ctx), (body, html) in zip(recipients, rendered):
+            msg = Message(subject, sender=self.app.config['FLASKY_MAIL_SENDER'],
+                          recipients=[to])
+            msg.body = body
+            msg.html = html
+            path = self._spool(msg) if self.spool_dir else None
+            with self._cond:
+                self._outstanding += 1
+            jobs.append(MailJob(msg, path))
+        if job.path:
+            self._unspool(job.path)
+        self._finish()
+        return jobs
+
+    def _deliver(self, job, connection):
+        try:
+            if connection is None:
+                connection = mail.connect()
+                connection.__enter__()
+                self.stats['connections'] += 1
+            started = time.time()
+            connection.send(job.msg)
+        except Exception:
+            connection = self._close(connection)
+            self._failed(job)
+        else:
+            now = time.time()
+            self.stats['sent'] += 1
+            self.stats['send_seconds'] += now - started
+            self.stats['delivery_seconds'] += now - job.queued_at
+            if job.path:
+                self._unspool(job.path)
+            self._finish()
+        return connection
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def _failed(self, job):
+        job.attempts += 1
+        if job.attempts <= self.max_retries:
+            self.app.logger.warning('Sending mail failed, retry %d', job.attempts)
+            self._retry_later(job)
+            return
+        self.app.logger.exception('Giving up on mail')
+        self.stats['failed'] += 1
+        if job.path:
+            self._claimed.discard(job.path)
+            base = os.path.basename(job.path).rsplit('.', 2)[0]
+            os.rename(job.path, os.path.join(self.spool_dir, 'failed', base + '.msg'))
+        self._finish()
+
+    def join(self, timeout=None):
+        """等所有已提交的邮件发出或放弃。"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._outstanding > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def metrics(self):
+        result = dict(self.stats)
+        result['queue_depth'] = self.queue.qsize()
+        result['retry_pending'] = len(self._delayed)
+        result['outstanding'] = self._outstanding
+        sent = result['sent']
+        result['avg_send_seconds'] = result['send_seconds'] / sent if sent else 0.0
+        result['avg_delivery_seconds'] = result['delivery_seconds'] / sent if sent else 0.0
+        return result
+
+
+class MailQueue(object):
+    """扩展：mail_queue.init_app(app)。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_MAIL_WORKERS', 2)
+        app.config.setdefault('FLASKY_MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('FLASKY_MAIL_BATCH_SIZE', 50)
+        app.config.setdefault('FLASKY_MAIL_MAX_RETRIES', 5)
+        app.config.setdefault('FLASKY_MAIL_RETRY_BACKOFF', 2.0)
+        app.config.setdefault('FLASKY_MAIL_IDLE_TIMEOUT', 30)
+        app.config.setdefault('FLASKY_MAIL_SPOOL_DIR', None)
+        app.config.setdefault('FLASKY_MAIL_TEMPLATE_PREFIX', 'auth/email/')
+        dispatcher = app.extensions['mail_queue'] = MailDispatcher(
+            app,
+            workers=app.config['FLASKY_MAIL_WORKERS'],
+            queue_size=app.config['FLASKY_MAIL_QUEUE_SIZE'],
+            batch_size=app.config['FLASKY_MAIL_BATCH_SIZE'],
+            max_retries=app.config['FLASKY_MAIL_MAX_RETRIES'],
+            backoff=app.config['FLASKY_MAIL_RETRY_BACKOFF'],
+            idle_timeout=app.config['FLASKY_MAIL_IDLE_TIMEOUT'],
+            spool_dir=app.config['FLASKY_MAIL_SPOOL_DIR'])
+        # 启动时编译好邮件模板，发第一封邮件时不用再编译
+        dispatcher.templates.prefix = app.config['FLASKY_MAIL_TEMPLATE_PREFIX']
+        dispatcher.templates.precompile()
+        # 有持久化目录时启动就接着发上次没发完的邮件，不等第一封新邮件
+        if dispatcher.spool_dir:
+            dispatcher.start()
+
+    @property
+    def dispatcher(self):
+        return current_app.extensions['mail_queue']
+
+    def submit(self, msg):
+        return self.dispatcher.submit(msg)
+
+    def submit_many(self, msgs):
+        return self.dispatcher.submit_many(msgs)
+
+    def submit_batch(self, subject, template, recipients, context=None,
+                     url_root=None):
+        return self.dispatcher.submit_batch(subject, template, recipients,
+                                            context, url_root)
+
+    @property
+    def templates(self):
+        return self.dispatcher.templates
+
+    def join(self, timeout=None):
+        return self.dispatcher.join(timeout)
+
+    def metrics(self):
+        return self.dispatcher.metrics()
+
+
+mail_queue = MailQueue()
+
+
+def make_message(to, subject, template, **kwargs):
     app = current_app._get_current_object()
     msg = Message(app.config['FLASK_MAIL_SUBJET_PREFIX'] + subject,
                   sender = app.config['FLASKY_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    msg.body, msg.html = mail_queue.templates.render_batch(template, [kwargs])[0]
+    return msg
 
+def send_email(to, subject, template, **kwargs):
+    return mail_queue.submit(make_message(to, subject, template, **kwargs))
+
+def send_bulk_email(recipients, subject, template, **kwargs):
+    """recipients 是 (邮箱, 该收件人的模板参数) 的列表，渲染和发送都交给发送队列。"""
+    app = current_app._get_current_object()
+    url_root = request.url_root if has_request_context() else None
+    return mail_queue.submit_batch(app.config['FLASK_MAIL_SUBJET_PREFIX'] + subject,
+                                   template, recipients, kwargs, url_root)
@@ -0,0 +1,188 @@
+# coding: utf-8
+# 压力测试用的假数据：一次取出所有 id，按批 executemany 插入，不经过 ORM 事件，
+# 插入完成后统一重算计数、时间线和检索索引。给定 seed 时每次生成的数据完全相同。
+# 作者、被关注者和评论所在的文章都按幂律分布挑选，少数人和少数文章特别热门。
+import bisect
+import hashlib
+import itertools
+import random
+from datetime import datetime, timedelta
+
+from forgery_py.dictionaries_loader import get_dictionary
+
+from . import db, timeline, search, passwords, renderer
+
+
+# 给了 seed 时时间都相对这个固定时刻生成，同一个 seed 每次的数据完全一样
+SEED_EPOCH = datetime(2020, 1, 1)
+
+
+def _words(name):
+    return [line.strip() for line in get_dictionary(name) if line.strip()]
+
+
+class PowerLaw(object):
+    """按排名的幂律分布挑选：第 k 个被选中的概率正比于 1 / k ** alpha。"""
+
+    def __init__(self, values, alpha, rng):
+        self.values = list(values)
+        rng.shuffle(self.values)        # 谁热门是随机的，和 id 大小无关
+        total = 0.0
+        self.cum_weights = []
+        for rank in range(1, len(self.values) + 1):
+            total += 1.0 / rank ** alpha
+            self.cum_weights.append(total)
+        self.rng = rng
+
+    def choice(self):
+        x = self.rng.random() * self.cum_weights[-1]
+        return self.values[bisect.bisect(self.cum_weights, x)]
+
+    def sample(self, k):
+        return self.rng.choices(self.values, cum_weights=self.cum_weights, k=k)
+
+
+class Seeder(object):
+    def __init__(self, seed=None, batch_size=5000, days=365, now=None,
+                 password='password', alpha=1.1):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.now = now or (SEED_EPOCH if seed is not None else datetime.utcnow())
+        self.seconds = days * 24 * 3600
+        self.alpha = alpha
+        # 所有假用户共用一个密码散列，逐个计算会占掉大部分时间
+        self.password_hash = passwords.hash(password)
+        self.sentences = _words('lorem_ipsum')
+        self.first_names = _words('male_first_names') + _words('female_first_names')
+        self.last_names = _words('last_names')
+        self.cities = _words('cities')
+        self._templates = {}
+
+    # 工具 ----------------------------------------------------------------
+
+    def _ids(self, model):
+        return [id for id, in db.session.query(model.id).order_by(model.id)]
+
+    def _insert(self, table, rows):
+        """按 batch_size 分批插入，每批一次 executemany 并提交。"""
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return count
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            count += len(batch)
+
+    def _timestamp(self):
+        return self.now - timedelta(seconds=self.rng.randrange(self.seconds))
+
+    def _text(self, low, high):
+        return ' '.join(self.rng.choice(self.sentences)
+                        for i in range(self.rng.randint(low, high)))
+
+    def _html(self, kind, text):
+        # 生成的文本只有普通句子，渲染结果只是外面包一层（文章是 <p>，评论不允许 <p>
+        # 所以没有），每类渲染一次占位文本得到外层，不用逐条渲染
+        if kind not in self._templates:
+            self._templates[kind] = renderer.render(kind, 'BODY').split('BODY')
+        before, after = self._templates[kind]
+        return before + text + after
+
+    # 各类数据 ------------------------------------------------------------
+
+    def users(self, count):
+        from .models import User, Role
+        role_id = db.session.query(Role.id).filter_by(default=True).scalar()
+        start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+        def rows():
+            for i in range(start, start + count):
+                first = self.rng.choice(self.first_names)
+                email = '%s%d@example.com' % (first.lower(), i)
+                since = self._timestamp()
+                yield {
+                    'email': email,
+                    'username': '%s%d' % (first.lower(), i),
+                    'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+                    'password_hash': self.password_hash,
+                    'role_id': role_id,
+                    'confirmed': True,
+                    'name': '%s %s' % (first, self.rng.choice(self.last_names)),
+                    'location': self.rng.choice(self.cities),
+                    'about_me': self._text(1, 2),
+                    'member_since': since,
+                    'last_seen': since,
+                }
+        return self._insert(User.__table__, rows())
+
+    def posts(self, count):
+        from .models import User, Post
+        authors = PowerLaw(self._ids(User), self.alpha, self.rng)
+
+        def rows():
+            for author_id in authors.sample(count):
+                body = self._text(1, 5)
+                yield {'body': body, 'body_html': self._html('post', body),
+                       'timestamp': self._timestamp(), 'author_id': author_id}
+        return self._insert(Post.__table__, rows())
+
+    def follows(self, count):
+        """粉丝数服从幂律分布，已有的关注关系和自己关注自己会跳过。"""
+        from .models import User, Follow
+        user_ids = self._ids(User)
+        if len(user_ids) < 2:
+            return 0
+        count = min(count, len(user_ids) * (len(user_ids) - 1))
+        followed = PowerLaw(user_ids, self.alpha, self.rng)
+        seen = set(db.session.query(Follow.follower_id, Follow.followed_id))
+        existing = len(seen)
+
+        def rows():
+            attempts = 0
+            while len(seen) - existing < count and attempts < count * 20:
+                attempts += 1
+                pair = (self.rng.choice(user_ids), followed.choice())
+                if pair[0] == pair[1] or pair in seen:
+                    continue
+                seen.add(pair)
+                yield {'follower_id': pair[0], 'followed_id': pair[1],
+                       'timestamp': self._timestamp()}
+        return self._insert(Follow.__table__, rows())
+
+    def comments(self, count, disabled_ratio=0.0):
+        from .models import User, Post, Comment
+        authors = self._ids(User)
+        posts = PowerLaw(self._ids(Post), self.alpha, self.rng)   # 热门文章
+
+        def rows():
+            for post_id in posts.sample(count):
+                body = self._text(1, 2)
+                yield {'body': body, 'body_html': self._html('comment', body),
+                       'timestamp': self._timestamp(),
+                       'disabled': self.rng.random() < disabled_ratio,
+                       'author_id': self.rng.choice(authors), 'post_id': post_id}
+        return self._insert(Comment.__table__, rows())
+
+    def finish(self, index=True):
+        """插入时跳过了模型事件，这里统一重算计数、时间线和检索索引。"""
+        from .models import User, Post
+        Post.refresh_comment_counts()
+        User.refresh_counters()
+        db.session.commit()
+        timeline.rebuild(db.session, self.batch_size)
+        if index:
+            search.reindex(db.session, self.batch_size)
+            db.session.commit()
+
+    def run(self, users=0, posts=0, follows=0, comments=0, index=True):
+        """按顺序生成各类数据，返回每类实际插入的行数。"""
+        result = {
+            'users': self.users(users) if users else 0,
+            'posts': self.posts(posts) if posts else 0,
+            'follows': self.follows(follows) if follows else 0,
+            'comments': self.comments(comments) if comments else 0,
+        }
+        self.finish(index)
+        return result
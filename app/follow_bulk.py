@@ -0,0 +1,280 @@
+# coding: utf-8
+# 关注关系的批量导入导出，给从旧平台迁移数据用：逐行读入 (关注人, 被关注者)，
+# 每批一次查询解析用户、一次查询去掉已有的关注、一次 executemany 插入并提交，
+# 关注数和粉丝数按批汇总成一次 executemany 更新，时间线每批一条 INSERT ... SELECT。
+# 导出按主键 keyset 分批读取，内存里最多只有一批数据。
+import csv
+import itertools
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from . import db, cache, follow_graph, timeline
+
+FIELDS = ('follower', 'followed', 'timestamp')
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    for pattern in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, pattern)
+        except ValueError:
+            pass
+    raise ValueError('bad timestamp: %r' % value)
+
+
+def _user_value(value, name):
+    if isinstance(value, bool) or not isinstance(value, (str, int)) or \
+            (isinstance(value, str) and not value.strip()):
+        raise ValueError('bad %s: %r' % (name, value))
+    return value.strip() if isinstance(value, str) else value
+
+
+def _parse_row(row):
+    if isinstance(row, dict):
+        if 'follower' not in row or 'followed' not in row:
+            raise ValueError('missing follower or followed')
+        follower, followed, timestamp = \
+            row['follower'], row['followed'], row.get('timestamp')
+    elif isinstance(row, list) and 2 <= len(row) <= 3:
+        follower, followed, timestamp = (row + [None])[:3]
+    else:
+        raise ValueError('expected an object or a 2-3 item array')
+    if timestamp is not None and not isinstance(timestamp, str):
+        raise ValueError('bad timestamp: %r' % (timestamp,))
+    return (_user_value(follower, 'follower'), _user_value(followed, 'followed'),
+            _parse_timestamp(timestamp))
+
+
+def _csv_rows(lines):
+    reader = csv.DictReader(lines)
+    missing = [name for name in FIELDS[:2] if name not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError('line 1: missing columns: %s' % ', '.join(missing))
+    for row in reader:
+        if None in row:
+            yield reader.line_num, ValueError('too many columns')
+        else:
+            yield reader.line_num, row
+
+
+def _jsonl_rows(lines):
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, ValueError('invalid JSON')
+
+
+def read_pairs(lines, format='csv', errors=None):
+    """逐行产生 (关注人, 被关注者, 时间或 None)。
+
+    csv 要有 follower,followed 表头，可以多一列 timestamp；jsonl 每行一个
+    {"follower": ..., "followed": ...} 对象或 [关注人, 被关注者] 数组。
+    格式不对的行：errors 为 None 时抛出带行号的 ValueError，否则把 (行号, 原因)
+    加进 errors 列表并跳过这一行。导入中断后可以用同一个文件重跑，已存在的关注会跳过。
+    """
+    if format == 'csv':
+        rows = _csv_rows(lines)
+    elif format == 'jsonl':
+        rows = _jsonl_rows(lines)
+    else:
+        raise ValueError('unknown format: %s' % format)
+    for number, row in rows:
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            yield _parse_row(row)
+        except ValueError as e:
+            if errors is None:
+                raise ValueError('line %d: %s' % (number, e))
+            errors.append((number, str(e)))
+
+
+def write_pairs(out, rows, format='csv'):
+    """把 iter_follows 的结果写进文本流，返回写出的行数。"""
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        for follower, followed, timestamp in rows:
+            writer.writerow((follower, followed,
+                             timestamp.isoformat() if timestamp else ''))
+            count += 1
+    elif format == 'jsonl':
+        for follower, followed, timestamp in rows:
+            out.write(json.dumps(dict(zip(FIELDS, (
+                follower, followed, timestamp.isoformat() if timestamp else None))),
+                sort_keys=True))
+            out.write('\n')
+            count += 1
+    else:
+        raise ValueError('unknown format: %s' % format)
+    return count
+
+
+def _batches(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _resolve(values, key):
+    """{原始值: 用户 id}，一条查询；不存在的用户不在结果里。"""
+    from .models import User
+    column = getattr(User, key)
+    if key == 'id':
+        wanted = {}
+        for value in values:
+            try:
+                wanted[int(value)] = value
+            except (TypeError, ValueError):
+                pass
+    else:
+        wanted = dict((value, value) for value in values)
+    if not wanted:
+        return {}
+    rows = db.session.query(column, User.id).filter(column.in_(list(wanted)))
+    return dict((wanted[value], id) for value, id in rows)
+
+
+def _existing(pairs):
+    """pairs 里已经存在的关注，一条查询，只返回 pairs 里的行。"""
+    from .models import Follow
+    if not pairs:
+        return set()
+    return set(db.session.query(Follow.follower_id, Follow.followed_id)
+               .filter(Follow.match(pairs)))
+
+
+def _prepare(batch, key, stats):
+    """解析一批输入，去掉未知用户、关注自己和批内重复，返回 {(关注人 id, 被关注者 id): 时间}。"""
+    ids = _resolve(set(v for row in batch for v in row[:2]), key)
+    pairs = {}
+    for follower, followed, timestamp in batch:
+        f, t = ids.get(follower), ids.get(followed)
+        if f is None or t is None:
+            stats['unknown'] += 1
+        elif f == t:
+            stats['self'] += 1
+        elif (f, t) in pairs:
+            stats['duplicate'] += 1
+        else:
+            pairs[f, t] = timestamp
+    return pairs
+
+
+def _counter_deltas(pairs, sign):
+    following, followers = defaultdict(int), defaultdict(int)
+    for f, t in pairs:
+        following[f] += sign
+        followers[t] += sign
+    return following, followers
+
+
+def _apply(session, pairs, sign):
+    from .models import User
+    connection = session.connection()
+    following, followers = _counter_deltas(pairs, sign)
+    User.change_counters(connection, 'following_count', following)
+    User.change_counters(connection, 'followers_count', followers)
+    cache.invalidate_on_commit(session)
+    follow_graph.invalidate_on_commit(session, *(set(following) | set(followers)))
+
+
+def follow_many(pairs, key='id', batch_size=1000, timelines=True):
+    """批量关注。pairs 是 read_pairs 产生的三元组，key 是用户的标识字段（id、username 或 email）。
+
+    已存在的关注原样保留。每批的时间线用一条 INSERT ... SELECT 补上；timelines 为 False
+    时不补，导入完再用 manage.py rebuild_timelines 分批重建。
+    返回各类行数的统计。
+    """
+    from .models import Follow
+    session = db.session
+    stats = dict.fromkeys(('read', 'inserted', 'existing', 'duplicate', 'self',
+                           'unknown'), 0)
+    for batch in _batches(pairs, batch_size):
+        stats['read'] += len(batch)
+        wanted = _prepare(batch, key, stats)
+        existing = _existing(list(wanted))
+        stats['existing'] += len(existing)
+        new = [pair for pair in wanted if pair not in existing]
+        if new:
+            now = datetime.utcnow()
+            session.execute(Follow.__table__.insert(), [
+                {'follower_id': f, 'followed_id': t, 'timestamp': wanted[f, t] or now}
+                for f, t in new])
+            _apply(session, new, 1)
+            if timelines:
+                timeline.followed_many(session, new)
+        session.commit()
+        stats['inserted'] += len(new)
+    return stats
+
+
+def unfollow_many(pairs, key='id', batch_size=1000, timelines=True):
+    """批量取消关注，参数和 follow_many 相同，不存在的关注计入 missing。"""
+    from .models import Follow
+    session = db.session
+    follows = Follow.__table__
+    stats = dict.fromkeys(('read', 'deleted', 'missing', 'duplicate', 'self',
+                           'unknown'), 0)
+    for batch in _batches(pairs, batch_size):
+        stats['read'] += len(batch)
+        wanted = _prepare(batch, key, stats)
+        existing = _existing(list(wanted))
+        stats['missing'] += len(wanted) - len(existing)
+        if existing:
+            session.execute(follows.delete().where(
+                (follows.c.follower_id == db.bindparam('f')) &
+                (follows.c.followed_id == db.bindparam('t'))),
+                [{'f': f, 't': t} for f, t in existing])
+            _apply(session, existing, -1)
+            if timelines:
+                timeline.unfollowed_many(session, existing)
+        session.commit()
+        stats['deleted'] += len(existing)
+    return stats
+
+
+def iter_follows(key='id', batch_size=1000):
+    """按 (follower_id, followed_id) 顺序产生所有关注 (关注人, 被关注者, 时间)。
+
+    每批一条 keyset 查询，不用 OFFSET，也不会一次把整张表读进内存。
+    """
+    from .models import Follow, User
+    follows = Follow.__table__
+    users = User.__table__
+    follower, followed = users.alias('follower'), users.alias('followed')
+    query = db.select([follows.c.follower_id, follows.c.followed_id,
+                       follower.c[key], followed.c[key], follows.c.timestamp]) \
+        .select_from(follows
+                     .join(follower, follower.c.id == follows.c.follower_id)
+                     .join(followed, followed.c.id == follows.c.followed_id)) \
+        .order_by(follows.c.follower_id, follows.c.followed_id) \
+        .limit(batch_size)
+    last = None
+    while True:
+        statement = query
+        if last is not None:
+            statement = statement.where(db.or_(
+                follows.c.follower_id > last[0],
+                db.and_(follows.c.follower_id == last[0],
+                        follows.c.followed_id > last[1])))
+        rows = db.session.execute(statement).fetchall()
+        for row in rows:
+            yield row[2], row[3], row[4]
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0], rows[-1][1]
@@ -0,0 +1,216 @@
+# coding: utf-8
+# 关注关系图：批量判断关注关系、互相关注、"你关注的人也关注了谁"的推荐。
+# 正向查询走 follows 的主键 (follower_id, followed_id)，反向查询走 (followed_id, follower_id) 索引。
+# 关注或粉丝特别多的热门账号，整张邻接表缓存在进程内存里，关注关系变化的事务提交后失效。
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class AdjacencyCache(object):
+    """(方向, 用户 id) -> 对方 id 的 frozenset，按 LRU 淘汰，ttl 秒后过期。"""
+
+    def __init__(self, ttl=300, size=256):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._sets = OrderedDict()      # (方向, user_id) -> (过期时间, frozenset)
+        self._lock = threading.Lock()
+
+    def get(self, direction, user_id):
+        key = (direction, user_id)
+        with self._lock:
+            entry = self._sets.get(key)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            self._sets.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, direction, user_id, ids):
+        with self._lock:
+            self._sets[direction, user_id] = (time.time() + self.ttl, frozenset(ids))
+            self._sets.move_to_end((direction, user_id))
+            while len(self._sets) > self.size:
+                self._sets.popitem(last=False)
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._sets.clear()
+                return
+            for user_id in user_ids:
+                self._sets.pop(('following', user_id), None)
+                self._sets.pop(('followers', user_id), None)
+
+
+class FollowGraph(object):
+    """扩展：follow_graph.init_app(app)。
+
+    FLASKY_FOLLOW_CACHE_THRESHOLD：关注数（或粉丝数）达到这个值的用户缓存整张邻接表，
+    None 表示不缓存。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_FOLLOW_CACHE_THRESHOLD', 1000)
+        app.config.setdefault('FLASKY_FOLLOW_CACHE_TTL', 300)
+        app.config.setdefault('FLASKY_FOLLOW_CACHE_SIZE', 256)
+        app.config.setdefault('FLASKY_FOLLOW_SUGGESTION_FANOUT', 200)
+        app.extensions['follow_graph'] = AdjacencyCache(
+            ttl=app.config['FLASKY_FOLLOW_CACHE_TTL'],
+            size=app.config['FLASKY_FOLLOW_CACHE_SIZE'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['follow_graph']
+
+    # 邻接表缓存 ------------------------------------------------------------
+
+    def _adjacency(self, direction, user):
+        """热门用户的整张邻接表，其他用户返回 None，由调用者直接查询。"""
+        from . import db
+        from .models import Follow
+        threshold = current_app.config['FLASKY_FOLLOW_CACHE_THRESHOLD']
+        count = user.following_count if direction == 'following' else user.followers_count
+        if threshold is None or (count or 0) < threshold:
+            return None
+        session = db.session()
+        # 本事务里改过关注关系时缓存不可信
+        if user.id in session.info.get('follow_graph_invalid', ()) or \
+                any(isinstance(o, Follow) for o in session.new) or \
+                any(isinstance(o, Follow) for o in session.deleted):
+            return None
+        ids = self.cache.get(direction, user.id)
+        if ids is None:
+            ids = frozenset(id for id, in self._neighbours(direction, user.id))
+            self.cache.put(direction, user.id, ids)
+        return ids
+
+    @staticmethod
+    def _neighbours(direction, user_id):
+        from . import db
+        from .models import Follow
+        if direction == 'following':
+            return db.session.query(Follow.followed_id).filter(Follow.follower_id == user_id)
+        return db.session.query(Follow.follower_id).filter(Follow.followed_id == user_id)
+
+    def invalidate_on_commit(self, session, *user_ids):
+        session.info.setdefault('follow_graph_invalid', set()).update(user_ids)
+
+    def after_commit(self, session):
+        ids = session.info.pop('follow_graph_invalid', None)
+        if ids:
+            self.cache.invalidate(ids)
+
+    def after_rollback(self, session):
+        session.info.pop('follow_graph_invalid', None)
+
+    # 批量判断 --------------------------------------------------------------
+
+    def is_following_many(self, user, ids):
+        """ids 里 user 关注了的那些，一条查询。"""
+        return self._filter('following', user, ids)
+
+    def followed_by_many(self, user, ids):
+        """ids 里关注了 user 的那些，一条查询。"""
+        return self._filter('followers', user, ids)
+
+    def _filter(self, direction, user, ids):
+        if user is None or not user.is_authenticated:
+            return set()
+        ids = set(id for id in ids if id is not None)
+        if not ids:
+            return set()
+        cached = self._adjacency(direction, user)
+        if cached is not None:
+            return ids & cached
+        from .models import Follow
+        column = Follow.followed_id if direction == 'following' else Follow.follower_id
+        return set(id for id, in self._neighbours(direction, user.id)
+                   .filter(column.in_(ids)))
+
+    def is_following(self, user, other):
+        return other.id in self.is_following_many(user, [other.id])
+
+    def is_followed_by(self, user, other):
+        return other.id in self.followed_by_many(user, [other.id])
+
+    def relationship(self, user, other):
+        """(user 是否关注 other, other 是否关注 user)，一条查询。"""
+        if user is None or not user.is_authenticated or other is None or \
+                user.id == other.id:
+            return False, False
+        from . import db
+        from .models import Follow
+        rows = set(db.session.query(Follow.follower_id, Follow.followed_id).filter(
+            db.or_(db.and_(Follow.follower_id == user.id, Follow.followed_id == other.id),
+                   db.and_(Follow.follower_id == other.id, Follow.followed_id == user.id))))
+        return (user.id, other.id) in rows, (other.id, user.id) in rows
+
+    # 图查询 ----------------------------------------------------------------
+
+    def mutual(self, user, limit=None):
+        """和 user 互相关注的用户 id。"""
+        from . import db
+        from .models import Follow
+        back = db.aliased(Follow)
+        query = db.session.query(Follow.followed_id) \
+            .join(back, db.and_(back.follower_id == Follow.followed_id,
+                                back.followed_id == Follow.follower_id)) \
+            .filter(Follow.follower_id == user.id) \
+            .order_by(Follow.timestamp.desc())
+        if limit:
+            query = query.limit(limit)
+        return [id for id, in query]
+
+    def known_followers(self, viewer, user, limit=None):
+        """viewer 关注的人里，也关注了 user 的那些 id。"""
+        from . import db
+        from .models import Follow
+        theirs = db.aliased(Follow)
+        query = db.session.query(Follow.followed_id) \
+            .join(theirs, theirs.follower_id == Follow.followed_id) \
+            .filter(Follow.follower_id == viewer.id, theirs.followed_id == user.id)
+        if limit:
+            query = query.limit(limit)
+        return [id for id, in query]
+
+    def suggestions(self, user, limit=10):
+        """你关注的人关注了、你还没关注的用户，按共同关注人数排序，返回 [(id, 人数)]。
+
+        只看最近关注的 FLASKY_FOLLOW_SUGGESTION_FANOUT 个人，关注很多人的账号也不会扫描整张图。
+        """
+        from . import db
+        from .models import Follow, User
+        fanout = current_app.config['FLASKY_FOLLOW_SUGGESTION_FANOUT']
+        mine = db.session.query(Follow.followed_id) \
+            .filter(Follow.follower_id == user.id) \
+            .order_by(Follow.timestamp.desc()).limit(fanout).subquery()
+        theirs = db.aliased(Follow)
+        already = db.session.query(Follow.followed_id).filter(Follow.follower_id == user.id)
+        score = db.func.count().label('score')
+        query = db.session.query(theirs.followed_id, score) \
+            .join(mine, mine.c.followed_id == theirs.follower_id) \
+            .join(User, User.id == theirs.followed_id) \
+            .filter(theirs.followed_id != user.id,
+                    ~theirs.followed_id.in_(already)) \
+            .group_by(theirs.followed_id, User.followers_count) \
+            .order_by(score.desc(), User.followers_count.desc(), theirs.followed_id) \
+            .limit(limit)
+        return [(id, n) for id, n in query]
+
+    def suggested_users(self, user, limit=10):
+        from .models import User
+        ids = [id for id, n in self.suggestions(user, limit)]
+        if not ids:
+            return []
+        users = dict((u.id, u) for u in User.query.filter(User.id.in_(ids)))
+        return [users[id] for id in ids if id in users]
@@ -7,4 +7,4 @@ from ..models import Permission
 
 @main.app_context_processor
 def inject_permissions():
-    return dict(Permission=Permission)
\ No newline at end of file
+    return dict(Permission=Permission, render_post_item=views.render_post_item)
\ No newline at end of file
@@ -1,10 +1,29 @@
-from flask import render_template
+from flask import render_template, request, jsonify
 from . import main
+from ..passwords import PasswordHashingBusy
+
+def wants_json():       #API 客户端只接受 JSON 时不返回 HTML 错误页
+    return request.accept_mimetypes.accept_json and \
+        not request.accept_mimetypes.accept_html
 
 @main.app_errorhandler(404)
 def page_not_found(e):
+    if wants_json():
+        response = jsonify({'error': 'not found'})
+        response.status_code = 404
+        return response
     return render_template('404.html'), 404
 
 @main.app_errorhandler(500)
 def internal_server_error(e):
-    return render_template('500.html'), 500
\ No newline at end of file
+    if wants_json():
+        response = jsonify({'error': 'internal server error'})
+        response.status_code = 500
+        return response
+    return render_template('500.html'), 500
+
+@main.app_errorhandler(PasswordHashingBusy)
+def password_hashing_busy(e):   #登录的人太多，密码散列排不上队
+    if wants_json():
+        return jsonify({'error': 'service unavailable'}), 503, {'Retry-After': '5'}
+    return render_template('500.html'), 503, {'Retry-After': '5'}
@@ -1,7 +1,7 @@
 # coding: utf-8
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField, BooleanField, SelectField
-from wtforms.validators import DataRequired, Length, Email, Regexp
+from wtforms.validators import DataRequired, Length, Email, Regexp, AnyOf
 from ..models import User, Role
 from wtforms import ValidationError
 from flask_pagedown.fields import PageDownField
@@ -52,4 +52,7 @@ class PostForm(FlaskForm):
 
 class CommentForm(FlaskForm):
     body = StringField('', validators=[DataRequired()])
-    submit = SubmitField('Submit')
\ No newline at end of file
+    submit = SubmitField('Submit')
+
+class ModerateForm(FlaskForm):     #批量审核，勾选的评论id在表单的ids字段里
+    action = StringField('', validators=[AnyOf(['approve', 'disable'])])
@@ -1,32 +1,51 @@
 # coding: utf-8
 from datetime import datetime
-from flask import render_template, session, redirect, url_for, abort, flash, request, current_app, make_response
+from flask import render_template, session, redirect, url_for, abort, flash, request, current_app, make_response, send_file
 from flask_login import login_required, current_user
 
 from . import main
-from .forms import PostForm, EditProfileForm, EditProfileAdminForm, CommentForm
-from .. import db
-from ..models import User, Role, Permission, Post, Comment
+from .forms import PostForm, EditProfileForm, EditProfileAdminForm, CommentForm, ModerateForm
+from .. import db, timeline, cache, avatars, profiler, follow_graph, search as fulltext
+from ..models import User, Role, Permission, Post, Comment, Follow
 from ..decorators import admin_required, permission_required
+from ..pagination import keyset_paginate, keyset_tail, approximate_count
+
+def render_post_item(post):     #文章列表中的一项，按文章和作者的版本号缓存
+    if current_user.is_authenticated and current_user.id == post.author_id:
+        viewer = 'author'
+    elif current_user.is_administrator():
+        viewer = 'admin'
+    else:
+        viewer = 'other'
+    post_version, author_version = cache.versions('post:%d' % post.id,
+                                                  'user:%d' % post.author_id)
+    key = 'fragment:post:%d:%s:%s:%s:%s' % (post.id, post_version, author_version,
+                                            viewer, request.scheme)
+    return cache.fragment(key, lambda: render_template('_post.html', post=post))
 
 @main.route('/', methods=['GET', 'POST'])
+@cache.cached_page()
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE_ARTICLES) and form.validate_on_submit():
         post = Post(body=form.body.data, author=current_user._get_current_object())
         db.session.add(post)
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
     show_followed = False
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get('show_followed', ''))      #从cookies中获取登陆用户的选择
-    if show_followed:       #显示所关注用户的文章
-        query = current_user.followed_posts
+    if show_followed:       #显示所关注用户的文章，从预先写好的时间线读取
+        query, columns = timeline.posts_for(current_user)
+        count_key = 'followed_posts:%d' % current_user.id
     else:       #显示所有文章
-        query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False
+        query, columns = Post.query, (Post.timestamp, Post.id)
+        count_key = 'posts'
+    pagination = keyset_paginate(
+        query.options(db.joinedload(Post.author)), columns,
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+        key=lambda post: (post.timestamp, post.id),
+        total=approximate_count(count_key, query)
     )
     posts = pagination.items
     return render_template('index.html',
@@ -47,12 +66,25 @@ def show_followed():
     return resp
 
 @main.route('/user/<username>')
+@cache.cached_page()
 def user(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         abort(404)
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
-    return render_template('user.html', user=user, posts=posts)
+    pagination = keyset_paginate(
+        user.posts, (Post.timestamp, Post.id),
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE']
+    )
+    posts = pagination.items
+    # 双方的关注关系一条查询取出；看自己的主页时给出推荐关注
+    following, followed_by = follow_graph.relationship(current_user, user)
+    suggestions = []
+    if current_user == user:
+        suggestions = follow_graph.suggested_users(user, 5)
+    return render_template('user.html', user=user, posts=posts,
+                           pagination=pagination, following=following,
+                           followed_by=followed_by, suggestions=suggestions)
 
 @main.route('/edit-profile', methods=['GET','POST'])
 @login_required
@@ -96,7 +128,35 @@ def edit_profile_admin(id):
     form.about_me.data = user.about_me
     return render_template('edit_profile.html', form=form, user=user)
 
+def comment_thread(post):
+    """文章下的一页评论，按 (timestamp, id) 升序，全部用 (post_id, timestamp, id) 索引定位：
+
+    ?after= / ?before=   前后翻页的游标
+    ?comment=<id>        结尾是这条评论的一页
+    ?comment=latest      最后一页（旧链接的 page=-1 也是）
+    """
+    columns = (Comment.timestamp, Comment.id)
+    query = post.comments.options(db.joinedload(Comment.author))
+    per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE']
+    after = request.args.get('after')
+    before = request.args.get('before')
+    anchor = request.args.get('comment')
+    if anchor is None and request.args.get('page') == '-1':
+        anchor = 'latest'
+    if anchor and not (after or before):
+        if anchor == 'latest':
+            return keyset_tail(query, columns, per_page=per_page)
+        if anchor.isdigit():
+            until = db.session.query(*columns) \
+                .filter_by(id=int(anchor), post_id=post.id).first()
+            # 评论已经删掉了就显示最后一页
+            return keyset_tail(query, columns, until=until and tuple(until),
+                               per_page=per_page)
+    return keyset_paginate(query, columns, after=after, before=before,
+                           per_page=per_page, descending=False)
+
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@cache.cached_page()
 def post(id):
     post = Post.query.get_or_404(id)
     form = CommentForm()
@@ -105,15 +165,11 @@ def post(id):
                           post=post,
                           author=current_user._get_current_object())
         db.session.add(comment)
+        db.session.flush()      #拿到新评论的id，跳到它所在的那一页
         flash('Your comment has been published.')
-        return redirect(url_for('.post', id=post.id, page=-1))
-    page = request.args.get('page', 1, type=int)
-    if page == -1:
-        page = (post.comments.count() - 1) / \
-            current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+        return redirect(url_for('.post', id=post.id, comment=comment.id,
+                                _anchor='comment-%d' % comment.id))
+    pagination = comment_thread(post)
     comments = pagination.items
     return render_template('post.html', posts=[post], form=form,
                            comments=comments, pagination=pagination)
@@ -142,10 +198,9 @@ def follow(username):
     if user is None:        #要关注的人不存在的情况
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if current_user.is_following(user):     #已关注的情况
+    if not current_user.follow(user):     #已关注的情况，follow里只判断一次
         flash('You are already following this user.')
         return redirect(url_for('.user', username=username))
-    current_user.follow(user)       #上边都满足，调用User模型的follow方法
     flash('You are now following %s.' % username)
     return redirect(url_for('.user', username=username))
 
@@ -157,29 +212,33 @@ def unfollow(username):
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if not current_user.is_following(user):
+    if not current_user.unfollow(user):
         flash("You havn/'t followed this user!")
         return redirect(url_for('.user', username=username))
-    current_user.unfollow(user)
     flash('You are now unfollow %s.' % username)
     return redirect(url_for('.user', username=username))
 
+def follow_states(follows):     #当前用户和列表里每个人的关注关系，整页两条查询
+    ids = [item['user'].id for item in follows]
+    return {'i_follow': follow_graph.is_following_many(current_user, ids),
+            'follows_me': follow_graph.followed_by_many(current_user, ids)}
+
 @main.route('/followers/<username>')
 def followers(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.who_i_followed.paginate(
-        page, per_page=current_app.config['FLASK_FOLLOWERS_PER_PAGE'],
-        error_out=False
+    pagination = keyset_paginate(
+        user.who_i_followed, (Follow.timestamp, Follow.followed_id),
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=current_app.config['FLASK_FOLLOWERS_PER_PAGE']
     )
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                for item in pagination.items]    #列表生成式，把pagination中的用户跟时间迭代出来
     return render_template('followers.html', user=user, title="Followers of",
                            endpoint='.followers', pagination=pagination,
-                           follows=follows)
+                           follows=follows, **follow_states(follows))
 
 @main.route('/followed_by/<username>')
 def followed_by(username):
@@ -187,28 +246,51 @@ def followed_by(username):
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.who_followed_me.paginate(
-        page, per_page=current_app.config['FLASK_FOLLOWERS_PER_PAGE'],
-        error_out=False
+    pagination = keyset_paginate(
+        user.who_followed_me, (Follow.timestamp, Follow.follower_id),
+        after=request.args.get('after'), before=request.args.get('before'),
+        per_page=current_app.config['FLASK_FOLLOWERS_PER_PAGE']
     )
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title="Followed by",
                            endpoint='.followed_by', pagination=pagination,
-                           follows=follows)
+                           follows=follows, **follow_states(follows))
+
+moderation_states = {
+    'pending': Comment.pending(),
+    'disabled': Comment.disabled.is_(True),
+    'approved': Comment.disabled.is_(False),
+    'all': None,
+}
 
-@main.route('/moderate')
+@main.route('/moderate', methods=['GET', 'POST'])
 @login_required
 @permission_required(Permission.MODERATE_COMMENTS)
-def moderate():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+def moderate():     #审核队列，默认只列出待审核的评论；勾选多条后一次通过或屏蔽
+    state = request.args.get('state', 'pending')
+    if state not in moderation_states:
+        abort(404)
+    after = request.args.get('after')
+    before = request.args.get('before')
+    form = ModerateForm()
+    if form.validate_on_submit():
+        ids = request.form.getlist('ids', type=int)
+        changed = Comment.moderate(ids, form.action.data == 'disable')
+        flash('%d comments updated.' % changed)
+        return redirect(url_for('.moderate', state=state, after=after, before=before))
+    query = Comment.query
+    if moderation_states[state] is not None:
+        query = query.filter(moderation_states[state])
+    pagination = keyset_paginate(
+        query.options(db.joinedload(Comment.author)),
+        (Comment.timestamp, Comment.id),
+        after=after, before=before,
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
+        total=approximate_count('comments:' + state, query))
     comments = pagination.items
-    return render_template('moderate.html', comments=comments,
-                           pagination=pagination, page=page)
+    return render_template('moderate.html', comments=comments, form=form, state=state,
+                           pagination=pagination, after=after, before=before)
 
 @main.route('/moderate/enable/<int:id>')
 @login_required
@@ -217,8 +299,9 @@ def moderate_enable(id):
     comment = Comment.query.get_or_404(id)
     comment.disabled = False
     db.session.add(comment)
-    return redirect(url_for('.moderate',
-                            page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', state=request.args.get('state'),
+                            after=request.args.get('after'),
+                            before=request.args.get('before')))
 
 @main.route('/moderate/disable/<int:id>')
 @login_required
@@ -227,5 +310,62 @@ def moderate_disable(id):
     comment = Comment.query.get_or_404(id)
     comment.disabled = True
     db.session.add(comment)
-    return redirect(url_for('.moderate',
-                            page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', state=request.args.get('state'),
+                            after=request.args.get('after'),
+                            before=request.args.get('before')))
+
+@main.route('/avatar/<hash>')
+def avatar(hash):       #FLASKY_AVATAR_SOURCE为local时的头像，渲染结果缓存在磁盘上
+    store = avatars.store
+    if not store.valid_hash(hash):
+        abort(404)
+    size = store.standard_size(request.args.get('s', 100, type=int))
+    etag = '%s-%d-%s' % (hash, size, store.fmt)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        # 只给存在的用户渲染，否则循环请求随机哈希就能把磁盘写满
+        if not store.cached(hash, size) and not db.session.query(
+                User.query.filter_by(avatar_hash=hash).exists()).scalar():
+            abort(404)
+        response = send_file(store.path(hash, size), mimetype=store.mimetype,
+                             add_etags=False, conditional=False)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    return response
+
+search_models = {'post': Post, 'comment': Comment, 'user': User}
+
+@main.route('/search')
+def search():       #全文检索，结果按相关度排序，用游标翻页
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('kind', 'post')
+    model = search_models.get(kind)
+    if model is None:
+        abort(404)
+    pagination = fulltext.query(kind, q, after=request.args.get('after'))
+    results = []
+    if pagination.items:
+        query = model.query.filter(model.id.in_(pagination.items))
+        if model is not User:
+            query = query.options(db.joinedload(model.author))
+        objects = dict((o.id, o) for o in query)
+        results = [objects[id] for id in pagination.items if id in objects]
+    return render_template('search.html', q=q, kind=kind, results=results,
+                           pagination=pagination)
+
+profile_sort_keys = ('mean_ms', 'max_ms', 'total_ms', 'queries', 'sql_ms', 'duplicates')
+
+@main.route('/debug/profile')
+@login_required
+@admin_required
+def debug_profile():        #FLASKY_PROFILE打开时各页面的耗时汇总，按平均耗时排序
+    if not profiler.enabled:
+        abort(404)
+    sort = request.args.get('sort', 'mean_ms')
+    if sort not in profile_sort_keys:
+        sort = 'mean_ms'
+    return render_template('debug_profile.html', sort=sort, sort_keys=profile_sort_keys,
+                           endpoints=profiler.stats.endpoint_table(sort),
+                           slowest=profiler.stats.slowest_requests())
@@ -0,0 +1,341 @@
+# coding: utf-8
+# 运行指标：每个 endpoint 的请求耗时直方图、数据库连接池、各级缓存命中率、邮件队列深度和
+# 上传字节数，以 Prometheus 的文本格式从本机的 /metrics 导出。
+# 预派生（pre-fork）部署时设置 FLASKY_METRICS_DIR，各进程定期把自己的数据写成
+# <pid>.json，/metrics 把所有文件合并：计数器和直方图相加，瞬时值（连接池大小、
+# 队列深度等）加上 pid 标签分开列出，已退出进程的瞬时值丢弃。
+import atexit
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, request, abort, g
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 名称 -> (类型, 说明)
+METRICS = {
+    'flasky_http_requests_total': ('counter', 'Requests by endpoint, method and status.'),
+    'flasky_http_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'flasky_db_connections_checked_out': ('gauge', 'Database connections in use.'),
+    'flasky_db_pool_size': ('gauge', 'Configured connection pool size.'),
+    'flasky_db_pool_overflow': ('gauge', 'Connections opened beyond the pool size.'),
+    'flasky_db_checkouts_total': ('counter', 'Connections taken from the pool.'),
+    'flasky_cache_hits_total': ('counter', 'Cache hits by cache.'),
+    'flasky_cache_misses_total': ('counter', 'Cache misses by cache.'),
+    'flasky_mail_queue_depth': ('gauge', 'Mail jobs waiting for a worker.'),
+    'flasky_mail_outstanding': ('gauge', 'Mails submitted but not yet sent or given up.'),
+    'flasky_mail_sent_total': ('counter', 'Mails sent.'),
+    'flasky_mail_failed_total': ('counter', 'Mails given up after retries.'),
+    'flasky_upload_bytes_total': ('counter', 'Bytes received by photo uploads.'),
+    'flasky_uploads_total': ('counter', 'Photos stored.'),
+    'flasky_photo_variants_pending': ('gauge', 'Photos waiting for their variants.'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry(object):
+    """本进程的计数器和直方图，标签是排好序的 (名, 值) 元组。"""
+
+    def __init__(self, app, buckets=DEFAULT_BUCKETS, directory=None, interval=5):
+        self.app = app
+        self.buckets = tuple(sorted(buckets))
+        self.directory = directory
+        self.interval = interval
+        self.counters = defaultdict(float)      # (名称, 标签) -> 值
+        self.histograms = {}                    # (名称, 标签) -> [各桶计数, 总和, 次数]
+        self.checked_out = 0
+        self._lock = threading.Lock()
+        self._written = 0
+        self._atexit = False
+
+    # 记录 ------------------------------------------------------------------
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
+
+    def connection_moved(self, delta):
+        with self._lock:
+            self.checked_out += delta
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    # 采集 ------------------------------------------------------------------
+
+    def gauges(self):
+        """抓取时才读取的瞬时值和外部计数器，返回 [(名称, 标签, 值)]。"""
+        app = self.app
+        result = [('flasky_db_connections_checked_out', (), max(self.checked_out, 0))]
+        from . import db
+        pool = db.get_engine(app).pool
+        if hasattr(pool, 'size') and hasattr(pool, 'overflow'):
+            result.append(('flasky_db_pool_size', (), pool.size()))
+            result.append(('flasky_db_pool_overflow', (), max(pool.overflow(), 0)))
+        caches = [('cache', app.extensions.get('cache')),
+                  ('user', app.extensions.get('user_cache')),
+                  ('follow_graph', app.extensions.get('follow_graph'))]
+        renderer = app.extensions.get('renderer')
+        if renderer is not None:
+            caches.extend(('render_' + kind, r) for kind, r in renderer.renderers.items())
+        for name, cache in caches:
+            if cache is None or not hasattr(cache, 'hits'):
+                continue
+            labels = (('cache', name),)
+            result.append(('flasky_cache_hits_total', labels, cache.hits))
+            result.append(('flasky_cache_misses_total', labels, cache.misses))
+        mail = app.extensions.get('mail_queue')
+        if mail is not None:
+            stats = mail.metrics()
+            result.append(('flasky_mail_queue_depth', (), stats['queue_depth']))
+            result.append(('flasky_mail_outstanding', (), stats['outstanding']))
+            result.append(('flasky_mail_sent_total', (), stats['sent']))
+            result.append(('flasky_mail_failed_total', (), stats['failed']))
+        variants = app.extensions.get('photo_variants')
+        if variants is not None:
+            result.append(('flasky_photo_variants_pending', (), variants.pending))
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, labels, value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, list(h[0]), h[1], h[2]]
+                          for (name, labels), h in self.histograms.items()]
+        return {'pid': os.getpid(), 'buckets': self.buckets, 'counters': counters,
+                'histograms': histograms,
+                'gauges': [list(item) for item in self.gauges()]}
+
+    # 多进程 ----------------------------------------------------------------
+
+    def write(self, force=False):
+        """把本进程的快照写进 FLASKY_METRICS_DIR，interval 秒之内最多写一次。"""
+        if not self.directory:
+            return False
+        now = time.time()
+        if not force and now - self._written < self.interval:
+            return False
+        self._written = now
+        if not self._atexit:
+            self._atexit = True
+            atexit.register(self._safe_write)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, os.path.join(self.directory, '%d.json' % os.getpid()))
+        return True
+
+    def _safe_write(self):
+        try:
+            self.write(force=True)
+        except Exception:
+            self.app.logger.exception('Writing metrics failed')
+
+    def collect(self):
+        """所有进程合并后的快照；没有设置目录时就是本进程的。"""
+        if not self.directory:
+            return [self.snapshot()]
+        self.write(force=True)
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue        # 正好在被替换，或者是残缺的文件
+            if not _alive(snapshot['pid']):
+                # 进程没了，瞬时值不再有意义，计数器照样累计
+                snapshot['gauges'] = [item for item in snapshot['gauges']
+                                      if item[0].endswith('_total')]
+            snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        counters = defaultdict(float)
+        gauges = defaultdict(float)
+        histograms = {}
+        for snapshot in self.collect():
+            if tuple(snapshot['buckets']) != self.buckets:
+                continue        # 桶的配置变过，旧文件无法合并
+            for name, labels, value in snapshot['counters']:
+                counters[name, _labels(labels)] += value
+            for name, labels, value in snapshot['gauges']:
+                # 缓存命中之类的外部计数器按进程相加；真正的瞬时值相加没有意义
+                # （几个进程的连接池大小加起来不是任何东西的大小），按 pid 分开
+                labels = _labels(labels)
+                if self.directory and not name.endswith('_total'):
+                    labels += (('pid', str(snapshot['pid'])),)
+                gauges[name, labels] += value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = name, _labels(labels)
+                hist = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+                hist[1] += total
+                hist[2] += count
+        series = defaultdict(list)
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            series[name].append('%s%s %s' % (name, _format_labels(labels),
+                                              _format_value(value)))
+        for (name, labels), (buckets, total, count) in histograms.items():
+            lines = series[name]
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), buckets + [0]):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels + (('le', _format_value(bound)),)),
+                    cumulative if bound != float('inf') else count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+        output = []
+        for name in sorted(series):
+            kind, help = METRICS.get(name, ('untyped', ''))
+            output.append('# HELP %s %s' % (name, help))
+            output.append('# TYPE %s %s' % (name, kind))
+            output.extend(sorted(series[name]) if kind != 'histogram' else series[name])
+        return '\n'.join(output) + '\n'
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics(object):
+    """扩展：metrics.init_app(app)，注册 /metrics 并记录每个请求的耗时。
+
+    设置了 FLASKY_METRICS_TOKEN 时，/metrics 要带 "Authorization: Bearer 令牌"；
+    没设置时只对 FLASKY_METRICS_ALLOWED 里的地址开放。其他请求返回 404。
+    放在反向代理后面时 remote_addr 是代理的地址，外面的请求也会被当成本机，
+    这时要设置令牌，或者让代理不转发 /metrics（ProxyFix 只有在代理覆盖而不是追加
+    X-Forwarded-For 时才可信）。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_METRICS', True)
+        app.config.setdefault('FLASKY_METRICS_BUCKETS', DEFAULT_BUCKETS)
+        app.config.setdefault('FLASKY_METRICS_DIR', None)
+        app.config.setdefault('FLASKY_METRICS_INTERVAL', 5)
+        app.config.setdefault('FLASKY_METRICS_ALLOWED', ('127.0.0.1', '::1'))
+        app.config.setdefault('FLASKY_METRICS_TOKEN', None)
+        first = 'metrics' not in app.extensions
+        app.extensions['metrics'] = MetricsRegistry(
+            app, buckets=app.config['FLASKY_METRICS_BUCKETS'],
+            directory=app.config['FLASKY_METRICS_DIR'],
+            interval=app.config['FLASKY_METRICS_INTERVAL'])
+        if first:
+            app.before_request(self._start)
+            app.after_request(self._finish)
+            app.before_first_request(self._watch_pool)
+            app.add_url_rule('/metrics', 'metrics', self.view)
+
+    @property
+    def registry(self):
+        return current_app.extensions['metrics']
+
+    def inc(self, name, amount=1, **labels):
+        if current_app.config['FLASKY_METRICS']:
+            self.registry.inc(name, amount, **labels)
+
+    def _start(self):
+        if current_app.config['FLASKY_METRICS']:
+            g._metrics_started = time.perf_counter()
+
+    def _finish(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None or request.endpoint in (None, 'static', 'metrics'):
+            return response
+        registry = self.registry
+        endpoint = request.endpoint
+        registry.observe('flasky_http_request_duration_seconds',
+                         time.perf_counter() - started, endpoint=endpoint,
+                         blueprint=request.blueprint or '')
+        registry.inc('flasky_http_requests_total', endpoint=endpoint,
+                     method=request.method, status=str(response.status_code))
+        registry.write()
+        return response
+
+    def _watch_pool(self):
+        # 在引擎上监听，连接池被 dispose 重建后监听器还在
+        from . import db
+        app = current_app._get_current_object()
+        registry = app.extensions['metrics']
+        engine = db.get_engine(app)
+
+        def checkout(dbapi_connection, record, proxy):
+            registry.connection_moved(1)
+            registry.inc('flasky_db_checkouts_total')
+
+        def checkin(dbapi_connection, record):
+            registry.connection_moved(-1)
+
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', checkin)
+
+    @staticmethod
+    def _allowed():
+        config = current_app.config
+        token = config['FLASKY_METRICS_TOKEN']
+        if token:
+            header = request.headers.get('Authorization', '')
+            return header[:7].lower() == 'bearer ' and \
+                hmac.compare_digest(header[7:].strip().encode('utf-8'),
+                                    token.encode('utf-8'))
+        return request.remote_addr in config['FLASKY_METRICS_ALLOWED']
+
+    def view(self):
+        if not current_app.config['FLASKY_METRICS'] or not self._allowed():
+            abort(404)
+        return current_app.response_class(self.registry.render(),
+                                          mimetype='text/plain; version=0.0.4')
@@ -1,14 +1,38 @@
 # coding: utf-8
-from app import db, login_manager
-from werkzeug.security import generate_password_hash, check_password_hash
+from app import db, login_manager, timeline, renderer, cache, activity, user_cache, avatars, search, \
+    passwords, follow_graph
 from flask_login import UserMixin, AnonymousUserMixin
-from flask import current_app, request
+from flask import current_app, request, url_for
 from datetime import datetime
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
-import bleach
 import hashlib      #计算电子邮件的MD5散列值库
 
+def group_count(key, *conditions):
+    return db.select([key, db.func.count()]).where(db.and_(*conditions)) \
+        .group_by(key)
+
+def refresh_count_columns(table, sources):
+    """按 GROUP BY 统计后批量写回冗余的计数字段。
+
+    sources 是 {字段名: 返回 (id, 数量) 的查询}。每个来源表只扫描一遍，
+    不用对每一行执行一次相关子查询（来源表的外键没有索引时那是平方级的）。
+    """
+    counts = {}
+    for name, query in sources.items():
+        for id, n in db.session.execute(query):
+            if id is not None:
+                counts.setdefault(id, dict.fromkeys(sources, 0))[name] = n
+    db.session.execute(table.update().values(**dict.fromkeys(sources, 0)))
+    if counts:
+        statement = table.update().where(table.c.id == db.bindparam('row_id')) \
+            .values(**dict((name, db.bindparam('n_' + name)) for name in sources))
+        db.session.execute(statement, [
+            dict([('row_id', id)] + [('n_' + k, v) for k, v in values.items()])
+            for id, values in counts.items()])
+
+def isoformat(value):     #API 里的时间一律是 UTC 的 ISO 8601 字符串
+    return value.isoformat() + 'Z' if value is not None else None
+
 class Permission:
     FOLLOW = 0x01
     COMMENT = 0x02
@@ -18,6 +42,10 @@ class Permission:
 
 class Follow(db.Model):
     __tablename__ = 'follows'
+    # 主键 (follower_id, followed_id) 查"我关注了谁"，反向索引查"谁关注了我"
+    __table_args__ = (
+        db.Index('ix_follows_followed_follower', 'followed_id', 'follower_id'),
+    )
     # Follow被添加了follwoer和followed引用，
     # 使用z.follower  z.followed可以返回具体对象
 
@@ -27,45 +55,174 @@ class Follow(db.Model):
                             primary_key=True)       #被关注者ID
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def match(pairs, follower=None, followed=None):
+        """(follower, followed) 恰好是 pairs 里某一对的条件，按关注人分组成
+        (follower = ? AND followed IN (...)) OR ...，走主键，不会像两个 IN 那样得到笛卡尔积。
+        follower / followed 默认是 follows 表的两列，也可以换成别的表里对应的列。
+        """
+        if follower is None:
+            follower, followed = Follow.follower_id, Follow.followed_id
+        groups = {}
+        for f, t in pairs:
+            groups.setdefault(f, set()).add(t)
+        return db.or_(*[db.and_(follower == f, followed.in_(sorted(ts)))
+                        for f, ts in sorted(groups.items())])
+
+    # 关注关系增删时同步双方的关注数和粉丝数
+    @staticmethod
+    def on_created(mapper, connection, target):
+        User.change_counter(connection, target.follower_id, 'following_count', 1)
+        User.change_counter(connection, target.followed_id, 'followers_count', 1)
+        cache.invalidate_on_commit(db.object_session(target))
+        follow_graph.invalidate_on_commit(db.object_session(target),
+                                          target.follower_id, target.followed_id)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        User.change_counter(connection, target.follower_id, 'following_count', -1)
+        User.change_counter(connection, target.followed_id, 'followers_count', -1)
+        cache.invalidate_on_commit(db.object_session(target))
+        follow_graph.invalidate_on_commit(db.object_session(target),
+                                          target.follower_id, target.followed_id)
+
+class TimelineEntry(db.Model):
+    # 每个用户的关注动态，发文章时写入所有关注者的时间线（见 app/timeline.py）
+    __tablename__ = 'timeline_entries'
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp', 'user_id', 'timestamp', 'post_id'),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    timestamp = db.Column(db.DateTime)
+
 class Comment(db.Model):
     __tablename__ = 'comments'
+    # 审核队列按 (disabled, timestamp) 取数据；SQLite 的索引末尾自带 rowid，按 id 排序也用得上
+    __table_args__ = (
+        db.Index('ix_comments_disabled_timestamp', 'disabled', 'timestamp'),
+        db.Index('ix_comments_post_timestamp', 'post_id', 'timestamp', 'id'),   #文章下的评论按时间翻页
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    disabled = db.Column(db.Boolean)
+    # 审核状态：None 待审核（照常显示），False 审核通过，True 被屏蔽
+    disabled = db.Column(db.Boolean, default=None)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
 
-    @staticmethod
-    def generate_fake(count=500):  # 用forgery_py生成文章
-        from random import seed, randint
-        import forgery_py
+    def to_json(self):
+        return {
+            'id': self.id,
+            'body': self.body,
+            'body_html': self.body_html,
+            'timestamp': isoformat(self.timestamp),
+            'author_id': self.author_id,
+            'author_url': url_for('api.get_user', id=self.author_id, _external=True),
+            'post_id': self.post_id,
+            'post_url': url_for('api.get_post', id=self.post_id, _external=True),
+        }
 
-        seed()
-        user_count = User.query.count()
-        post_count = Post.query.count()
-        for i in range(count):
-            u = User.query.offset(randint(0, user_count - 1)).first()
-            p = Post.query.offset(randint(0, post_count - 1)).first()
-            c = Comment(body=forgery_py.lorem_ipsum.sentences(randint(1, 3)),
-                     timestamp=forgery_py.date.date(True),
-                     disabled = True,
-                     post = p,
-                     author=u)
-            db.session.add(p)
-            db.session.commit()
+    @staticmethod
+    def generate_fake(count=500, seed=None):  # 批量生成假评论，见app/fake.py
+        from .fake import Seeder
+        seeder = Seeder(seed)
+        seeder.comments(count)
+        seeder.finish()
 
     @staticmethod
     def on_change_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True
-        ))
+        renderer.render_body(target, value, 'comment')
+
+    @staticmethod
+    def visible():      #没有被屏蔽的评论（待审核和审核通过的）
+        return Comment.disabled.isnot(True)
+
+    @staticmethod
+    def pending():
+        return Comment.disabled.is_(None)
+
+    @staticmethod
+    def moderate(ids, disabled):
+        """一条 UPDATE 改掉一批评论的审核状态，同步文章的可见评论数、检索索引和缓存。
+
+        不经过 ORM 事件，返回状态确实变了的评论数。
+        """
+        comments = Comment.__table__
+        ids = set(ids)
+        if not ids:
+            return 0
+        rows = db.session.execute(
+            db.select([comments.c.id, comments.c.post_id, comments.c.disabled,
+                       comments.c.body])
+            .where(comments.c.id.in_(ids))
+            .where(comments.c.disabled.isnot(disabled))).fetchall()
+        if not rows:
+            return 0
+        db.session.execute(comments.update()
+                           .where(comments.c.id.in_([row.id for row in rows]))
+                           .values(disabled=disabled))
+        deltas = {}
+        for row in rows:
+            if bool(row.disabled) != disabled:      #待审核和通过之间切换不影响可见数
+                deltas[row.post_id] = deltas.get(row.post_id, 0) + (-1 if disabled else 1)
+        connection = db.session.connection()
+        Post.change_comment_counts(connection, deltas)
+        if disabled:
+            search.remove_many(connection, 'comment', [row.id for row in rows])
+        else:
+            search.update_many(connection, 'comment', [(row.id, '', row.body)
+                                                       for row in rows if row.disabled])
+        cache.invalidate_on_commit(db.session(), *['post:%d' % post_id for post_id in
+                                                   set(row.post_id for row in rows)])
+        return len(rows)
+
+    # 评论增删时同步文章的可见评论数，列表页和文章页不用查 COUNT
+    @staticmethod
+    def on_created(mapper, connection, target):
+        if not target.disabled:
+            Post.change_comment_count(connection, target.post_id, 1)
+        User.change_counter(connection, target.author_id, 'comments_count', 1)
+        Comment.on_changed(connection, target)
+
+    @staticmethod
+    def on_updated(mapper, connection, target):     #屏蔽或解除屏蔽时调整文章的可见评论数
+        history = db.inspect(target).attrs.disabled.history
+        if history.has_changes():
+            if history.deleted:
+                if bool(history.deleted[0]) != bool(target.disabled):
+                    Post.change_comment_count(connection, target.post_id,
+                                              -1 if target.disabled else 1)
+            else:       #改之前的值没有加载，只好重新数一遍
+                Post.recount_comments(connection, target.post_id)
+        Comment.on_changed(connection, target)
+
+    @staticmethod
+    def on_changed(connection, target):     #评论变化时文章的缓存失效，并更新检索索引
+        cache.invalidate_on_commit(db.object_session(target),
+                                   'post:%s' % target.post_id)
+        state = db.inspect(target)
+        if state.attrs.body.history.has_changes() or \
+                state.attrs.disabled.history.has_changes():
+            if target.disabled:     #被屏蔽的评论搜不到
+                search.remove(connection, 'comment', target.id)
+            else:
+                search.update(connection, 'comment', target.id, '', target.body)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        if not target.disabled:
+            Post.change_comment_count(connection, target.post_id, -1)
+        User.change_counter(connection, target.author_id, 'comments_count', -1)
+        Comment.on_changed(connection, target)
+        search.remove(connection, 'comment', target.id)
 
 db.event.listen(Comment.body, 'set', Comment.on_change_body)
+db.event.listen(Comment, 'after_insert', Comment.on_created)
+db.event.listen(Comment, 'after_update', Comment.on_updated)
+db.event.listen(Comment, 'after_delete', Comment.on_deleted)
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -99,6 +256,10 @@ class Role(db.Model):
             db.session.add(role)
         db.session.commit()
 
+    @staticmethod
+    def on_changed(mapper, connection, target):     #角色变化后重新加载进程内的角色表
+        user_cache.invalidate_roles_on_commit(db.object_session(target))
+
 
 
 class User(UserMixin, db.Model):
@@ -108,6 +269,7 @@ class User(UserMixin, db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     password_hash = db.Column(db.String(128))   #不直接储存密码，而储存密码的哈希值
     email = db.Column(db.String(64), unique=True, index=True)
+    avatar_hash = db.Column(db.String(32), index=True)      #电子邮件的MD5散列值，邮箱变化时重新计算
     name = db.Column(db.String(64))
     location = db.Column(db.String(64))
     about_me = db.Column(db.Text())
@@ -115,6 +277,12 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     confirmed = db.Column(db.Boolean, default=False)
+    # 冗余的计数字段，由关注、发文章、发评论时的数据库事件维护，
+    # 数据不一致时用 manage.py reconcile_counters 重新统计
+    followers_count = db.Column(db.Integer, default=0, index=True)     #粉丝数
+    following_count = db.Column(db.Integer, default=0)     #关注数
+    posts_count = db.Column(db.Integer, default=0)
+    comments_count = db.Column(db.Integer, default=0)
     # 与Follow表中所有follower_id为自己的行关联
     # foreign_keys=[Follow.follower_id]：明确关联外键
     # db.backref('follower', lazy='joined')：创建一个为follower的反向引用
@@ -148,29 +316,50 @@ class User(UserMixin, db.Model):
         raise AttributeError('password is not a readable attribute')
 
     @password.setter
-    def password(self, password):   #设置密码，储存为密码的哈希值
-        self.password_hash = generate_password_hash(password)
+    def password(self, password):   #设置密码，储存为密码的哈希值（在进程池里计算）
+        self.password_hash = passwords.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not passwords.verify(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            # 密码正确而散列的算法或强度已经过时，趁有明文时按当前配置重新计算
+            self.password_hash = passwords.hash(password)
+        return True
 
     def __repr__(self):
         return '<User %r>' % self.username
 
-    def can(self, permissions):     #检查权限
-        return self.role is not None and (self.role.permissions & permissions) == permissions
+    def can(self, permissions):     #检查权限，角色的权限从进程内的角色表读取
+        if self.role_id is not None:
+            role_permissions = user_cache.permissions(self.role_id)
+        else:       #还没写入数据库的新用户
+            role_permissions = self.role.permissions if self.role is not None else None
+        return role_permissions is not None and (role_permissions & permissions) == permissions
 
     def is_administrator(self):     #检查管理员权限
         return self.can(Permission.ADMINISTER)
 
-    def ping(self):     #获取最后登陆时间
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+    def ping(self):     #获取最后登陆时间，先记在内存里，由app/activity.py批量写入
+        activity.record(self)
 
     def generate_confirmation_token(self, expiration=3600):     #设置认证密钥
         s = Serializer(current_app.config['SECRET_KEY'], expiration)
         return s.dumps({'confirm': self.id})
 
+    def generate_auth_token(self, expiration):      #API 用的令牌
+        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
+        return s.dumps({'id': self.id}).decode('ascii')
+
+    @staticmethod
+    def verify_auth_token(token):       #令牌有效时返回用户，用户在缓存有效期内不查询数据库
+        s = Serializer(current_app.config['SECRET_KEY'])
+        try:
+            data = s.loads(token)
+        except:
+            return None
+        return user_cache.load(data['id'])
+
     def confirm(self, token):       #认证检查密钥
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
@@ -205,66 +394,153 @@ class User(UserMixin, db.Model):
         else:
             return True
 
+    @staticmethod
+    def email_hash(email):
+        return hashlib.md5(email.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def on_changed_email(target, value, oldvalue, initiator):
+        target.avatar_hash = User.email_hash(value) if value else None
+
+    @staticmethod
+    def refresh_avatar_hashes():        #给还没有avatar_hash的老用户补上
+        for user in User.query.filter(User.avatar_hash.is_(None),
+                                      User.email.isnot(None)):
+            user.avatar_hash = User.email_hash(user.email)
+            db.session.add(user)
+
     def gravatar(self, size=100, default='identicon', rating='g'):
+        hash = self.avatar_hash or User.email_hash(self.email)
+        if avatars.local:       #FLASKY_AVATAR_SOURCE为local时使用本站生成的头像
+            return avatars.url(hash, size)
         if request.is_secure:
             url = 'https://secure.gravatar.com/avatar'
         else:
             url = 'https://www.gravatar.com/avatar'
-        hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
         return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
             url=url, hash=hash, size=size, default=default, rating=rating
         )
 
+    def to_json(self):
+        return {
+            'id': self.id,
+            'url': url_for('api.get_user', id=self.id, _external=True),
+            'username': self.username,
+            'name': self.name,
+            'location': self.location,
+            'about_me': self.about_me,
+            'avatar_url': self.gravatar(100),
+            'member_since': isoformat(self.member_since),
+            'posts_count': self.posts_count or 0,
+            'followers_count': self.followers_count or 0,
+            'following_count': self.following_count or 0,
+            'posts_url': url_for('api.get_user_posts', id=self.id, _external=True),
+            'followers_url': url_for('api.get_followers', id=self.id, _external=True),
+            'following_url': url_for('api.get_following', id=self.id, _external=True),
+            'timeline_url': url_for('api.get_timeline', id=self.id, _external=True),
+        }
+
     @staticmethod
-    def generate_fake(count=100):       #用forgery_py自动生成大量用户
-        from sqlalchemy.exc import IntegrityError
-        from random import seed
-        import forgery_py
-
-        seed()
-        for i in range(count):
-            u = User(email=forgery_py.internet.email_address(),
-                     username=forgery_py.internet.user_name(True),
-                     password=forgery_py.lorem_ipsum.word(),
-                     confirmed=True,
-                     name=forgery_py.name.full_name(),
-                     location=forgery_py.address.city(),
-                     about_me=forgery_py.lorem_ipsum.sentence(),
-                     member_since=forgery_py.date.date(True))
-            db.session.add(u)
-            try:
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
+    def generate_fake(count=100, seed=None):       #批量生成假用户，见app/fake.py
+        from .fake import Seeder
+        seeder = Seeder(seed)
+        seeder.users(count)
+        seeder.finish()
 
     # 关注用户：先判断是否已关注，如果没关注，给Follow表创建新行
 
-    def follow(self, user):
-        if not self.is_following(user):
-            f = Follow(follower=self, followed=user)
-            db.session.add(f)
+    def follow(self, user):     #返回是否新关注了对方，已经关注时什么也不做
+        # 写之前直接查数据库：follow_graph 的缓存可能还没看到别的进程提交的关注
+        if self.who_i_followed.filter_by(followed_id=user.id).first() is not None:
+            return False
+        f = Follow(follower=self, followed=user)
+        db.session.add(f)
+        timeline.followed(db.session, self, user)     #把对方最近的文章补进自己的时间线
+        return True
 
     # 取消关注：查询自己的who_i_followed中是否有目标用户，如果有，删除。
     def unfollow(self, user):
         f = self.who_i_followed.filter_by(followed_id=user.id).first()
-        if f:
-            db.session.delete(f)
+        if f is None:
+            return False
+        db.session.delete(f)
+        timeline.unfollowed(db.session, self, user)
+        return True
 
-    # 判断是否关注某个用户：用自己的who_i_followed关联到Follow表中关联的记录，记录中所有的follower_id都是
-    # 自己，所以筛选followed_id是否有要查目标，有返回True，没有返回False。
+    # 判断关注关系，批量判断和互相关注等查询见app/follow_graph.py
 
     def is_following(self, user):
-        return self.who_i_followed.filter_by(followed_id=user.id).first() is not None
-
-    # 判断是否被某个用户关注
+        return follow_graph.is_following(self, user)
 
     def is_followed_by(self, user):
-        return self.who_followed_me.filter_by(follower_id=user.id).first() is not None
+        return follow_graph.is_followed_by(self, user)
 
     @property       #联结查询所关注用户的文章，定义成User的属性
     def followed_posts(self):
         return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(Follow.follower_id == self.id)
 
+    # 这些资料显示在文章列表里，修改后要让缓存的文章片段失效
+    profile_attributes = ('username', 'email', 'name', 'location', 'about_me')
+
+    # 这些资料可以被搜索到
+    search_attributes = ('username', 'name', 'about_me')
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        User.index(connection, target)
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        user_cache.invalidate_user_on_commit(db.object_session(target), target.id)
+        state = db.inspect(target)
+        if any(state.attrs[name].history.has_changes()
+               for name in User.profile_attributes):
+            cache.invalidate_on_commit(db.object_session(target),
+                                       'user:%d' % target.id)
+        if any(state.attrs[name].history.has_changes()
+               for name in User.search_attributes):
+            User.index(connection, target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        search.remove(connection, 'user', target.id)
+
+    @staticmethod
+    def index(connection, target):
+        search.update(connection, 'user', target.id,
+                      ' '.join(filter(None, (target.username, target.name))),
+                      target.about_me)
+
+    @staticmethod
+    def change_counter(connection, user_id, name, delta):
+        if user_id is None:
+            return
+        users = User.__table__
+        column = users.c[name]
+        connection.execute(users.update().where(users.c.id == user_id).values(
+            {column: db.func.coalesce(column, 0) + delta}))
+
+    @staticmethod
+    def change_counters(connection, name, deltas):     #{user_id: 变化量}，一次executemany
+        deltas = [{'user_id': k, 'delta': v} for k, v in deltas.items()
+                  if k is not None and v]
+        if not deltas:
+            return
+        users = User.__table__
+        column = users.c[name]
+        connection.execute(users.update().where(users.c.id == db.bindparam('user_id'))
+                           .values({column: db.func.coalesce(column, 0)
+                                    + db.bindparam('delta')}), deltas)
+
+    @staticmethod
+    def refresh_counters():     #按关联表批量重新统计所有用户的计数字段
+        follows = Follow.__table__
+        refresh_count_columns(User.__table__, {
+            'followers_count': group_count(follows.c.followed_id),
+            'following_count': group_count(follows.c.follower_id),
+            'posts_count': group_count(Post.__table__.c.author_id),
+            'comments_count': group_count(Comment.__table__.c.author_id)})
+
 
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
@@ -275,8 +551,8 @@ class AnonymousUser(AnonymousUserMixin):
 
 login_manager.anonymous_user = AnonymousUser
 @login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def load_user(user_id):     #在缓存有效期内不查询数据库，见app/usercache.py
+    return user_cache.load(int(user_id))
 
 class Post(db.Model):
     __tablename__ = 'posts'
@@ -285,32 +561,153 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     body_html = db.Column(db.Text)      #存储转换后的HTML数据
+    comment_count = db.Column(db.Integer, default=0)     #可见（未屏蔽）的评论数，由Comment模型维护
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
-    @staticmethod
-    def generate_fake(count=100):       #用forgery_py生成文章
-        from random import seed, randint
-        import forgery_py
+    def to_json(self):      #只含作者的 id 和地址，列表里不用加载作者
+        return {
+            'id': self.id,
+            'url': url_for('api.get_post', id=self.id, _external=True),
+            'body': self.body,
+            'body_html': self.body_html,
+            'timestamp': isoformat(self.timestamp),
+            'author_id': self.author_id,
+            'author_url': url_for('api.get_user', id=self.author_id, _external=True),
+            'comment_count': self.comment_count or 0,
+            'comments_url': url_for('api.get_post_comments', id=self.id, _external=True),
+        }
 
-        seed()
-        user_count = User.query.count()
-        for i in range(count):
-            u = User.query.offset(randint(0, user_count - 1)).first()
-            p = Post(body=forgery_py.lorem_ipsum.sentences(randint(1, 3)),
-                     timestamp=forgery_py.date.date(True),
-                     author=u)
-            db.session.add(p)
-            db.session.commit()
+    @staticmethod
+    def generate_fake(count=100, seed=None):       #批量生成假文章，作者按幂律分布，见app/fake.py
+        from .fake import Seeder
+        seeder = Seeder(seed)
+        seeder.posts(count)
+        seeder.finish()
 
-    @staticmethod           #用静态方法来把文章原始数据转换成HTML
+    @staticmethod           #用静态方法来把文章原始数据转换成HTML，允许的标签见app/rendering.py
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True
-        ))
+        renderer.render_body(target, value, 'post')
+
+    @staticmethod
+    def change_comment_count(connection, post_id, delta):
+        if post_id is None:
+            return
+        posts = Post.__table__
+        connection.execute(posts.update().where(posts.c.id == post_id).values(
+            comment_count=db.func.coalesce(posts.c.comment_count, 0) + delta))
+
+    @staticmethod
+    def change_comment_counts(connection, deltas):     #{post_id: 变化量}，一次executemany
+        deltas = [{'post_id': k, 'delta': v} for k, v in deltas.items()
+                  if k is not None and v]
+        if not deltas:
+            return
+        posts = Post.__table__
+        connection.execute(posts.update().where(posts.c.id == db.bindparam('post_id'))
+                           .values(comment_count=db.func.coalesce(posts.c.comment_count, 0)
+                                   + db.bindparam('delta')), deltas)
+
+    @staticmethod
+    def recount_comments(connection, post_id):
+        if post_id is None:
+            return
+        posts = Post.__table__
+        comments = Comment.__table__
+        count = db.select([db.func.count()]).where(
+            (comments.c.post_id == post_id) & comments.c.disabled.isnot(True))
+        connection.execute(posts.update().where(posts.c.id == post_id)
+                           .values(comment_count=count.as_scalar()))
+
+    @staticmethod
+    def refresh_comment_counts():       #按comments表重新统计所有文章的可见评论数
+        comments = Comment.__table__
+        refresh_count_columns(Post.__table__, {
+            'comment_count': group_count(comments.c.post_id,
+                                         comments.c.disabled.isnot(True))})
+
+    @staticmethod           #新文章写入关注者的时间线，并更新作者的文章数
+    def on_created(mapper, connection, target):
+        User.change_counter(connection, target.author_id, 'posts_count', 1)
+        timeline.post_created(connection, target)
+        Post.on_updated(mapper, connection, target)
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        cache.invalidate_on_commit(db.object_session(target),
+                                   'post:%d' % target.id)
+        if db.inspect(target).attrs.body.history.has_changes():
+            search.update(connection, 'post', target.id, '', target.body)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        User.change_counter(connection, target.author_id, 'posts_count', -1)
+        timeline.post_deleted(connection, target)
+        Post.on_updated(mapper, connection, target)
+        search.remove(connection, 'post', target.id)
+
+class Photo(db.Model):
+    # 上传的图片，文件按 sha256 存在 PHOTO_STORAGE_ROOT 下（见 app/photo/storage.py），
+    # 内容相同的多次上传共用一个文件
+    __tablename__ = 'photos'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
+    content_type = db.Column(db.String(64))
+    filename = db.Column(db.String(128))        #用户上传时的文件名
+    uploader_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'sha256': self.sha256,
+            'size': self.size,
+            'content_type': self.content_type,
+            'filename': self.filename,
+            'url': url_for('photo.uploaded_file', filename=self.sha256),
+        }
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)     #数据库环境监听，调用上边的静态方法
+db.event.listen(Post, 'after_insert', Post.on_created)
+db.event.listen(Post, 'after_update', Post.on_updated)
+db.event.listen(Post, 'after_delete', Post.on_deleted)
+db.event.listen(User, 'after_insert', User.on_created)
+db.event.listen(User, 'after_update', User.on_updated)
+db.event.listen(User, 'after_delete', User.on_deleted)
+db.event.listen(User.email, 'set', User.on_changed_email)
+db.event.listen(Role, 'after_insert', Role.on_changed)
+db.event.listen(Role, 'after_update', Role.on_changed)
+db.event.listen(Role, 'after_delete', Role.on_changed)
+db.event.listen(Follow, 'after_insert', Follow.on_created)
+db.event.listen(Follow, 'after_delete', Follow.on_deleted)
+# 全文检索的倒排表，FLASKY_SEARCH_BACKEND 为 'table' 时使用（见 app/search.py）
+search_documents = db.Table(
+    'search_documents',
+    db.Column('kind', db.SmallInteger, primary_key=True),
+    db.Column('ref', db.Integer, primary_key=True),
+    db.Column('length', db.Integer))
+search_terms = db.Table(
+    'search_terms',
+    db.Column('term', db.String(64), primary_key=True),
+    db.Column('kind', db.SmallInteger, primary_key=True),
+    db.Column('ref', db.Integer, primary_key=True),
+    db.Column('tf', db.Integer),
+    db.Index('ix_search_terms_kind_ref', 'kind', 'ref'))
+# SQLite 上默认用 FTS5 虚拟表，随其他表一起创建和删除
+db.event.listen(db.metadata, 'after_create', db.DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(title, body)'
+).execute_if(dialect='sqlite'))
+db.event.listen(db.metadata, 'before_drop', db.DDL(
+    'DROP TABLE IF EXISTS search_fts').execute_if(dialect='sqlite'))
+# 异步渲染模式下，提交之后再把文章和评论交给后台线程渲染
+db.event.listen(db.session, 'after_flush', renderer.after_flush)
+db.event.listen(db.session, 'after_commit', renderer.after_commit)
+db.event.listen(db.session, 'after_rollback', renderer.after_rollback)
+# 提交之后才让相关缓存失效
+db.event.listen(db.session, 'after_commit', cache.after_commit)
+db.event.listen(db.session, 'after_rollback', cache.after_rollback)
+db.event.listen(db.session, 'after_commit', user_cache.after_commit)
+db.event.listen(db.session, 'after_rollback', user_cache.after_rollback)
+db.event.listen(db.session, 'after_commit', follow_graph.after_commit)
+db.event.listen(db.session, 'after_rollback', follow_graph.after_rollback)
 
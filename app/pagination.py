@@ -0,0 +1,213 @@
+# coding: utf-8
+# 游标（keyset）分页：按 (timestamp, id) 之类的排序键定位下一页，
+# 避免 OFFSET 扫描和每次请求都要做的 COUNT(*)。
+import base64
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import and_, or_
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """把排序键的值编码成不透明的游标字符串。"""
+    items = []
+    for value in values:
+        if isinstance(value, datetime):
+            items.append(['d', value.strftime(_DATETIME_FORMAT)])
+        else:
+            items.append(['v', value])
+    raw = json.dumps(items, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, arity=None):
+    """解析游标，格式不对时返回 None。
+
+    游标来自客户端，只接受 arity 个（给出时）标量值，否则拼查询条件时会出错。
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        items = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        if not isinstance(items, list) or not items or \
+                (arity is not None and len(items) != arity):
+            return None
+        values = []
+        for kind, value in items:
+            if kind == 'd':
+                value = datetime.strptime(value, _DATETIME_FORMAT)
+            elif kind != 'v' or isinstance(value, bool) or \
+                    not isinstance(value, (str, int, float)):
+                return None
+            values.append(value)
+        return tuple(values)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def _seek_condition(columns, values, descending):
+    # 生成 (c1, c2) < (v1, v2) 形式的条件，展开成 OR/AND 以兼容 SQLite
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        if descending:
+            equal.append(column < values[i])
+        else:
+            equal.append(column > values[i])
+        clauses.append(and_(*equal))
+    return or_(*clauses)
+
+
+class KeysetPagination(object):
+    """一页游标分页的结果，接口与 flask_sqlalchemy 的 Pagination 相近。"""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None,
+                 total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, columns, after=None, before=None, per_page=20,
+                    descending=True, key=None, total=None):
+    """按 columns 排序做游标分页。
+
+    after / before 是上一页给出的 next_cursor / prev_cursor。
+    key 用来从每一行取出排序键的值，默认按列名从行对象上取属性。
+    """
+    if key is None:
+        names = [column.key for column in columns]
+
+        def key(row):
+            return tuple(getattr(row, name) for name in names)
+
+    after = decode_cursor(after, len(columns))
+    before = decode_cursor(before, len(columns)) if after is None else None
+    backwards = before is not None
+    if backwards:
+        query = query.filter(_seek_condition(columns, before, not descending))
+    elif after is not None:
+        query = query.filter(_seek_condition(columns, after, descending))
+    if descending != backwards:
+        order = [column.desc() for column in columns]
+    else:
+        order = [column.asc() for column in columns]
+    rows = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    next_cursor = prev_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = encode_cursor(key(rows[-1]))
+        if (more and backwards) or after is not None:
+            prev_cursor = encode_cursor(key(rows[0]))
+    elif backwards:
+        next_cursor = encode_cursor(before)
+    return KeysetPagination(rows, per_page, next_cursor=next_cursor,
+                            prev_cursor=prev_cursor, total=total)
+
+
+def keyset_tail(query, columns, until=None, per_page=20, key=None, total=None):
+    """按 columns 升序排列时，结尾是 until 这一行（含）的一页；until 为 None 时是最后一页。
+
+    倒着取 per_page + 1 行再反转，不用 COUNT 也不用 OFFSET。返回的游标可以接着交给
+    keyset_paginate(..., descending=False) 前后翻页。
+    """
+    if key is None:
+        names = [column.key for column in columns]
+
+        def key(row):
+            return tuple(getattr(row, name) for name in names)
+
+    if until is not None and len(until) != len(columns):
+        until = None
+    seek = query
+    if until is not None:
+        seek = query.filter(or_(_seek_condition(columns, until, True),
+                                and_(*[c == v for c, v in zip(columns, until)])))
+    rows = seek.order_by(None).order_by(*[c.desc() for c in columns]) \
+        .limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    rows.reverse()
+    next_cursor = prev_cursor = None
+    if rows:
+        if more:
+            prev_cursor = encode_cursor(key(rows[0]))
+        if until is not None:
+            later = query.filter(_seek_condition(columns, until, False))
+            if query.session.query(later.order_by(None).exists()).scalar():
+                next_cursor = encode_cursor(key(rows[-1]))
+    return KeysetPagination(rows, per_page, next_cursor=next_cursor,
+                            prev_cursor=prev_cursor, total=total)
+
+
+class CountCache(object):
+    """缓存列表的大致总数，过期前不重复执行 COUNT(*)。
+
+    每个用户的时间线各有一个名字，所以最多保留 max_size 个，超出时先丢过期的，
+    再丢最久没用过的。
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._counts = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, name, query, ttl=60):
+        now = time.time()
+        with self._lock:
+            cached = self._counts.get(name)
+            if cached is not None:
+                if cached[1] > now:
+                    self._counts.move_to_end(name)
+                    return cached[0]
+                del self._counts[name]
+        count = query.order_by(None).count()
+        with self._lock:
+            self._counts[name] = (count, now + ttl)
+            self._counts.move_to_end(name)
+            if len(self._counts) > self.max_size:
+                for key in [k for k, (c, expires) in self._counts.items() if expires <= now]:
+                    del self._counts[key]
+                while len(self._counts) > self.max_size:
+                    self._counts.popitem(last=False)
+        return count
+
+    def __len__(self):
+        return len(self._counts)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+count_cache = CountCache()
+
+
+def approximate_count(name, query, ttl=None):
+    """返回缓存的总数；ttl 为 0 时关闭总数统计。"""
+    from flask import current_app
+    if ttl is None:
+        ttl = current_app.config.get('FLASKY_PAGINATION_COUNT_TTL', 0)
+    if not ttl:
+        return None
+    return count_cache.get(name, query, ttl)
@@ -0,0 +1,123 @@
+# coding: utf-8
+# 密码散列服务：散列放到进程池里算，不占请求线程的 GIL；同时进行的散列数量有上限，
+# 登录高峰时多出来的请求等一会儿，等不到就返回 503，其他页面不受影响。
+# 算法和强度由 FLASKY_PASSWORD_METHOD 配置，登录成功时旧强度的散列会自动升级。
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+
+
+class PasswordHashingBusy(Exception):
+    """等了 FLASKY_PASSWORD_TIMEOUT 秒还没轮到，交给调用者返回 503。"""
+
+
+# 在工作进程里执行，必须是模块级函数
+
+def hash_password(password, method, salt_length):
+    return generate_password_hash(password, method, salt_length)
+
+
+def check_password(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def normalize_method(method):
+    """'pbkdf2:sha256' 补上默认的迭代次数，方便和已存散列的前缀比较。"""
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return '%s:%d' % (method, DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+class PasswordHasher(object):
+    def __init__(self, method='pbkdf2:sha256', salt_length=8, workers=0,
+                 concurrency=None, timeout=10):
+        self.method = normalize_method(method)
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency or workers or 2)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHashingBusy()
+        try:
+            if not self.workers:
+                return fn(*args)
+            try:
+                return self.executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # 工作进程被杀掉了：换一个新的进程池，这一次在本进程里算
+                with self._lock:
+                    self._executor = None
+                return fn(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """散列的算法或强度和当前配置不同。"""
+        return pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class Passwords(object):
+    """扩展：passwords.init_app(app)，User 的 password 和 verify_password 通过它计算。
+
+    FLASKY_PASSWORD_WORKERS 为 0 时在请求线程里计算，但仍然受并发上限限制。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PASSWORD_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('FLASKY_PASSWORD_SALT_LENGTH', 8)
+        app.config.setdefault('FLASKY_PASSWORD_WORKERS', 0)
+        app.config.setdefault('FLASKY_PASSWORD_CONCURRENCY', None)
+        app.config.setdefault('FLASKY_PASSWORD_TIMEOUT', 10)
+        app.extensions['passwords'] = PasswordHasher(
+            method=app.config['FLASKY_PASSWORD_METHOD'],
+            salt_length=app.config['FLASKY_PASSWORD_SALT_LENGTH'],
+            workers=app.config['FLASKY_PASSWORD_WORKERS'],
+            concurrency=app.config['FLASKY_PASSWORD_CONCURRENCY'],
+            timeout=app.config['FLASKY_PASSWORD_TIMEOUT'])
+
+    @property
+    def hasher(self):
+        return current_app.extensions['passwords']
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, pwhash, password):
+        return self.hasher.verify(pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return self.hasher.needs_rehash(pwhash)
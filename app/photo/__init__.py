@@ -1,5 +1,15 @@
 from flask import Blueprint
+from .storage import Storage
+from .variants import Variants
 
 photo = Blueprint('photo', __name__)
+storage = Storage()
+variants = Variants()
 
-from . import views
\ No newline at end of file
+
+@photo.record_once
+def init_storage(state):
+    storage.init_app(state.app)
+    variants.init_app(state.app)
+
+from . import views
@@ -0,0 +1,273 @@
+# coding: utf-8
+# 图片存储：上传的数据按块写入临时文件并同时计算 SHA-256，
+# 完成后按内容哈希放进分层目录（objects/ab/cd/<哈希>），相同内容只存一份。
+# 大文件可以分块续传：每个上传会话对应 uploads/ 下的一个 .part 文件，
+# 写入和完成时对 .part 加文件锁，同一个会话同时只有一个请求在写。
+import errno
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:     # Windows 上没有 fcntl，不加锁
+    fcntl = None
+
+# 文件头 -> 类型。响应的 Content-Type 只从这里来，不信客户端声明的类型，
+# 否则声明成 text/html 的“图片”会被浏览器当网页执行
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+_digest_re = re.compile(r'^[0-9a-f]{64}$')
+_upload_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+class UploadBusy(UploadError):
+    """另一个请求正在写这个上传会话。"""
+
+
+class OffsetMismatch(UploadError):
+    """续传的起始位置和服务器上已有的数据长度不一致。"""
+
+    def __init__(self, offset):
+        UploadError.__init__(self, 'upload is at offset %d' % offset)
+        self.offset = offset
+
+
+class PhotoStorage(object):
+    def __init__(self, root, chunk_size=64 * 1024, max_size=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+    def _dir(self, *parts):
+        path = os.path.join(self.root, *parts)
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def valid_digest(digest):
+        return bool(digest and _digest_re.match(digest))
+
+    def path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return self.valid_digest(digest) and os.path.exists(self.path(digest))
+
+    def content_type(self, digest):
+        """按文件头判断的图片类型，不是支持的图片格式时返回 None。"""
+        try:
+            with open(self.path(digest), 'rb') as f:
+                head = f.read(8)
+        except (IOError, OSError):
+            return None
+        for signature, mimetype in IMAGE_SIGNATURES:
+            if head.startswith(signature):
+                return mimetype
+        return None
+
+    def remove(self, digest):
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _copy(self, stream, f, hasher=None, limit=None, start=0):
+        """按块从 stream 复制到 f，返回复制的字节数。
+
+        start 是 f 里已有的字节数，总长度超过 limit 时抛出 UploadTooLarge。
+        """
+        size = start
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                return size - start
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise UploadTooLarge('upload exceeds %d bytes' % limit)
+            if hasher is not None:
+                hasher.update(chunk)
+            f.write(chunk)
+
+    def _commit(self, tmp, digest):
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(tmp)      # 内容相同的文件只存一份
+        else:
+            self._dir('objects', digest[:2], digest[2:4])
+            os.rename(tmp, path)
+        return digest
+
+    def save(self, stream):
+        """保存一个完整的文件流，返回 (哈希, 大小)。"""
+        fd, tmp = tempfile.mkstemp(dir=self._dir('tmp'))
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = self._copy(stream, f, hasher, self.max_size)
+            return self._commit(tmp, hasher.hexdigest()), size
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # 分块续传 ------------------------------------------------------------
+
+    def _upload_path(self, upload_id, ext):
+        if not upload_id or not _upload_id_re.match(upload_id):
+            return None
+        return os.path.join(self.root, 'uploads', upload_id + ext)
+
+    def start_upload(self, **info):
+        """创建上传会话，info 里是文件名、类型、总大小等，完成时原样返回。"""
+        size = info.get('size')
+        if size is not None and self.max_size is not None and size > self.max_size:
+            raise UploadTooLarge('upload exceeds %d bytes' % self.max_size)
+        upload_id = uuid.uuid4().hex
+        self._dir('uploads')
+        open(self._upload_path(upload_id, '.part'), 'wb').close()
+        with open(self._upload_path(upload_id, '.json'), 'w') as f:
+            json.dump(info, f)
+        return upload_id
+
+    def upload_info(self, upload_id):
+        """返回会话信息和已经收到的字节数（offset），会话不存在时返回 None。"""
+        path = self._upload_path(upload_id, '.json')
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                info = json.load(f)
+            info['offset'] = os.path.getsize(self._upload_path(upload_id, '.part'))
+        except (IOError, OSError, ValueError):
+            return None
+        return info
+
+    @contextmanager
+    def _locked(self, upload_id):
+        """打开并锁住会话的 .part 文件，别的请求正在写时抛出 UploadBusy。
+
+        会话不存在（已经完成或取消）时抛出 KeyError，不会重新创建 .part。
+        """
+        path = self._upload_path(upload_id, '.part')
+        try:
+            f = open(path, 'r+b')
+        except (IOError, OSError, TypeError):
+            raise KeyError(upload_id)
+        with f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    raise UploadBusy('upload %s is being written' % upload_id)
+            if not os.path.exists(path):    # 等锁的时候被别的请求完成了
+                raise KeyError(upload_id)
+            yield f
+
+    def _declared_size(self, upload_id):
+        info = self.upload_info(upload_id)
+        size = info.get('size') if info is not None else None
+        if size is None:
+            return self.max_size
+        return size if self.max_size is None else min(size, self.max_size)
+
+    def append(self, upload_id, offset, stream):
+        """从 offset 开始追加一块数据，返回追加之后的长度。
+
+        总长度不能超过开始上传时声明的 size（没声明时是 max_size）。
+        """
+        limit = self._declared_size(upload_id)
+        with self._locked(upload_id) as f:
+            f.seek(0, os.SEEK_END)
+            current = f.tell()
+            if current != offset:
+                raise OffsetMismatch(current)
+            self._copy(stream, f, limit=limit, start=offset)
+            return f.tell()
+
+    def finish_upload(self, upload_id):
+        """数据收齐后计算哈希并放进存储，返回 (哈希, 大小)。"""
+        path = self._upload_path(upload_id, '.part')
+        hasher = hashlib.sha256()
+        size = 0
+        with self._locked(upload_id) as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                hasher.update(chunk)
+            digest = self._commit(path, hasher.hexdigest())
+            os.remove(self._upload_path(upload_id, '.json'))
+        return digest, size
+
+    def cancel_upload(self, upload_id):
+        for ext in ('.part', '.json'):
+            path = self._upload_path(upload_id, ext)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def remove_stale_uploads(self, max_age):
+        """删除超过 max_age 秒没有动静的上传会话，返回删除的文件数。"""
+        horizon = time.time() - max_age
+        removed = 0
+        for directory in ('uploads', 'tmp'):
+            directory = self._dir(directory)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < horizon:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+class Storage(object):
+    """扩展：storage.init_app(app)，在注册 photo 蓝本时调用。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PHOTO_STORAGE_ROOT',
+                              os.path.join(app.instance_path, 'photos'))
+        app.config.setdefault('PHOTO_UPLOAD_TTL', 24 * 3600)
+        app.config.setdefault('PHOTO_CACHE_MAX_AGE', 365 * 24 * 3600)
+        app.config.setdefault('PHOTO_FALLBACK_MAX_AGE', 60)
+        app.config.setdefault('PHOTO_SENDFILE', None)
+        app.config.setdefault('PHOTO_ACCEL_PREFIX', '/_photos/')
+        app.config.setdefault('PHOTO_CHUNK_SIZE', 64 * 1024)
+        app.config.setdefault('PHOTO_MAX_SIZE', 64 * 1024 * 1024)
+        app.extensions['photo_storage'] = PhotoStorage(
+            app.config['PHOTO_STORAGE_ROOT'],
+            chunk_size=app.config['PHOTO_CHUNK_SIZE'],
+            max_size=app.config['PHOTO_MAX_SIZE'])
+
+    @property
+    def backend(self):
+        return current_app.extensions['photo_storage']
@@ -0,0 +1,156 @@
+# coding: utf-8
+# 图片的缩略图和不同宽度的版本：上传完成后交给进程池生成，结果存在
+# PHOTO_STORAGE_ROOT/variants 下，请求时按需要的宽度挑最合适的一张。
+# 没装 Pillow 时不生成任何版本，一律返回原图。
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+try:
+    from PIL import Image
+except ImportError:     # pragma: no cover
+    Image = None
+
+FORMATS = {'jpeg': 'jpg', 'webp': 'webp', 'png': 'png'}
+
+
+def variant_path(root, digest, width, fmt='jpeg'):
+    return os.path.join(root, 'variants', digest[:2], digest[2:4],
+                        '%s-%d.%s' % (digest, width, FORMATS[fmt]))
+
+
+def make_variants(source, root, digest, widths, fmt='jpeg', quality=85):
+    """在工作进程里执行：解码一次原图，从大到小依次缩放，返回生成的宽度。"""
+    if Image is None:
+        return []
+    try:
+        image = Image.open(source)
+    except (IOError, OSError):
+        return []       # 不是 Pillow 能识别的图片，只保留原图
+    widths = sorted((w for w in widths if w < image.width), reverse=True)
+    if not widths:
+        return []
+    # JPEG 可以直接按缩小的尺寸解码，省掉大部分解码时间
+    image.draft('RGB', (widths[0], image.height * widths[0] // image.width))
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    done = []
+    for width in widths:
+        height = max(1, image.height * width // image.width)
+        # 每一级都从上一级缩出来，比每次从原图缩快得多
+        image = image.resize((width, height), Image.LANCZOS)
+        path = variant_path(root, digest, width, fmt)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, fmt.upper(), quality=quality, optimize=True)
+        os.rename(tmp, path)
+        done.append(width)
+    return done
+
+
+class VariantPipeline(object):
+    def __init__(self, root, widths, fmt='jpeg', quality=85, workers=None):
+        self.root = root
+        self.widths = sorted(widths)
+        self.fmt = fmt
+        self.quality = quality
+        self.workers = workers
+        self._executor = None
+        self._pending = {}      # digest -> Future
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return Image is not None and bool(self.widths)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def schedule(self, source, digest):
+        """把生成任务交给进程池，立即返回 Future；同一张图不会重复排队。"""
+        if not self.enabled:
+            return None
+        executor = self.executor
+        with self._lock:
+            future = self._pending.get(digest)
+            if future is not None:
+                return future
+            future = self._pending[digest] = executor.submit(
+                make_variants, source, self.root, digest,
+                self.widths, self.fmt, self.quality)
+        future.add_done_callback(lambda f: self._done(digest))
+        return future
+
+    def _done(self, digest):
+        with self._lock:
+            self._pending.pop(digest, None)
+
+    @property
+    def pending(self):
+        """还在等缩略图的图片数。"""
+        return len(self._pending)
+
+    def choose(self, width):
+        """不小于 width 的最小版本宽度，比所有版本都大时返回 None（用原图）。"""
+        for w in self.widths:
+            if w >= width:
+                return w
+        return None
+
+    def find(self, digest, width):
+        """返回宽度合适且已经生成的版本文件，找不到时返回 None。"""
+        w = self.choose(width)
+        if w is None:
+            return None
+        path = variant_path(self.root, digest, w, self.fmt)
+        # 还没生成好，或者原图本来就比这个宽度窄，都直接用原图
+        return path if os.path.exists(path) else None
+
+    def mimetype(self):
+        return 'image/' + self.fmt
+
+    def join(self):
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class Variants(object):
+    """扩展：variants.init_app(app)，在注册 photo 蓝本时调用。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PHOTO_VARIANT_WIDTHS', (160, 320, 640, 1280))
+        app.config.setdefault('PHOTO_VARIANT_FORMAT', 'jpeg')
+        app.config.setdefault('PHOTO_VARIANT_QUALITY', 85)
+        app.config.setdefault('PHOTO_VARIANT_WORKERS', None)
+        app.extensions['photo_variants'] = VariantPipeline(
+            app.config['PHOTO_STORAGE_ROOT'],
+            app.config['PHOTO_VARIANT_WIDTHS'],
+            fmt=app.config['PHOTO_VARIANT_FORMAT'],
+            quality=app.config['PHOTO_VARIANT_QUALITY'],
+            workers=app.config['PHOTO_VARIANT_WORKERS'])
+
+    @property
+    def pipeline(self):
+        return current_app.extensions['photo_variants']
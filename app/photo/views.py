@@ -1,28 +1,194 @@
-from flask import render_template, request, url_for, send_from_directory, current_app, flash
+from flask import render_template, request, url_for, send_file, current_app, flash, \
+    abort, jsonify
+from flask_login import current_user
 from werkzeug.utils import secure_filename
-from . import photo
+from . import photo, storage, variants
+from .storage import UploadTooLarge, UploadBusy, OffsetMismatch
+from .. import db, metrics
+from ..models import Photo
 
 import os
+import re
 
-ALLOWED_EXTENSIONS = set(['png', 'ipg', 'jpeg', 'gif'])
+ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+_content_range_re = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def save_photo(digest, size, filename):
+    """文件已经放进存储之后，记录一条 Photo；不是图片时删掉文件并返回 None。
+
+    类型按文件头判断，同一个哈希的所有记录类型都一样，不用客户端声明的类型。
+    """
+    content_type = storage.backend.content_type(digest)
+    if content_type is None:
+        if Photo.query.filter_by(sha256=digest).first() is None:
+            storage.backend.remove(digest)
+        return None
+    photo = Photo(sha256=digest, size=size, filename=secure_filename(filename),
+                  content_type=content_type,
+                  uploader_id=current_user.id if current_user.is_authenticated else None)
+    db.session.add(photo)
+    db.session.commit()
+    metrics.inc('flasky_uploads_total')
+    # 缩略图在进程池里生成，不占用当前请求
+    variants.pipeline.schedule(storage.backend.path(digest), digest)
+    return photo
+
+def send_photo(path, etag, mimetype=None, max_age=None):
+    """发送存储里的文件。内容按哈希存放、永远不变，所以哈希就是强 ETag。
+
+    PHOTO_SENDFILE 为 'x-sendfile' 或 'x-accel-redirect' 时只返回响应头，
+    由前端的 Web 服务器发送文件并处理 Range 请求。
+    """
+    config = current_app.config
+    if max_age is None:
+        max_age = config['PHOTO_CACHE_MAX_AGE']
+    mode = config.get('PHOTO_SENDFILE')
+    if mode == 'x-accel-redirect':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = config['PHOTO_ACCEL_PREFIX'] + \
+            os.path.relpath(path, storage.backend.root).replace(os.sep, '/')
+    elif mode == 'x-sendfile':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_file(path, mimetype=mimetype, add_etags=False,
+                             conditional=False, cache_timeout=max_age)
+    set_cache_headers(response, etag, max_age)
+    # 浏览器只按 Content-Type 处理，不自己猜内容是不是 HTML
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if mode:
+        return response
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=os.path.getsize(path))
+
+def set_cache_headers(response, etag, max_age):
+    response.set_etag(etag)
+    # immutable：浏览器刷新页面时也不再来验证（werkzeug 的 cache_control 还不支持这个指令）
+    immutable = max_age >= current_app.config['PHOTO_CACHE_MAX_AGE']
+    response.headers['Cache-Control'] = 'public, max-age=%d%s' % (
+        max_age, ', immutable' if immutable else '')
+
+def not_modified(etag, max_age):
+    response = current_app.response_class(status=304)
+    set_cache_headers(response, etag, max_age)
+    return response
 
 @photo.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(current_app.config.get('UPLOAD_FOLDER'), filename)
+    if not storage.backend.exists(filename):
+        abort(404)
+    max_age = current_app.config['PHOTO_CACHE_MAX_AGE']
+    width = request.args.get('w', type=int)
+    if width:
+        path = variants.pipeline.find(filename, width)
+        if path is not None:
+            etag = os.path.basename(path)
+            if etag in request.if_none_match:
+                return not_modified(etag, max_age)
+            return send_photo(path, etag, variants.pipeline.mimetype())
+        # 缩略图还没生成好，先给原图，但不能让浏览器永久缓存这个地址
+        max_age = current_app.config['PHOTO_FALLBACK_MAX_AGE']
+    # 浏览器带着 ETag 来问时不用查数据库、也不用打开文件
+    if filename in request.if_none_match:
+        return not_modified(filename, max_age)
+    # 类型按文件内容判断，以前按客户端声明存下的记录不可信
+    mimetype = storage.backend.content_type(filename)
+    if mimetype is None:
+        abort(404)
+    return send_photo(storage.backend.path(filename), filename, mimetype, max_age)
 
 @photo.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
-        file = request.files['file']
+        file = request.files.get('file')
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(current_app.config.get('UPLOAD_FOLDER'), filename))
-            file_url = url_for('photo.uploaded_file', filename=filename)
-            flash('You have upload a photo!')
-            return render_template('photo/photowall.html')
-        else:
-            flash("This file can't upload!")
-    return render_template('photo/photowall.html')
\ No newline at end of file
+            # 表单里的文件由 werkzeug 暂存，这里按块复制进存储，不整个读进内存
+            try:
+                digest, size = storage.backend.save(file.stream)
+            except UploadTooLarge:
+                abort(413)
+            metrics.inc('flasky_upload_bytes_total', size, mode='form')
+            photo = save_photo(digest, size, file.filename)
+            if photo is not None:
+                flash('You have upload a photo!')
+                return render_template('photo/photowall.html', photo=photo)
+        flash("This file can't upload!")
+    return render_template('photo/photowall.html')
+
+# 分块续传：
+#   POST /photo/resumable             filename、size，返回 upload_id
+#   PUT  /photo/resumable/<upload_id> 请求体是一块数据，Content-Range 指明位置
+#   GET  /photo/resumable/<upload_id> 查询已经收到多少字节，断线后从这里继续
+# 收齐 size 字节后自动完成，返回 201 和图片信息。
+
+@photo.route('/resumable', methods=['POST'])
+def start_upload():
+    params = request.get_json(silent=True) or request.form
+    filename = params.get('filename', '')
+    if not allowed_file(filename):
+        abort(400)
+    try:
+        size = int(params['size'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    try:
+        upload_id = storage.backend.start_upload(filename=filename, size=size)
+    except UploadTooLarge:
+        abort(413)
+    url = url_for('photo.resume_upload', upload_id=upload_id)
+    response = jsonify({'upload_id': upload_id, 'offset': 0, 'url': url})
+    response.status_code = 201
+    response.headers['Location'] = url
+    return response
+
+def _conflict(upload_id, offset):
+    response = jsonify({'upload_id': upload_id, 'offset': offset})
+    response.status_code = 409
+    return response
+
+@photo.route('/resumable/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def resume_upload(upload_id):
+    info = storage.backend.upload_info(upload_id)
+    if info is None:
+        abort(404)
+    if request.method == 'GET':
+        return jsonify({'upload_id': upload_id, 'offset': info['offset'],
+                        'size': info['size']})
+    if request.method == 'DELETE':
+        storage.backend.cancel_upload(upload_id)
+        return '', 204
+    offset = 0
+    content_range = request.headers.get('Content-Range')
+    if content_range:
+        match = _content_range_re.match(content_range)
+        if match is None:
+            abort(400)
+        offset = int(match.group(1))
+    try:
+        received = storage.backend.append(upload_id, offset, request.stream)
+        metrics.inc('flasky_upload_bytes_total', received - offset, mode='resumable')
+        if received < info['size']:
+            return jsonify({'upload_id': upload_id, 'offset': received,
+                            'size': info['size']})
+        digest, size = storage.backend.finish_upload(upload_id)
+    except OffsetMismatch as e:
+        return _conflict(upload_id, e.offset)
+    except UploadBusy:
+        # 同一个会话的另一个 PUT 还没写完，客户端稍后用 GET 查询位置再续传
+        return _conflict(upload_id, None)
+    except UploadTooLarge:
+        storage.backend.cancel_upload(upload_id)
+        abort(413)
+    except KeyError:
+        abort(404)
+    photo = save_photo(digest, size, info['filename'])
+    if photo is None:
+        abort(415)
+    response = jsonify(photo.to_json())
+    response.status_code = 201
+    response.headers['Location'] = url_for('photo.uploaded_file', filename=digest)
+    return response
@@ -0,0 +1,285 @@
+# coding: utf-8
+# 按请求的性能剖析（FLASKY_PROFILE 打开时才启用）：记录 SQL 条数和耗时、重复执行的语句
+# （N+1 查询的特征）、模板渲染时间和本线程的 CPU 时间。结果写进 Server-Timing 响应头和
+# 一行 JSON 日志，并按 endpoint 汇总，管理员在 /debug/profile 查看最慢的页面。
+# QueryCounter 不依赖请求，测试和 benchmarks 用它统计一段代码执行的 SQL。
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, g, request, has_request_context, \
+    before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('flasky.profile')
+
+_space_re = re.compile(r'\s+')
+_in_list_re = re.compile(r'\bIN \((?:\?|%s|:\w+)(?:, (?:\?|%s|:\w+))*\)', re.IGNORECASE)
+
+try:
+    _thread_time = time.thread_time
+except AttributeError:      # pragma: no cover
+    _thread_time = time.process_time
+
+
+def signature(statement):
+    """语句的特征：合并空白，把 IN (?, ?, ...) 缩成一个，参数不同的同一条语句特征相同。"""
+    return _in_list_re.sub('IN (...)', _space_re.sub(' ', statement).strip())
+
+
+class QueryCounter(object):
+    """统计 with 块里执行的 SQL 语句，engine 默认是 db.engine。"""
+
+    def __init__(self, engine=None):
+        if engine is None:
+            from . import db
+            engine = db.engine
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class RequestProfile(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.cpu_started = _thread_time()
+        self.queries = []           # (语句, 秒)
+        self.template_time = 0.0
+        self._templates = []        # 嵌套渲染时只计最外层
+        self.duration = None
+        self.cpu_time = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        self.cpu_time = _thread_time() - self.cpu_started
+
+    @property
+    def sql_time(self):
+        return sum(t for s, t in self.queries)
+
+    def duplicates(self, threshold=2):
+        """执行了 threshold 次以上的语句特征和次数，次数多的在前。"""
+        counts = defaultdict(int)
+        for statement, t in self.queries:
+            counts[signature(statement)] += 1
+        return sorted(((sig, n) for sig, n in counts.items() if n >= threshold),
+                      key=lambda item: -item[1])
+
+    def template_started(self):
+        self._templates.append(time.perf_counter())
+
+    def template_finished(self):
+        if self._templates:
+            started = self._templates.pop()
+            if not self._templates:
+                self.template_time += time.perf_counter() - started
+
+
+class EndpointStats(object):
+    __slots__ = ('count', 'total', 'max', 'queries', 'sql_time', 'duplicates',
+                 'template_time', 'cpu_time')
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.max = self.sql_time = self.template_time = self.cpu_time = 0.0
+        self.queries = self.duplicates = 0
+
+    def as_dict(self):
+        n = float(self.count or 1)
+        return {
+            'count': self.count,
+            'mean_ms': self.total / n * 1000,
+            'max_ms': self.max * 1000,
+            'total_ms': self.total * 1000,
+            'queries': self.queries / n,
+            'sql_ms': self.sql_time / n * 1000,
+            'duplicates': self.duplicates / n,
+            'template_ms': self.template_time / n * 1000,
+            'cpu_ms': self.cpu_time / n * 1000,
+        }
+
+
+class ProfileStats(object):
+    """各 endpoint 的累计数据，以及最慢的若干个请求。"""
+
+    def __init__(self, keep=20):
+        self.keep = keep
+        self.endpoints = defaultdict(EndpointStats)
+        self.slowest = []       # 小顶堆，(耗时, 序号, 描述)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, profile, summary):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.count += 1
+            stats.total += profile.duration
+            stats.max = max(stats.max, profile.duration)
+            stats.queries += len(profile.queries)
+            stats.sql_time += profile.sql_time
+            stats.duplicates += summary['duplicates']
+            stats.template_time += profile.template_time
+            stats.cpu_time += profile.cpu_time
+            self._counter += 1
+            item = (profile.duration, self._counter, summary)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def endpoint_table(self, sort='mean_ms'):
+        with self._lock:
+            rows = [dict(endpoint=name, **stats.as_dict())
+                    for name, stats in self.endpoints.items()]
+        return sorted(rows, key=lambda row: -row[sort])
+
+    def slowest_requests(self):
+        with self._lock:
+            return [summary for duration, n, summary in sorted(self.slowest, reverse=True)]
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            del self.slowest[:]
+
+
+def _current_profile():
+    if has_request_context():
+        return g.get('_profile')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile() is not None:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile()
+    if profile is None:
+        return
+    stack = conn.info.get('profile_started')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    profile.queries.append((statement, elapsed))
+    slow = current_app.config['FLASKY_PROFILE_SLOW_QUERY']
+    if slow and elapsed >= slow:
+        logger.warning('slow query %.1fms in %s: %s', elapsed * 1000,
+                       request.endpoint, _space_re.sub(' ', statement))
+
+
+_engine_hooks = []
+
+
+def _listen_engines():
+    # 监听所有 Engine，只记录属于当前请求的语句；只装一次
+    if not _engine_hooks:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _engine_hooks.append(True)
+
+
+class Profiler(object):
+    """扩展：profiler.init_app(app)。
+
+    FLASKY_PROFILE 为 False 时不记录任何东西，每个请求只多一次配置检查。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PROFILE', False)
+        app.config.setdefault('FLASKY_PROFILE_HEADERS', True)
+        app.config.setdefault('FLASKY_PROFILE_SLOW_QUERY', 0.1)
+        app.config.setdefault('FLASKY_PROFILE_SLOW_REQUEST', 1.0)
+        app.config.setdefault('FLASKY_PROFILE_DUPLICATES', 3)
+        app.config.setdefault('FLASKY_PROFILE_KEEP', 20)
+        first = 'profiler' not in app.extensions
+        app.extensions['profiler'] = ProfileStats(app.config['FLASKY_PROFILE_KEEP'])
+        if first:
+            app.before_request(self._start)
+            app.after_request(self._finish)
+            before_render_template.connect(self._template_started, app)
+            template_rendered.connect(self._template_finished, app)
+        if app.config['FLASKY_PROFILE']:
+            _listen_engines()
+
+    @property
+    def stats(self):
+        return current_app.extensions['profiler']
+
+    @property
+    def enabled(self):
+        return current_app.config['FLASKY_PROFILE']
+
+    def _start(self):
+        if current_app.config['FLASKY_PROFILE'] and request.endpoint != 'static':
+            g._profile = RequestProfile()
+
+    @staticmethod
+    def _template_started(app, template, context):
+        profile = _current_profile()
+        if profile is not None:
+            profile.template_started()
+
+    @staticmethod
+    def _template_finished(app, template, context):
+        profile = _current_profile()
+        if profile is not None:
+            profile.template_finished()
+
+    def _finish(self, response):
+        profile = g.pop('_profile', None)
+        if profile is None:
+            return response
+        profile.finish()
+        config = current_app.config
+        duplicates = profile.duplicates(config['FLASKY_PROFILE_DUPLICATES'])
+        summary = {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'ms': round(profile.duration * 1000, 2),
+            'queries': len(profile.queries),
+            'sql_ms': round(profile.sql_time * 1000, 2),
+            'duplicates': sum(n for sig, n in duplicates),
+            'template_ms': round(profile.template_time * 1000, 2),
+            'cpu_ms': round(profile.cpu_time * 1000, 2),
+        }
+        if duplicates:
+            summary['top_duplicate'] = duplicates[0][0]
+        self.stats.add(request.endpoint or '<unmatched>', profile, summary)
+        slow = config['FLASKY_PROFILE_SLOW_REQUEST']
+        level = logging.WARNING if slow and profile.duration >= slow else logging.INFO
+        logger.log(level, 'profile %s', json.dumps(summary, sort_keys=True))
+        if config['FLASKY_PROFILE_HEADERS']:
+            response.headers['Server-Timing'] = ', '.join([
+                'app;dur=%.2f' % summary['ms'],
+                'sql;dur=%.2f;desc="%d queries"' % (summary['sql_ms'], summary['queries']),
+                'tpl;dur=%.2f' % summary['template_ms'],
+                'cpu;dur=%.2f' % summary['cpu_ms'],
+            ])
+            response.headers['X-Query-Count'] = str(summary['queries'])
+            response.headers['X-Duplicate-Queries'] = str(summary['duplicates'])
+        return response
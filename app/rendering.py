@@ -0,0 +1,224 @@
+# coding: utf-8
+# 文章和评论的 Markdown 渲染：按内容哈希缓存渲染结果，每个线程复用自己的
+# Markdown、bleach Cleaner / Linker 实例，也可以交给后台线程在提交之后再填 body_html。
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from queue import Queue
+
+from bleach.linkifier import Linker
+from bleach.sanitizer import Cleaner
+from flask import current_app
+from markdown import Markdown
+
+POST_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+             'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+             'h1', 'h2', 'h3', 'p']
+COMMENT_TAGS = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
+                'strong']
+
+
+class MarkdownRenderer(object):
+    """把 Markdown 转成过滤后的 HTML，结果按内容的 SHA1 做 LRU 缓存。"""
+
+    def __init__(self, tags, cache_size=1024):
+        self.tags = tags
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Markdown、Cleaner 和 Linker 都带着解析状态，不是线程安全的，每个线程一份
+        self._local = threading.local()
+
+    def _tools(self):
+        local = self._local
+        if getattr(local, 'markdown', None) is None:
+            local.markdown = Markdown(output_format='html')
+            local.cleaner = Cleaner(tags=self.tags, strip=True)
+            local.linker = Linker()
+        return local.markdown, local.cleaner, local.linker
+
+    def render_uncached(self, text):
+        md, cleaner, linker = self._tools()
+        return linker.linkify(cleaner.clean(md.reset().convert(text)))
+
+    def render(self, text):
+        if text is None:
+            return None
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = self.render_uncached(text)
+        if self.cache_size:
+            with self._lock:
+                self._cache[key] = html
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class RenderService(object):
+    """渲染服务扩展：renderer.init_app(app)。
+
+    FLASKY_RENDER_ASYNC 为 True 时 body_html 先置空，事务提交后由后台线程
+    渲染并写回数据库。
+    """
+
+    def __init__(self, app=None):
+        self.renderers = {
+            'post': MarkdownRenderer(POST_TAGS),
+            'comment': MarkdownRenderer(COMMENT_TAGS),
+        }
+        self.app = None
+        self._queue = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_RENDER_CACHE_SIZE', 1024)
+        app.config.setdefault('FLASKY_RENDER_ASYNC', False)
+        app.config.setdefault('FLASKY_RENDER_WORKERS', 1)
+        for r in self.renderers.values():
+            r.cache_size = app.config['FLASKY_RENDER_CACHE_SIZE']
+        app.extensions['renderer'] = self
+        if app.config['FLASKY_RENDER_ASYNC']:
+            self.start_workers(app)
+
+    def render(self, kind, text):
+        return self.renderers[kind].render(text)
+
+    @property
+    def is_async(self):
+        return self._queue is not None and \
+            current_app.config.get('FLASKY_RENDER_ASYNC', False)
+
+    def render_body(self, target, value, kind):
+        """在 body 的 set 事件里调用。"""
+        if self.is_async:
+            target.body_html = None
+            target._render_pending = kind
+        else:
+            target.body_html = self.render(kind, value)
+
+    # 后台渲染 ------------------------------------------------------------
+
+    def start_workers(self, app):
+        self.app = app      #线程已经启动时只换成新的应用（测试里会多次创建应用）
+        if self._queue is not None:
+            return
+        self._queue = Queue()
+        for i in range(app.config['FLASKY_RENDER_WORKERS']):
+            t = threading.Thread(target=self._worker, name='render-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def after_flush(self, session, flush_context):
+        # flush 之后对象才有 id，把待渲染的记录暂存在 session.info 里
+        pending = session.info.setdefault('render_pending', [])
+        for obj in list(session.new) + list(session.dirty):
+            kind = obj.__dict__.pop('_render_pending', None)
+            if kind is not None:
+                pending.append((kind, obj.__table__, obj.id, obj.body,
+                                _versions(kind, obj.id, getattr(obj, 'post_id', None))))
+
+    def after_commit(self, session):
+        pending = session.info.pop('render_pending', None)
+        if pending and self._queue is not None:
+            for item in pending:
+                self._queue.put(item)
+
+    def after_rollback(self, session):
+        session.info.pop('render_pending', None)
+
+    def _worker(self):
+        while True:
+            kind, table, id, body, versions = self._queue.get()
+            try:
+                html = self.render(kind, body)
+                with self.app.app_context():
+                    from . import db, cache
+                    # body 已经被再次修改的话交给下一次渲染
+                    result = db.engine.execute(table.update().where(
+                        (table.c.id == id) & (table.c.body == body)
+                    ).values(body_html=html))
+                    if result.rowcount:     #不经过 session，要自己换缓存版本号
+                        cache.touch('pages', *versions)
+            except Exception:
+                self.app.logger.exception('Rendering %s %s failed', kind, id)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """等待后台渲染队列清空。"""
+        if self._queue is not None:
+            self._queue.join()
+
+    # 批量重新渲染 --------------------------------------------------------
+
+    def rerender(self, model, kind, batch_size=500, processes=None):
+        """允许的标签改变后重新渲染整张表，返回处理的行数。"""
+        from . import db, cache
+        table = model.__table__
+        update = table.update().where(table.c.id == db.bindparam('row_id')) \
+            .values(body_html=db.bindparam('html'))
+        # 评论的缓存版本号挂在所属文章上
+        parent = model.post_id if kind == 'comment' else model.id
+        pool = Pool(processes, initializer=_init_pool_renderer)
+        last_id = 0
+        total = 0
+        try:
+            while True:
+                rows = db.session.query(model.id, model.body, parent) \
+                    .filter(model.id > last_id).order_by(model.id) \
+                    .limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                bodies = [(kind, body) for id, body, post_id in rows]
+                htmls = pool.map(_render_in_pool, bodies,
+                                 chunksize=max(1, len(bodies) // 16))
+                db.session.execute(update, [
+                    {'row_id': id, 'html': html}
+                    for (id, body, post_id), html in zip(rows, htmls)])
+                db.session.commit()
+                cache.touch('pages', *set('post:%s' % post_id for id, body, post_id in rows))
+                total += len(rows)
+        finally:
+            pool.close()
+            pool.join()
+        self.renderers[kind].clear()
+        return total
+
+
+def _versions(kind, id, post_id):
+    """body_html 变化后要换的缓存版本号（见 Cache.versions）。"""
+    return ['post:%s' % (id if kind == 'post' else post_id)]
+
+
+_pool_renderers = None
+
+
+def _init_pool_renderer():
+    global _pool_renderers
+    _pool_renderers = {
+        'post': MarkdownRenderer(POST_TAGS, cache_size=0),
+        'comment': MarkdownRenderer(COMMENT_TAGS, cache_size=0),
+    }
+
+
+def _render_in_pool(item):
+    kind, body = item
+    if body is None:
+        return None
+    return _pool_renderers[kind].render_uncached(body)
@@ -0,0 +1,285 @@
+# coding: utf-8
+# 全文检索：文章、评论和用户资料的倒排索引，在模型的 after_insert / after_update /
+# after_delete 事件里用同一个数据库连接增量更新，和业务数据一起提交或回滚。
+# SQLite 上用 FTS5 虚拟表，其他数据库用普通的倒排表（search_terms / search_documents）。
+import math
+import re
+from collections import defaultdict
+
+from flask import current_app
+
+from .pagination import KeysetPagination, encode_cursor, decode_cursor
+
+KINDS = {'post': 1, 'comment': 2, 'user': 3}
+
+_word_re = re.compile(r'[^\W_]+', re.UNICODE)
+_cjk_re = re.compile(u'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+
+
+def tokenize(text):
+    """把文本切成检索用的词：字母数字按词切，中日韩文字按相邻两个字切。"""
+    tokens = []
+    for word in _word_re.findall((text or '').lower()):
+        start = 0
+        for match in _cjk_re.finditer(word):
+            if match.start() > start:
+                tokens.append(word[start:match.start()])
+            run = match.group()
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            start = match.end()
+        if start < len(word):
+            tokens.append(word[start:])
+    return tokens
+
+
+class FTS5Backend(object):
+    """SQLite FTS5：rowid = 对象 id * 4 + 类别，按 rowid 增删不用扫描全表。"""
+
+    table = 'search_fts'
+
+    def create(self, connection):
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s '
+                           'USING fts5(title, body)' % self.table)
+
+    def drop(self, connection):
+        connection.execute('DROP TABLE IF EXISTS %s' % self.table)
+
+    def clear(self, connection, kind=None):
+        if kind is None:
+            connection.execute('DELETE FROM %s' % self.table)
+        else:
+            connection.execute('DELETE FROM %s WHERE rowid %% 4 = ?' % self.table,
+                               (KINDS[kind],))
+
+    def add(self, connection, kind, ref, title, body):
+        self.add_many(connection, kind, [(ref, title, body)])
+
+    def add_many(self, connection, kind, rows):
+        code = KINDS[kind]
+        rows = [(ref * 4 + code, ' '.join(tokenize(title)), ' '.join(tokenize(body)))
+                for ref, title, body in rows]
+        if not rows:
+            return
+        connection.execute('DELETE FROM %s WHERE rowid = ?' % self.table,
+                           [(row[0],) for row in rows])
+        connection.execute('INSERT INTO %s (rowid, title, body) VALUES (?, ?, ?)'
+                           % self.table, rows)
+
+    def remove(self, connection, kind, ref):
+        self.remove_many(connection, kind, [ref])
+
+    def remove_many(self, connection, kind, refs):
+        code = KINDS[kind]
+        rows = [(ref * 4 + code,) for ref in refs]
+        if rows:
+            connection.execute('DELETE FROM %s WHERE rowid = ?' % self.table, rows)
+
+    def search(self, connection, kind, terms, after=None, limit=20):
+        # bm25 越小越相关；标题的权重是正文的两倍
+        score = 'bm25(%s, 2.0, 1.0)' % self.table
+        sql = 'SELECT rowid, %s FROM %s WHERE %s MATCH ? AND rowid %% 4 = ?' \
+            % (score, self.table, self.table)
+        params = [' '.join('"%s"' % t for t in terms), KINDS[kind]]
+        if after is not None:
+            sql += ' AND (%s > ? OR (%s = ? AND rowid > ?))' % (score, score)
+            params.extend([after[0], after[0], after[1] * 4 + KINDS[kind]])
+        sql += ' ORDER BY 2, rowid LIMIT ?'
+        params.append(limit)
+        return [(s, rowid // 4) for rowid, s in connection.execute(sql, tuple(params))]
+
+
+class TableBackend(object):
+    """通用的倒排表，任何数据库都能用。
+
+    每个词的 IDF 先用一条 GROUP BY term 查出文档频率在 Python 里算好，再作为参数
+    传进打分的 SQL：按 ref 分组求 BM25、排序、按游标过滤并 LIMIT 都在数据库里做，
+    不把整条倒排列表读进内存。
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    @property
+    def tables(self):
+        from .models import search_terms, search_documents
+        return search_terms, search_documents
+
+    def create(self, connection):
+        for table in self.tables:
+            table.create(connection, checkfirst=True)
+
+    def drop(self, connection):
+        for table in self.tables:
+            table.drop(connection, checkfirst=True)
+
+    def clear(self, connection, kind=None):
+        for table in self.tables:
+            statement = table.delete()
+            if kind is not None:
+                statement = statement.where(table.c.kind == KINDS[kind])
+            connection.execute(statement)
+
+    def _postings(self, kind, ref, title, body):
+        counts = defaultdict(int)
+        for token in tokenize(title):
+            counts[token] += 2      # 标题里的词算两次
+        for token in tokenize(body):
+            counts[token] += 1
+        return [{'term': term[:64], 'kind': KINDS[kind], 'ref': ref, 'tf': tf}
+                for term, tf in counts.items()], sum(counts.values())
+
+    def add(self, connection, kind, ref, title, body):
+        self.add_many(connection, kind, [(ref, title, body)])
+
+    def add_many(self, connection, kind, rows):
+        terms, documents = self.tables
+        rows = list(rows)
+        self.remove_many(connection, kind, [ref for ref, title, body in rows])
+        postings = []
+        lengths = []
+        for ref, title, body in rows:
+            items, length = self._postings(kind, ref, title, body)
+            postings.extend(items)
+            lengths.append({'kind': KINDS[kind], 'ref': ref, 'length': length})
+        if lengths:
+            connection.execute(documents.insert(), lengths)
+        if postings:
+            connection.execute(terms.insert(), postings)
+
+    def remove(self, connection, kind, ref):
+        self.remove_many(connection, kind, [ref])
+
+    def remove_many(self, connection, kind, refs):
+        refs = list(refs)
+        if not refs:
+            return
+        for table in self.tables:
+            connection.execute(table.delete().where(
+                (table.c.kind == KINDS[kind]) & table.c.ref.in_(refs)))
+
+    def search(self, connection, kind, terms, after=None, limit=20):
+        from sqlalchemy import select, func, case, literal
+        search_terms, documents = self.tables
+        terms = sorted(set(t[:64] for t in terms))
+        code = KINDS[kind]
+        count, avg_length = connection.execute(
+            select([func.count(), func.avg(documents.c.length)])
+            .where(documents.c.kind == code)).first()
+        if not count:
+            return []
+        df = dict(connection.execute(
+            select([search_terms.c.term, func.count()])
+            .where((search_terms.c.kind == code) & search_terms.c.term.in_(terms))
+            .group_by(search_terms.c.term)).fetchall())
+        if len(df) < len(terms):
+            return []       # 和 FTS5 一样，所有词都要出现
+        idf = case([(search_terms.c.term == term,
+                     literal(math.log((count - n + 0.5) / (n + 0.5) + 1)))
+                    for term, n in df.items()])
+        tf = search_terms.c.tf * literal(1.0)
+        norm = literal(self.k1 * (1 - self.b)) + \
+            documents.c.length * literal(self.k1 * self.b / float(avg_length or 1))
+        score = -func.sum(idf * tf * literal(self.k1 + 1) / (tf + norm))
+        query = select([score.label('score'), search_terms.c.ref]) \
+            .select_from(search_terms.join(
+                documents, (documents.c.kind == search_terms.c.kind) &
+                (documents.c.ref == search_terms.c.ref))) \
+            .where((search_terms.c.kind == code) & search_terms.c.term.in_(terms)) \
+            .group_by(search_terms.c.ref) \
+            .having(func.count() == len(terms))
+        if after is not None:
+            query = query.having((score > after[0]) |
+                                 ((score == after[0]) & (search_terms.c.ref > after[1])))
+        query = query.order_by(score, search_terms.c.ref).limit(limit)
+        return [(s, ref) for s, ref in connection.execute(query)]
+
+
+backends = {
+    'fts5': FTS5Backend,
+    'table': TableBackend,
+}
+
+
+class Search(object):
+    """全文检索扩展：search.init_app(app)。
+
+    FLASKY_SEARCH_BACKEND 为 None 时 SQLite 用 'fts5'，其他数据库用 'table'。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_SEARCH_BACKEND', None)
+        app.config.setdefault('FLASKY_SEARCH_PER_PAGE', 20)
+        name = app.config['FLASKY_SEARCH_BACKEND']
+        if name is None:
+            uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+            name = 'fts5' if uri.startswith('sqlite') else 'table'
+        app.extensions['search'] = backends[name]()
+
+    @property
+    def backend(self):
+        return current_app.extensions['search']
+
+    # 由模型事件调用，connection 是当前 flush 用的连接
+
+    def update(self, connection, kind, ref, title, body):
+        self.backend.add(connection, kind, ref, title, body)
+
+    def remove(self, connection, kind, ref):
+        self.backend.remove(connection, kind, ref)
+
+    def update_many(self, connection, kind, rows):
+        """rows 是 (id, 标题, 正文) 的列表。"""
+        self.backend.add_many(connection, kind, rows)
+
+    def remove_many(self, connection, kind, refs):
+        self.backend.remove_many(connection, kind, refs)
+
+    def query(self, kind, text, after=None, per_page=None):
+        """返回一页检索结果，items 是按相关度排好的对象 id。"""
+        from . import db
+        per_page = per_page or current_app.config['FLASKY_SEARCH_PER_PAGE']
+        terms = tokenize(text)
+        if not terms:
+            return KeysetPagination([], per_page)
+        rows = self.backend.search(db.session.connection(), kind, terms,
+                                   decode_cursor(after, 2), per_page + 1)
+        next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+        return KeysetPagination([ref for score, ref in rows[:per_page]], per_page,
+                                next_cursor=next_cursor)
+
+    def reindex(self, session, batch_size=1000):
+        """清空并重建整个索引，返回写入的文档数。"""
+        from .models import Post, Comment, User
+        connection = session.connection()
+        backend = self.backend
+        backend.create(connection)
+        backend.clear(connection)
+        total = 0
+        # 只取需要的列，不构造 ORM 对象
+        sources = [
+            ('post', Post, [Post.body], None),
+            ('comment', Comment, [Comment.body], Comment.visible()),
+            ('user', User, [User.username, User.name, User.about_me], None),
+        ]
+        for kind, model, columns, condition in sources:
+            last_id = 0
+            while True:
+                query = session.query(model.id, *columns).filter(model.id > last_id)
+                if condition is not None:
+                    query = query.filter(condition)
+                rows = query.order_by(model.id).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                backend.add_many(connection, kind, [
+                    (row[0], ' '.join(filter(None, row[1:-1])), row[-1])
+                    for row in rows])
+                total += len(rows)
+        return total
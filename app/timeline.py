@@ -0,0 +1,299 @@
+# coding: utf-8
+# 关注动态的写扩散（fan-out-on-write）：发文章时把文章写进每个关注者的
+# 时间线，首页读关注动态时直接按时间线分页，不再每次联结 posts 和 follows。
+# 关注者很多的用户不做写扩散，读的时候再把他们的文章合并进来（读扩散）。
+import time
+from bisect import insort
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import select, literal, or_, func
+
+
+def latest_rows(follows, authors, skip_authors, limit):
+    """满足 follows 条件的每条关注，对方最新的 limit 篇文章 (关注人, 文章, 作者, 时间)。
+
+    用窗口函数给 authors 的文章按时间排名，每个作者只排一次序，
+    和新关注时补时间线（FLASKY_TIMELINE_BACKFILL）的规则一样。
+    """
+    from .models import Follow, Post
+    rank = func.row_number().over(partition_by=Post.author_id,
+                                  order_by=(Post.timestamp.desc(), Post.id.desc()))
+    latest = select([Post.id, Post.author_id, Post.timestamp, rank.label('rank')]) \
+        .where(Post.author_id.in_(authors))
+    if skip_authors:
+        latest = latest.where(~Post.author_id.in_(skip_authors))
+    latest = latest.alias('latest')
+    return select([Follow.follower_id, latest.c.id, latest.c.author_id,
+                   latest.c.timestamp]) \
+        .select_from(Follow.__table__.join(latest,
+                                           latest.c.author_id == Follow.followed_id)) \
+        .where(follows & (latest.c.rank <= limit))
+
+
+def rebuild_rows(user_ids, skip_authors, limit):
+    """user_ids 这批用户完整的时间线。"""
+    from .models import Follow
+    followed = select([Follow.followed_id]).where(Follow.follower_id.in_(user_ids))
+    return latest_rows(Follow.follower_id.in_(user_ids), followed, skip_authors, limit)
+
+
+def follow_rows(pairs, skip_authors, limit):
+    """新关注的 (关注人, 被关注者) 要补进时间线的文章，pairs 必须已经写进 follows。"""
+    from .models import Follow
+    return latest_rows(Follow.match(pairs), sorted(set(t for f, t in pairs)),
+                       skip_authors, limit)
+
+
+class SQLTimelineBackend(object):
+    """时间线存放在 timeline_entries 表里，和业务数据在同一个事务中更新。"""
+
+    def fan_out(self, connection, post):
+        from .models import Follow, TimelineEntry
+        followers = select([Follow.follower_id, literal(post.id),
+                            literal(post.author_id), literal(post.timestamp)]) \
+            .where(Follow.followed_id == post.author_id)
+        connection.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], followers))
+
+    def retract(self, connection, post):
+        from .models import TimelineEntry
+        table = TimelineEntry.__table__
+        connection.execute(table.delete().where(table.c.post_id == post.id))
+
+    def follow(self, session, follower_id, followed_id, limit):
+        from .models import Post, TimelineEntry
+        recent = select([literal(follower_id), Post.id, Post.author_id,
+                         Post.timestamp]) \
+            .where(Post.author_id == followed_id) \
+            .order_by(Post.timestamp.desc()).limit(limit)
+        session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], recent))
+
+    def unfollow(self, session, follower_id, followed_id):
+        from .models import TimelineEntry
+        table = TimelineEntry.__table__
+        session.execute(table.delete().where(
+            (table.c.user_id == follower_id) & (table.c.author_id == followed_id)))
+
+    def follow_many(self, session, pairs, skip_authors, limit):
+        from .models import TimelineEntry
+        session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            follow_rows(pairs, skip_authors, limit)))
+
+    def unfollow_many(self, session, pairs):
+        from .models import Follow, TimelineEntry
+        table = TimelineEntry.__table__
+        session.execute(table.delete().where(
+            Follow.match(pairs, table.c.user_id, table.c.author_id)))
+
+    def posts(self, user_id):
+        from .models import Post, TimelineEntry
+        query = Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id) \
+            .filter(TimelineEntry.user_id == user_id)
+        return query, (TimelineEntry.timestamp, TimelineEntry.post_id)
+
+    def post_ids_query(self, user_id):
+        from .models import TimelineEntry
+        from . import db
+        return db.session.query(TimelineEntry.post_id) \
+            .filter(TimelineEntry.user_id == user_id)
+
+    def rebuild(self, session, user_ids, skip_authors, limit):
+        from .models import TimelineEntry
+        table = TimelineEntry.__table__
+        session.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+        session.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            rebuild_rows(user_ids, skip_authors, limit)))
+
+
+class MemoryTimelineBackend(object):
+    """进程内的时间线，开发和测试时代替 timeline_entries 表。"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = {}      # user_id -> [(timestamp, post_id, author_id), ...]
+        self._lock = Lock()
+
+    def _push(self, user_id, entry):
+        entries = self._entries.setdefault(user_id, [])
+        if entry not in entries:
+            insort(entries, entry)
+            if len(entries) > self.max_entries:
+                del entries[0]
+
+    def fan_out(self, connection, post):
+        from .models import Follow
+        rows = connection.execute(select([Follow.follower_id])
+                                  .where(Follow.followed_id == post.author_id))
+        entry = (post.timestamp, post.id, post.author_id)
+        with self._lock:
+            for row in rows:
+                self._push(row[0], entry)
+
+    def retract(self, connection, post):
+        with self._lock:
+            for user_id, entries in self._entries.items():
+                entries[:] = [e for e in entries if e[1] != post.id]
+
+    def follow(self, session, follower_id, followed_id, limit):
+        from .models import Post
+        rows = session.query(Post.timestamp, Post.id, Post.author_id) \
+            .filter(Post.author_id == followed_id) \
+            .order_by(Post.timestamp.desc()).limit(limit).all()
+        with self._lock:
+            for row in rows:
+                self._push(follower_id, tuple(row))
+
+    def unfollow(self, session, follower_id, followed_id):
+        with self._lock:
+            entries = self._entries.get(follower_id, [])
+            entries[:] = [e for e in entries if e[2] != followed_id]
+
+    def follow_many(self, session, pairs, skip_authors, limit):
+        rows = session.execute(follow_rows(pairs, skip_authors, limit)).fetchall()
+        with self._lock:
+            for follower_id, post_id, author_id, timestamp in rows:
+                self._push(follower_id, (timestamp, post_id, author_id))
+
+    def unfollow_many(self, session, pairs):
+        pairs = set(pairs)
+        with self._lock:
+            for user_id in set(f for f, t in pairs):
+                entries = self._entries.get(user_id, [])
+                entries[:] = [e for e in entries if (user_id, e[2]) not in pairs]
+
+    def post_ids(self, user_id):
+        with self._lock:
+            return [e[1] for e in self._entries.get(user_id, [])]
+
+    def posts(self, user_id):
+        from .models import Post
+        return Post.query.filter(Post.id.in_(self.post_ids(user_id))), \
+            (Post.timestamp, Post.id)
+
+    def post_ids_query(self, user_id):
+        return self.post_ids(user_id)
+
+    def rebuild(self, session, user_ids, skip_authors, limit):
+        rows = session.execute(rebuild_rows(user_ids, skip_authors, limit)).fetchall()
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+            for follower_id, post_id, author_id, timestamp in rows:
+                self._push(follower_id, (timestamp, post_id, author_id))
+
+
+backends = {
+    'sql': SQLTimelineBackend,
+    'memory': MemoryTimelineBackend,
+}
+
+
+class Timeline(object):
+    """时间线扩展，用法和其他扩展一样：timeline.init_app(app)。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_TIMELINE_BACKEND', 'sql')
+        app.config.setdefault('FLASKY_FANOUT_THRESHOLD', 1000)
+        app.config.setdefault('FLASKY_TIMELINE_BACKFILL', 100)
+        app.config.setdefault('FLASKY_TIMELINE_POPULAR_TTL', 300)
+        name = app.config['FLASKY_TIMELINE_BACKEND']
+        if name == 'memory':
+            backend = MemoryTimelineBackend(
+                app.config.get('FLASKY_TIMELINE_MAX_ENTRIES', 1000))
+        else:
+            backend = backends[name]()
+        app.extensions['timeline'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['timeline']
+
+    def popular_authors(self, refresh=False):
+        """关注者数超过阈值的用户，这些人的文章走读扩散。结果按 TTL 缓存。"""
+        from .models import User
+        from . import db
+        backend = self.backend
+        cached = getattr(backend, 'popular', None)
+        if not refresh and cached is not None and cached[1] > time.time():
+            return cached[0]
+        threshold = current_app.config['FLASKY_FANOUT_THRESHOLD']
+        rows = db.session.query(User.id).filter(User.followers_count >= threshold)
+        popular = frozenset(row[0] for row in rows)
+        backend.popular = (popular, time.time() +
+                           current_app.config['FLASKY_TIMELINE_POPULAR_TTL'])
+        return popular
+
+    # 以下几个方法由 Post / User 模型在写入时调用
+
+    def post_created(self, connection, post):
+        if post.author_id is None or post.author_id in self.popular_authors():
+            return
+        self.backend.fan_out(connection, post)
+
+    def post_deleted(self, connection, post):
+        self.backend.retract(connection, post)
+
+    def followed(self, session, follower, followed):
+        if follower.id is None or followed.id is None or \
+                followed.id in self.popular_authors():
+            return
+        self.backend.follow(session, follower.id, followed.id,
+                            current_app.config['FLASKY_TIMELINE_BACKFILL'])
+
+    def unfollowed(self, session, follower, followed):
+        self.backend.unfollow(session, follower.id, followed.id)
+
+    def followed_many(self, session, pairs):
+        """批量关注后补时间线，一条 INSERT ... SELECT；pairs 必须已经写进 follows。"""
+        if pairs:
+            self.backend.follow_many(session, pairs, list(self.popular_authors()),
+                                     current_app.config['FLASKY_TIMELINE_BACKFILL'])
+
+    def unfollowed_many(self, session, pairs):
+        if pairs:
+            self.backend.unfollow_many(session, pairs)
+
+    def posts_for(self, user):
+        """返回 (query, 排序列)，供 keyset_paginate 分页。"""
+        from .models import Follow, Post
+        from . import db
+        popular = self.popular_authors()
+        if popular:
+            popular_followed = db.session.query(Follow.followed_id).filter(
+                Follow.follower_id == user.id,
+                Follow.followed_id.in_(popular)).all()
+            popular_followed = [row[0] for row in popular_followed]
+        else:
+            popular_followed = []
+        if not popular_followed:
+            return self.backend.posts(user.id)
+        # 混合模式：时间线里的文章加上热门用户的文章
+        query = Post.query.filter(or_(
+            Post.id.in_(self.backend.post_ids_query(user.id)),
+            Post.author_id.in_(popular_followed)))
+        return query, (Post.timestamp, Post.id)
+
+    def rebuild(self, session, batch_size=500):
+        """按用户 id 分批重建所有人的时间线，每批提交一次，返回处理的用户数。"""
+        from .models import User
+        skip = list(self.popular_authors(refresh=True))
+        limit = current_app.config['FLASKY_TIMELINE_BACKFILL']
+        last = 0
+        count = 0
+        while True:
+            ids = [id for id, in session.query(User.id).filter(User.id > last)
+                   .order_by(User.id).limit(batch_size)]
+            if not ids:
+                return count
+            self.backend.rebuild(session, ids, skip, limit)
+            session.commit()
+            count += len(ids)
+            last = ids[-1]
@@ -0,0 +1,125 @@
+# coding: utf-8
+# 登录用户的缓存：load_user 在 TTL 内直接用缓存的列值重建 User 对象，
+# 角色和权限放在进程内的角色表里，can() / is_administrator() 不再查数据库。
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class RoleTable(object):
+    """role_id -> permissions 的进程内映射，角色变化或过期后整表重新加载。"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._permissions = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from .models import Role
+        from . import db
+        rows = db.session.query(Role.id, Role.permissions).all()
+        with self._lock:
+            self._permissions = dict((id, permissions or 0) for id, permissions in rows)
+            self._expires = time.time() + self.ttl
+
+    def permissions(self, role_id):
+        if self._permissions is None or self._expires < time.time() or \
+                role_id not in self._permissions:
+            self._load()
+        return self._permissions.get(role_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._permissions = None
+
+
+class UserCache(object):
+    """按用户 id 缓存 users 表的一行，命中时 merge 进当前 session，不发查询。"""
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users = {}        # user_id -> (expires, 列值字典)
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        from .models import User
+        from . import db
+        now = time.time()
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            user = User.__mapper__.class_manager.new_instance()
+            for key, value in entry[1].items():
+                set_committed_value(user, key, value)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+        self.misses += 1
+        user = User.query.get(user_id)
+        if user is not None and self.ttl:
+            values = dict((attr.key, getattr(user, attr.key))
+                          for attr in User.__mapper__.column_attrs)
+            with self._lock:
+                self._users[user_id] = (now + self.ttl, values)
+        return user
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+
+class UserLoader(object):
+    """扩展：user_cache.init_app(app)。"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_USER_CACHE_TTL', 30)
+        app.config.setdefault('FLASKY_ROLE_TABLE_TTL', 300)
+        app.extensions['user_cache'] = UserCache(app.config['FLASKY_USER_CACHE_TTL'])
+        app.extensions['role_table'] = RoleTable(app.config['FLASKY_ROLE_TABLE_TTL'])
+
+    @property
+    def users(self):
+        return current_app.extensions['user_cache']
+
+    @property
+    def roles(self):
+        return current_app.extensions['role_table']
+
+    def load(self, user_id):
+        return self.users.load(user_id)
+
+    def permissions(self, role_id):
+        return self.roles.permissions(role_id)
+
+    # 由模型事件调用：用户资料、角色、密码等变化后在提交时清掉缓存
+
+    def invalidate_user_on_commit(self, session, user_id):
+        session.info.setdefault('user_cache_invalid', set()).add(user_id)
+
+    def invalidate_roles_on_commit(self, session):
+        session.info.setdefault('user_cache_invalid', set()).add(None)
+
+    def after_commit(self, session):
+        ids = session.info.pop('user_cache_invalid', None)
+        if not ids:
+            return
+        if None in ids:
+            self.roles.invalidate()
+            ids.discard(None)
+        for user_id in ids:
+            self.users.invalidate(user_id)
+
+    def after_rollback(self, session):
+        session.info.pop('user_cache_invalid', None)
@@ -0,0 +1,67 @@
+# coding: utf-8
+"""缩略图流水线的吞吐量：用不同的进程数处理同一批图片，报告每秒张数和每核张数。
+
+    python -m benchmarks.bench_variants -n 40 --size 3000x2000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.photo.variants import Image, make_variants
+
+WIDTHS = (160, 320, 640, 1280)
+
+
+def make_images(directory, count, size):
+    paths = []
+    for i in range(count):
+        # 渐变加噪点，避免纯色图让 JPEG 编解码快得不真实
+        noise = Image.effect_noise(size, 64 + i % 64)
+        gradient = Image.linear_gradient('L').resize(size)
+        image = Image.merge('RGB', (noise, gradient,
+                                    noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        path = os.path.join(directory, '%d.jpg' % i)
+        image.save(path, 'JPEG', quality=90)
+        paths.append(path)
+    return paths
+
+
+def run(paths, root, workers):
+    started = time.time()
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(make_variants, path, root, '%064x' % i, WIDTHS)
+                   for i, path in enumerate(paths)]
+        for future in futures:
+            future.result()
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=40)
+    parser.add_argument('--size', default='3000x2000')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if Image is None:
+        parser.error('Pillow is not installed')
+    size = tuple(int(x) for x in args.size.split('x'))
+    directory = tempfile.mkdtemp()
+    try:
+        paths = make_images(directory, args.count, size)
+        workers = 1
+        while workers <= args.max_workers:
+            root = tempfile.mkdtemp(dir=directory)
+            elapsed = run(paths, root, workers)
+            rate = len(paths) / elapsed
+            print('%2d workers  %7.2f images/s  %6.2f images/s/core'
+                  % (workers, rate, rate / workers))
+            workers *= 2
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# coding: utf-8
+"""主要页面的延迟和吞吐量：在种好数据的库上用测试客户端反复请求，报告
+p50/p95/p99、每秒请求数和每个请求的 SQL 条数，可以和保存的基线比较。
+默认关掉页面缓存，测的是每次都真正渲染的开销；--page-cache 测缓存命中时的数字，
+两种结果不能互相比较。
+
+    python -m benchmarks.routes -n 200 -o results.json
+    python -m benchmarks.routes --save-baseline benchmarks/baseline.json
+    python -m benchmarks.routes --baseline benchmarks/baseline.json
+
+p95 比基线慢 --threshold 以上，或者 SQL 条数变多时退出码为 1。
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from app import create_app, db
+from app.fake import Seeder
+from app.models import User, Role, Post
+from app.profiling import QueryCounter
+
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'bench'
+
+
+def percentile(values, p):
+    """最近秩法的百分位数，values 需要已经排好序。"""
+    if not values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(len(values) - 1, k))]
+
+
+def make_app(database, seed, users, posts, follows, comments, reseed=False,
+             page_cache=False):
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(database)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['FLASKY_CACHE_PAGES'] = page_cache
+    with app.app_context():
+        if reseed or not os.path.exists(database) or \
+                User.query.filter_by(email=BENCH_EMAIL).first() is None:
+            db.drop_all()
+            db.create_all()
+            Role.insert_roles()
+            Seeder(seed).run(users, posts, follows, comments)
+            # 用来登录的管理员，关注一批热门用户，时间线和审核页面才有内容
+            admin = User(email=BENCH_EMAIL, username='bench', password=BENCH_PASSWORD,
+                         confirmed=True,
+                         role=Role.query.filter_by(permissions=0xff).first())
+            db.session.add(admin)
+            for user in User.query.order_by(User.followers_count.desc()).limit(50):
+                admin.follow(user)
+            db.session.commit()
+    return app
+
+
+def routes(app):
+    """(名称, 方法, 地址, 是否登录, cookies, 表单)。"""
+    with app.app_context():
+        username = db.session.query(User.username) \
+            .order_by(User.followers_count.desc()).limit(1).scalar()
+        post_id = db.session.query(Post.id) \
+            .order_by(Post.comment_count.desc()).limit(1).scalar()
+    return [
+        ('index', 'GET', '/', False, {}, None),
+        ('followed', 'GET', '/', True, {'show_followed': '1'}, None),
+        ('user', 'GET', '/user/%s' % username, False, {}, None),
+        ('post', 'GET', '/post/%d' % post_id, False, {}, None),
+        ('followers', 'GET', '/followers/%s' % username, True, {}, None),
+        ('moderate', 'GET', '/moderate', True, {}, None),
+        ('login', 'POST', '/auth/login', False, {},
+         {'email': BENCH_EMAIL, 'password': BENCH_PASSWORD}),
+    ]
+
+
+def login(client):
+    response = client.post('/auth/login', data={'email': BENCH_EMAIL,
+                                                'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('benchmark user cannot log in')
+
+
+def measure(app, route, requests, warmup):
+    name, method, url, logged_in, cookies, data = route
+    client = app.test_client()
+    if logged_in:
+        login(client)
+    for key, value in cookies.items():
+        client.set_cookie('localhost', key, value)
+    latencies = []
+    statuses = set()
+    with app.app_context():
+        engine = db.engine
+    with QueryCounter(engine) as counter:
+        for i in range(warmup + requests):
+            if i == warmup:
+                del counter.statements[:]
+            started = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            elapsed = time.perf_counter() - started
+            response.close()
+            if i >= warmup:
+                latencies.append(elapsed)
+                statuses.add(response.status_code)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'requests': requests,
+        'status': sorted(statuses),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': total / len(latencies) * 1000,
+        'rps': len(latencies) / total if total else None,
+        'queries_per_request': counter.count / float(requests),
+    }
+
+
+def compare(results, baseline, threshold):
+    """返回回归的描述列表。"""
+    problems = []
+    if results.get('page_cache') != baseline.get('page_cache'):
+        return ['baseline measured with page_cache=%s, this run with page_cache=%s' % (
+            baseline.get('page_cache'), results.get('page_cache'))]
+    for name, result in sorted(results['routes'].items()):
+        base = baseline.get('routes', {}).get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            problems.append('%s: p95 %.2fms, baseline %.2fms' % (
+                name, result['p95_ms'], base['p95_ms']))
+        if result['queries_per_request'] > base['queries_per_request']:
+            problems.append('%s: %.1f queries/request, baseline %.1f' % (
+                name, result['queries_per_request'], base['queries_per_request']))
+    return problems
+
+
+def run(requests=100, warmup=10, database=None, seed=1, users=1000, posts=10000,
+        follows=20000, comments=20000, reseed=False, page_cache=False, only=None):
+    database = database or os.path.join(tempfile.gettempdir(), 'flasky-bench.sqlite')
+    app = make_app(database, seed, users, posts, follows, comments, reseed, page_cache)
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'dataset': {'seed': seed, 'users': users, 'posts': posts,
+                    'follows': follows, 'comments': comments},
+        'page_cache': page_cache,
+        'routes': {},
+    }
+    for route in routes(app):
+        if only and route[0] not in only:
+            continue
+        results['routes'][route[0]] = measure(app, route, requests, warmup)
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('page cache %s\n' % ('on' if results['page_cache'] else 'off'))
+    out.write('%-10s %8s %8s %8s %8s %8s\n' % ('route', 'p50ms', 'p95ms', 'p99ms',
+                                                'req/s', 'queries'))
+    for name, r in sorted(results['routes'].items()):
+        out.write('%-10s %8.2f %8.2f %8.2f %8.1f %8.1f\n' % (
+            name, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['rps'],
+            r['queries_per_request']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('-w', '--warmup', type=int, default=10)
+    parser.add_argument('--database', help='seeded SQLite file, reused between runs')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--page-cache', action='store_true',
+                        help='measure with the page cache on (mostly cache hits)')
+    parser.add_argument('--route', action='append', dest='only')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--save-baseline', help='write results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed p95 slowdown, 0.2 = 20%%')
+    args = parser.parse_args(argv)
+
+    results = run(args.requests, args.warmup, args.database, args.seed, args.users,
+                  args.posts, args.follows, args.comments, args.reseed,
+                  args.page_cache, args.only)
+    report(results)
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.threshold)
+        for problem in problems:
+            print('REGRESSION ' + problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
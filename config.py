@@ -20,8 +20,63 @@ class Config:
     FLASKY_POSTS_PER_PAGE = 20
     FLASK_FOLLOWERS_PER_PAGE = 10
     FLASKY_COMMENTS_PER_PAGE = 10
-    UPLOAD_FOLDER = os.getcwd()
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    FLASKY_PAGINATION_COUNT_TTL = 60   #列表大致总数的缓存秒数，0 表示不统计
+    FLASKY_TIMELINE_BACKEND = 'sql'     #关注动态存储：sql 或 memory
+    FLASKY_FANOUT_THRESHOLD = 1000      #关注者超过这个数的用户改为读扩散
+    FLASKY_TIMELINE_BACKFILL = 100      #新关注某人时补进时间线的文章数
+    FLASKY_FOLLOW_CACHE_THRESHOLD = 1000    #关注数或粉丝数达到这个值的用户在内存里缓存整张关注表，None表示不缓存
+    FLASKY_FOLLOW_CACHE_TTL = 300
+    FLASKY_FOLLOW_SUGGESTION_FANOUT = 200   #推荐关注时只看最近关注的这么多人
+    FLASKY_RENDER_CACHE_SIZE = 1024     #Markdown渲染结果的缓存条数
+    FLASKY_RENDER_ASYNC = False         #为True时提交后由后台线程渲染body_html
+    CACHE_BACKEND = 'memory'            #缓存后端：null、memory、filesystem 或类路径
+    CACHE_DEFAULT_TIMEOUT = 300
+    FLASKY_CACHE_PAGES = True           #缓存匿名用户看到的整页
+    FLASKY_PAGE_CACHE_TIMEOUT = 60
+    FLASKY_LAST_SEEN_RESOLUTION = 60        #这么多秒内的重复访问不更新last_seen
+    FLASKY_LAST_SEEN_FLUSH_INTERVAL = 30    #批量写入last_seen的间隔秒数
+    FLASKY_LAST_SEEN_FLUSH_THRESHOLD = 500  #积攒这么多用户就立即写入
+    FLASKY_USER_CACHE_TTL = 30      #登录用户缓存的秒数，0表示不缓存
+    FLASKY_ROLE_TABLE_TTL = 300     #角色权限表重新加载的间隔秒数
+    FLASKY_MAIL_WORKERS = 2         #发邮件的工作线程数，每个线程复用一个SMTP连接
+    FLASKY_MAIL_QUEUE_SIZE = 1000
+    FLASKY_MAIL_MAX_RETRIES = 5
+    FLASKY_MAIL_SPOOL_DIR = os.environ.get('FLASKY_MAIL_SPOOL_DIR')   #设置后邮件先写入磁盘，重启后继续发送
+    FLASKY_SEARCH_BACKEND = None        #全文检索：fts5（SQLite）或 table（通用倒排表），None 按数据库自动选择
+    FLASKY_SEARCH_PER_PAGE = 20
+    FLASKY_PASSWORD_METHOD = 'pbkdf2:sha256:150000'    #密码散列的算法和迭代次数，改了以后旧散列在登录时自动升级
+    FLASKY_PASSWORD_WORKERS = 2         #计算密码散列的进程数，0表示在请求线程里计算
+    FLASKY_PASSWORD_CONCURRENCY = None  #同时进行的散列计算上限，None表示和进程数相同
+    FLASKY_PASSWORD_TIMEOUT = 10        #等待散列名额的秒数，超时返回503
+    FLASKY_PROFILE = bool(os.environ.get('FLASKY_PROFILE'))    #记录每个请求的SQL、模板和CPU时间，管理员在/debug/profile查看
+    FLASKY_PROFILE_SLOW_QUERY = 0.1     #超过这么多秒的SQL写一条警告日志
+    FLASKY_PROFILE_SLOW_REQUEST = 1.0   #超过这么多秒的请求日志级别为WARNING
+    FLASKY_PROFILE_DUPLICATES = 3       #同一条语句在一个请求里执行这么多次算作重复（N+1）
+    FLASKY_METRICS = True               #记录请求耗时等指标，本机可以从/metrics抓取
+    FLASKY_METRICS_DIR = os.environ.get('FLASKY_METRICS_DIR')  #多进程部署时各进程写指标文件的目录，/metrics合并所有文件
+    FLASKY_METRICS_ALLOWED = ('127.0.0.1', '::1')   #没有令牌时允许访问/metrics的地址，放在反向代理后面时不可靠
+    FLASKY_METRICS_TOKEN = os.environ.get('FLASKY_METRICS_TOKEN')  #设置后/metrics要带 Authorization: Bearer 令牌
+    FLASKY_API_MAX_PER_PAGE = 100       #API 列表每页最多的条数（?per_page=）
+    FLASKY_API_TOKEN_EXPIRATION = 3600  #API 令牌的有效秒数
+    FLASKY_API_GZIP_MIN_SIZE = 500      #API 响应超过这么多字节、客户端支持时用 gzip 压缩
+    FLASKY_API_GZIP_LEVEL = 6
+    FLASKY_API_ETAG_TTL = 300   #API 的 ETag 最多沿用的秒数，别的进程提交的修改最迟这么久后可见
+    FLASKY_AVATAR_SOURCE = os.environ.get('FLASKY_AVATAR_SOURCE') or 'gravatar'     #头像来源：gravatar 或 local（本站生成的 identicon）
+    FLASKY_AVATAR_SIZES = (32, 40, 100, 256)    #本地头像渲染并缓存的标准尺寸
+    FLASKY_AVATAR_FORMAT = 'svg'        #本地头像的格式：svg，装了 Pillow 时也可以用 png
+    FLASKY_AVATAR_CACHE_DIR = os.path.join(basedir, 'avatars')
+    PHOTO_STORAGE_ROOT = os.environ.get('PHOTO_STORAGE_ROOT') or \
+        os.path.join(basedir, 'photos')     #图片按内容哈希存放的目录
+    PHOTO_CHUNK_SIZE = 64 * 1024        #上传时每次读写的块大小
+    PHOTO_MAX_SIZE = 64 * 1024 * 1024   #分块续传时单个文件的上限
+    PHOTO_UPLOAD_TTL = 24 * 3600        #未完成的上传会话保留的秒数
+    PHOTO_VARIANT_WIDTHS = (160, 320, 640, 1280)    #上传后生成的各个宽度的版本
+    PHOTO_VARIANT_FORMAT = 'jpeg'       #版本的格式：jpeg、webp 或 png
+    PHOTO_VARIANT_WORKERS = None        #生成版本的进程数，None 表示 CPU 核数
+    PHOTO_CACHE_MAX_AGE = 365 * 24 * 3600   #图片内容不会变，浏览器可以一直缓存
+    PHOTO_SENDFILE = os.environ.get('PHOTO_SENDFILE')   #交给前端服务器发送文件：x-sendfile 或 x-accel-redirect
+    PHOTO_ACCEL_PREFIX = '/_photos/'    #nginx 里指向 PHOTO_STORAGE_ROOT 的 internal location
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024   #单个请求（分块续传时是单个分块）的上限
 
 
     @staticmethod
@@ -36,6 +91,8 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    FLASKY_PASSWORD_METHOD = 'pbkdf2:sha256:1000'  #测试时不需要抗暴力破解
+    FLASKY_PASSWORD_WORKERS = 0
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
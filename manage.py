@@ -1,7 +1,7 @@
 #!/user/bin/env python
 import os
 from app import create_app, db
-from app.models import User, Role, Post, Follow, Comment
+from app.models import User, Role, Post, Follow, Comment, TimelineEntry, Photo
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
 
@@ -10,7 +10,8 @@ manager = Manager(app)
 migrate = Migrate(app, db)
 
 def make_shell_context():
-    return dict(app=app, db=db, User=User, Role=Role, Post=Post, Follow=Follow, Comment=Comment)
+    return dict(app=app, db=db, User=User, Role=Role, Post=Post, Follow=Follow, Comment=Comment,
+                TimelineEntry=TimelineEntry, Photo=Photo)
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
@@ -30,6 +31,133 @@ def deploy():
     upgrade()
 
     Role.insert_roles()
+    User.refresh_avatar_hashes()
+    db.session.commit()
+
+    from app import search
+    search.backend.create(db.session.connection())
+    db.session.commit()
+
+@manager.command
+def reconcile_counters():
+    """Recompute denormalized counters."""
+    Post.refresh_comment_counts()
+    User.refresh_counters()
+    db.session.commit()
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+@manager.option('-p', '--processes', dest='processes', type=int, default=None)
+def rerender(batch_size, processes):
+    """Re-render body_html of every post and comment."""
+    from app import renderer
+
+    for model, kind in ((Post, 'post'), (Comment, 'comment')):
+        count = renderer.rerender(model, kind, batch_size=batch_size,
+                                  processes=processes)
+        print('%d %ss rendered' % (count, kind))
+
+@manager.command
+def rebuild_timelines():
+    """Rebuild every user's followed-posts timeline in batches of users."""
+    from app import timeline
+
+    print(timeline.rebuild(db.session))
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+def generate_variants(workers):
+    """Generate resized variants of every stored photo."""
+    from app.photo import storage, variants
+
+    pipeline = variants.pipeline
+    if workers:
+        pipeline.workers = workers
+    digests = [d for d, in db.session.query(Photo.sha256).distinct()]
+    for digest in digests:
+        pipeline.schedule(storage.backend.path(digest), digest)
+    pipeline.join()
+    pipeline.shutdown()
+    print(len(digests))
+
+@manager.option('-u', '--users', dest='users', type=int, default=1000)
+@manager.option('-p', '--posts', dest='posts', type=int, default=10000)
+@manager.option('-f', '--follows', dest='follows', type=int, default=20000)
+@manager.option('-c', '--comments', dest='comments', type=int, default=30000)
+@manager.option('-s', '--seed', dest='seed', type=int, default=None)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=5000)
+@manager.option('--no-index', dest='index', action='store_false', default=True)
+def seed(users, posts, follows, comments, seed, batch_size, index):
+    """Bulk-insert fake users, posts, follows and comments."""
+    import time
+    from app.fake import Seeder
+
+    started = time.time()
+    counts = Seeder(seed, batch_size).run(users, posts, follows, comments, index)
+    print(' '.join('%s=%d' % item for item in sorted(counts.items())),
+          '%.1fs' % (time.time() - started))
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+def reindex(batch_size):
+    """Rebuild the full-text search index."""
+    from app import search
+
+    print(search.reindex(db.session, batch_size))
+    db.session.commit()
+
+def _follow_format(path, format):
+    if format:
+        return format
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+@manager.option('path', help='CSV or JSONL file of follower,followed pairs, - for stdin')
+@manager.option('-f', '--format', dest='format', choices=('csv', 'jsonl'), default=None)
+@manager.option('-k', '--key', dest='key', choices=('id', 'username', 'email'), default='id')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+@manager.option('--unfollow', dest='unfollow', action='store_true', default=False)
+@manager.option('--rebuild-timelines', dest='rebuild', action='store_true', default=False)
+def import_follows(path, format, key, batch_size, unfollow, rebuild):
+    """Bulk follow (or unfollow) from a CSV/JSONL stream of pairs."""
+    import io
+    import sys
+    from app import follow_bulk, timeline
+
+    stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') \
+        if path == '-' else open(path, encoding='utf-8', newline='')
+    errors = []
+    with stream:
+        pairs = follow_bulk.read_pairs(stream, _follow_format(path, format), errors)
+        apply = follow_bulk.unfollow_many if unfollow else follow_bulk.follow_many
+        counts = apply(pairs, key, batch_size, timelines=not rebuild)
+    if rebuild:
+        timeline.rebuild(db.session, batch_size)
+    counts['invalid'] = len(errors)
+    for line, message in errors[:20]:
+        print('line %d: %s' % (line, message), file=sys.stderr)
+    print(' '.join('%s=%d' % item for item in sorted(counts.items())))
+
+@manager.option('path', help='output file, - for stdout')
+@manager.option('-f', '--format', dest='format', choices=('csv', 'jsonl'), default=None)
+@manager.option('-k', '--key', dest='key', choices=('id', 'username', 'email'), default='id')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+def export_follows(path, format, key, batch_size):
+    """Stream every follow as CSV/JSONL pairs."""
+    import sys
+    from app import follow_bulk
+
+    out = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+    try:
+        count = follow_bulk.write_pairs(out, follow_bulk.iter_follows(key, batch_size),
+                                        _follow_format(path, format))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(count, file=sys.stderr)
+
+@manager.command
+def clean_uploads():
+    """Remove unfinished photo uploads older than PHOTO_UPLOAD_TTL."""
+    from app.photo import storage
+
+    print(storage.backend.remove_stale_uploads(app.config['PHOTO_UPLOAD_TTL']))
 
 
 if __name__ == '__main__':
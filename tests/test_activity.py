@@ -0,0 +1,41 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db, activity
+from app.models import User, Role
+
+
+class ActivityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        activity.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat',
+                         last_seen=datetime(2017, 1, 1))
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        activity.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ping_is_buffered(self):
+        self.user.ping()
+        self.assertNotIn(self.user, db.session.dirty)
+        self.assertEqual(activity.flush(), 1)
+        db.session.expire_all()
+        self.assertTrue(self.user.last_seen > datetime(2017, 1, 1))
+
+    def test_pings_within_resolution_do_not_write(self):
+        now = datetime.utcnow()
+        self.assertTrue(activity.record(self.user, now))
+        self.assertFalse(activity.record(self.user, now + timedelta(seconds=30)))
+        self.assertEqual(activity.flush(), 1)
+        self.assertFalse(activity.record(self.user, now + timedelta(seconds=59)))
+        self.assertEqual(activity.flush(), 0)
+        self.assertTrue(activity.record(self.user, now + timedelta(seconds=61)))
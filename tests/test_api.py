@@ -0,0 +1,144 @@
+import gzip
+import json
+import unittest
+from unittest import mock
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from .utils import QueryCountMixin
+
+
+class APITestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat',
+                         confirmed=True)
+        self.susan = User(email='susan@example.com', username='susan', password='dog',
+                          confirmed=True)
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.susan.follow(self.john)
+        for i in range(5):
+            db.session.add(Post(body='post %d' % i, author=self.john))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self, username=None, password='', **extra):
+        headers = {'Accept': 'application/json'}
+        if username is not None:
+            headers['Authorization'] = 'Basic ' + b64encode(
+                (username + ':' + password).encode('utf-8')).decode('utf-8')
+        headers.update(extra)
+        return headers
+
+    def get_json(self, url, **headers):
+        response = self.client.get(url, headers=self.get_api_headers(**headers))
+        return response, json.loads(response.get_data(as_text=True) or 'null')
+
+    def test_errors_are_json(self):
+        response, data = self.get_json('/api/v1.0/posts/999')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['error'], 'not found')
+        response, data = self.get_json('/wrong/url')
+        self.assertEqual(data['error'], 'not found')
+        response, data = self.get_json('/api/v1.0/posts/?fields=id,nope')
+        self.assertEqual(response.status_code, 400)
+
+    def test_token_auth(self):
+        response = self.client.post('/api/v1.0/tokens/',
+                                    headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/v1.0/tokens/',
+                                    headers=self.get_api_headers('susan@example.com', 'dog'))
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.get_data(as_text=True))['token']
+        # 令牌不能换新令牌
+        response = self.client.post('/api/v1.0/tokens/', headers=self.get_api_headers(token))
+        self.assertEqual(response.status_code, 401)
+        url = '/api/v1.0/users/%d/timeline/' % self.susan.id
+        self.assertEqual(self.get_json(url)[0].status_code, 401)
+        response, data = self.get_json(url, Authorization='Bearer ' + token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['posts']), 5)
+        response, data = self.get_json('/api/v1.0/users/%d/timeline/' % self.john.id,
+                                       Authorization='Bearer ' + token)
+        self.assertEqual(response.status_code, 403)
+
+    def test_timeline_owner_checked_before_etag(self):
+        url = '/api/v1.0/users/%d/timeline/' % self.susan.id
+        response, data = self.get_json(url, username='susan@example.com', password='dog')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        # 别人拿着同样的 ETag 来，也不能用 304 确认内容没变
+        response, data = self.get_json(url, username='john@example.com', password='cat',
+                                       **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 403)
+        response, data = self.get_json(url, username='susan@example.com', password='dog',
+                                       **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_cursor_pagination_and_fields(self):
+        response, data = self.get_json('/api/v1.0/posts/?per_page=2&fields=id,body')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['posts'], [{'id': 5, 'body': 'post 4'},
+                                         {'id': 4, 'body': 'post 3'}])
+        self.assertIsNone(data['prev'])
+        seen = [p['id'] for p in data['posts']]
+        while data['next']:
+            self.assertIn('fields=id%2Cbody', data['next'])
+            response, data = self.get_json(data['next'])
+            seen.extend(p['id'] for p in data['posts'])
+        self.assertEqual(seen, [5, 4, 3, 2, 1])
+        response, data = self.get_json('/api/v1.0/users/%d/followers/' % self.john.id)
+        self.assertEqual([u['username'] for u in data['users']], ['susan'])
+        response, data = self.get_json('/api/v1.0/users/%d/following/' % self.john.id)
+        self.assertEqual(data['users'], [])
+
+    def test_etag_short_circuits(self):
+        url = '/api/v1.0/posts/1/comments/'
+        response = self.client.get(url, headers=self.get_api_headers())
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        with self.assertMaxQueries(0):
+            response = self.client.get(url, headers=self.get_api_headers(
+                **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        # 新评论让文章的版本号变化
+        db.session.add(Comment(body='hi', post_id=1, author=self.susan))
+        db.session.commit()
+        response, data = self.get_json(url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['body'] for c in data['comments']], ['hi'])
+
+    def test_etag_expires_after_ttl(self):
+        # 别的进程的提交换不了本进程的版本号，ETag 最多沿用 FLASKY_API_ETAG_TTL 秒
+        self.app.config['FLASKY_API_ETAG_TTL'] = 60
+        with mock.patch('app.api_1_0.responses.time.time', return_value=6000):
+            etag = self.client.get('/api/v1.0/posts/1').headers['ETag']
+            response = self.client.get('/api/v1.0/posts/1',
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+        with mock.patch('app.api_1_0.responses.time.time', return_value=6060):
+            response = self.client.get('/api/v1.0/posts/1',
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+
+    def test_gzip(self):
+        response = self.client.get('/api/v1.0/posts/', headers=self.get_api_headers(
+            **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        data = json.loads(gzip.decompress(response.get_data()).decode('utf-8'))
+        self.assertEqual(len(data['posts']), 5)
+        response = self.client.get('/api/v1.0/posts/1?fields=id',
+                                   headers=self.get_api_headers(**{'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', response.headers)
@@ -0,0 +1,61 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.avatars import AvatarStore, identicon_cells
+from app.models import User, Role
+
+
+class AvatarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.cache_dir = tempfile.mkdtemp()
+        self.app.config['FLASKY_AVATAR_SOURCE'] = 'local'
+        self.app.extensions['avatars'] = AvatarStore(self.cache_dir)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_avatar_hash_follows_email(self):
+        u = User(email='john@example.com', password='cat')
+        self.assertEqual(u.avatar_hash,
+                         hashlib.md5(b'john@example.com').hexdigest())
+        u.email = 'john2@example.com'
+        self.assertEqual(u.avatar_hash,
+                         hashlib.md5(b'john2@example.com').hexdigest())
+
+    def test_identicon_is_symmetric(self):
+        cells = set(identicon_cells(hashlib.md5(b'x').hexdigest()))
+        self.assertEqual(cells, set((4 - col, row) for col, row in cells))
+
+    def test_local_avatar_rendered_once_per_size(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context():
+            url = u.gravatar(size=36)
+        self.assertIn('s=40', url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/svg+xml')
+        self.assertIn(b'width="40"', response.data)
+        self.client.get(url)
+        self.assertEqual(self.app.extensions['avatars'].renders, 1)
+        response = self.client.get(url, headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_hashes_are_not_rendered(self):
+        digest = hashlib.md5(b'nobody@example.com').hexdigest()
+        self.assertEqual(self.client.get('/avatar/%s?s=40' % digest).status_code, 404)
+        self.assertEqual(self.app.extensions['avatars'].renders, 0)
+        self.assertFalse(self.app.extensions['avatars'].cached(digest, 40))
@@ -0,0 +1,76 @@
+import shutil
+import tempfile
+import time
+import unittest
+from app import create_app, db
+from app.cache import MemoryCache, FileSystemCache
+from app.models import User, Role, Post, Comment
+
+
+class CacheBackendTestCase(unittest.TestCase):
+    def test_memory_lru_and_ttl(self):
+        c = MemoryCache(max_entries=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get_many(['a', 'c']), [1, 3])
+        c.set('d', 4, timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(c.get('d'))
+
+    def test_filesystem(self):
+        path = tempfile.mkdtemp()
+        try:
+            c = FileSystemCache(path)
+            c.set('a', {'x': 1})
+            self.assertEqual(FileSystemCache(path).get('a'), {'x': 1})
+            c.delete('a')
+            self.assertIsNone(c.get('a'))
+        finally:
+            shutil.rmtree(path)
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.add(Post(body='first post', author=self.user))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_anonymous_page_cache(self):
+        self.assertEqual(self.client.get('/').headers['X-Cache'], 'MISS')
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertIn(b'first post', response.data)
+
+        db.session.add(Post(body='second post', author=self.user))
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn(b'second post', response.data)
+
+    def test_post_fragment_invalidation(self):
+        self.app.config['FLASKY_CACHE_PAGES'] = False
+        p = Post.query.first()
+        self.assertIn(b'0 Comments', self.client.get('/').data)
+        db.session.add(Comment(body='hi', post=p, author=self.user))
+        db.session.commit()
+        self.assertIn(b'1 Comments', self.client.get('/').data)
+
+        self.user.username = 'johnny'
+        db.session.add(self.user)
+        db.session.commit()
+        self.assertIn(b'/user/johnny', self.client.get('/').data)
@@ -0,0 +1,58 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+
+
+class CounterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat')
+        self.susan = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_follow_counters(self):
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.john.following_count, 1)
+        self.assertEqual(self.john.followers_count, 0)
+        self.assertEqual(self.susan.followers_count, 1)
+        self.john.unfollow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.john.following_count, 0)
+        self.assertEqual(self.susan.followers_count, 0)
+
+    def test_post_and_comment_counters(self):
+        p = Post(body='hello', author=self.susan)
+        db.session.add(p)
+        db.session.add(Comment(body='hi', post=p, author=self.john))
+        db.session.commit()
+        self.assertEqual(self.susan.posts_count, 1)
+        self.assertEqual(self.john.comments_count, 1)
+        db.session.delete(p.comments.first())
+        db.session.commit()
+        self.assertEqual(self.john.comments_count, 0)
+
+    def test_reconcile(self):
+        self.john.follow(self.susan)
+        db.session.add(Post(body='hello', author=self.susan))
+        db.session.commit()
+        db.session.execute(User.__table__.update().values(
+            followers_count=7, following_count=7, posts_count=7,
+            comments_count=7))
+        db.session.commit()
+        User.refresh_counters()
+        db.session.commit()
+        self.assertEqual((self.susan.followers_count, self.susan.posts_count),
+                         (1, 1))
+        self.assertEqual((self.john.following_count, self.john.comments_count),
+                         (1, 0))
@@ -0,0 +1,138 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from flask_mail import Message, Connection
+from app import create_app, mail
+from app.email import MailDispatcher
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.spool = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+        self.app_context.pop()
+
+    def message(self, i):
+        return Message('test %d' % i, sender='a@example.com',
+                       recipients=['b@example.com'], body='hello')
+
+    def test_messages_share_one_connection(self):
+        d = MailDispatcher(self.app, workers=1)
+        with mail.record_messages() as outbox:
+            d.submit_many([self.message(i) for i in range(10)])
+            self.assertTrue(d.join(5))
+        self.assertEqual(len(outbox), 10)
+        metrics = d.metrics()
+        self.assertEqual((metrics['sent'], metrics['connections']), (10, 1))
+        self.assertEqual(metrics['queue_depth'], 0)
+
+    def test_retry_with_backoff(self):
+        calls = []
+        original = Connection.send
+
+        def flaky(connection, msg, *args):
+            calls.append(msg)
+            if len(calls) == 1:
+                raise IOError('connection lost')
+            return original(connection, msg, *args)
+
+        Connection.send = flaky
+        try:
+            d = MailDispatcher(self.app, workers=1, backoff=0.01)
+            with mail.record_messages() as outbox:
+                d.submit(self.message(1))
+                self.assertTrue(d.join(5))
+        finally:
+            Connection.send = original
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(d.metrics()['retried'], 1)
+        self.assertEqual(d.metrics()['connections'], 2)
+
+    def test_retries_do_not_start_threads(self):
+        calls = []
+        original = Connection.send
+        threads = []
+
+        def down(connection, msg, *args):
+            # SMTP 服务器挂了一阵：每封邮件第一次都失败
+            calls.append(msg)
+            threads.append(threading.active_count())
+            if calls.count(msg) == 1:
+                raise IOError('connection refused')
+            return original(connection, msg, *args)
+
+        Connection.send = down
+        try:
+            d = MailDispatcher(self.app, workers=2, backoff=0.01)
+            with mail.record_messages() as outbox:
+                before = threading.active_count()
+                for i in range(20):
+                    d.submit(self.message(i))
+                self.assertTrue(d.join(5))
+        finally:
+            Connection.send = original
+        self.assertEqual(len(outbox), 20)
+        self.assertEqual(d.metrics()['retried'], 20)
+        self.assertEqual(d.metrics()['retry_pending'], 0)
+        self.assertLessEqual(max(threads), before + 2)
+
+    def test_spooled_messages_survive_restart(self):
+        d = MailDispatcher(self.app, spool_dir=self.spool)
+        d._spool(self.message(1))
+        d._spool(self.message(2))
+        restarted = MailDispatcher(self.app, spool_dir=self.spool)
+        with mail.record_messages() as outbox:
+            restarted.start()
+            self.assertTrue(restarted.join(5))
+        self.assertEqual([m.subject for m in outbox], ['test 1', 'test 2'])
+        self.assertEqual([n for n in os.listdir(self.spool) if n != 'failed'], [])
+
+    def test_recover_claims_only_orphaned_files(self):
+        d = MailDispatcher(self.app, spool_dir=self.spool)
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        for i, pid in ((1, dead.pid), (2, os.getppid())):
+            path = d._spool(self.message(i))
+            os.rename(path, path.replace('.%d.sending' % os.getpid(),
+                                         '.%d.sending' % pid))
+        # 另一个进程正在发送 test 2，这里不能再发一次
+        restarted = MailDispatcher(self.app, spool_dir=self.spool)
+        with mail.record_messages() as outbox:
+            restarted.start()
+            self.assertTrue(restarted.join(5))
+        self.assertEqual([m.subject for m in outbox], ['test 1'])
+        self.assertEqual([n.rsplit('.', 2)[1] for n in os.listdir(self.spool)
+                          if n != 'failed'], [str(os.getppid())])
+
+    def test_spool_dir_recovered_at_init(self):
+        MailDispatcher(self.app, spool_dir=self.spool)._spool(self.message(1))
+        self.app.config['FLASKY_MAIL_SPOOL_DIR'] = self.spool
+        from app.email import mail_queue
+        with mail.record_messages() as outbox:
+            mail_queue.init_app(self.app)
+            self.assertTrue(mail_queue.join(5))
+        self.assertEqual([m.subject for m in outbox], ['test 1'])
+
+    def test_bulk_mail_rendered_in_worker(self):
+        d = MailDispatcher(self.app, workers=1)
+        self.assertGreater(d.templates.precompile(), 0)
+        recipients = [('u%d@example.com' % i, {'user': {'username': 'u%d' % i},
+                                               'token': 't%d' % i})
+                      for i in range(3)]
+        with mail.record_messages() as outbox:
+            d.submit_batch('Confirm', 'auth/email/confirm', recipients,
+                           url_root='http://example.com/')
+            self.assertTrue(d.join(5))
+        self.assertEqual([m.recipients for m in outbox],
+                         [['u0@example.com'], ['u1@example.com'], ['u2@example.com']])
+        self.assertIn('u1', outbox[1].body)
+        self.assertIn('http://example.com/auth/confirm/t1', outbox[1].html)
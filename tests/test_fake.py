@@ -0,0 +1,67 @@
+import unittest
+from datetime import datetime
+from app import create_app, db, renderer
+from app.fake import Seeder
+from app.models import User, Role, Post, Comment, Follow
+
+
+class SeederTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.reset()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def reset(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+
+    def seed(self):
+        counts = Seeder(42, batch_size=50, now=datetime(2020, 1, 1)).run(
+            users=30, posts=100, follows=200, comments=150)
+        return counts, db.session.query(Post.author_id, Post.body, Post.timestamp) \
+            .order_by(Post.id).all()
+
+    def test_deterministic_and_consistent(self):
+        counts, posts = self.seed()
+        self.assertEqual(counts, {'users': 30, 'posts': 100, 'follows': 200,
+                                  'comments': 150})
+        self.assertEqual(Follow.query.filter(
+            Follow.follower_id == Follow.followed_id).count(), 0)
+        p = Post.query.first()
+        self.assertEqual(p.body_html, renderer.render('post', p.body))
+        for c in Comment.query:
+            self.assertEqual(c.body_html, renderer.render('comment', c.body))
+        self.assertEqual(p.comment_count, p.comments.count())
+        u = User.query.order_by(User.followers_count.desc()).first()
+        self.assertEqual(u.followers_count, u.who_followed_me.count())
+        self.assertTrue(u.verify_password('password'))
+
+        self.reset()
+        self.assertEqual(self.seed(), (counts, posts))
+
+    def test_same_seed_same_rows(self):
+        def dump():
+            Seeder(7, batch_size=50).run(users=10, posts=30, follows=40, comments=30)
+            rows = []
+            for model in (User, Post, Follow, Comment):
+                # 密码散列带随机盐，不算在内
+                columns = [c for c in model.__table__.c if c.name != 'password_hash']
+                rows.append(db.session.execute(db.select(columns).order_by(
+                    *model.__table__.primary_key.columns)).fetchall())
+            return rows
+        first = dump()
+        self.reset()
+        self.assertEqual(dump(), first)
+
+    def test_generate_fake_adds_comments(self):
+        Seeder(1).run(users=5, posts=5)
+        Comment.generate_fake(10, seed=1)
+        self.assertEqual(Comment.query.count(), 10)
@@ -0,0 +1,145 @@
+import io
+import unittest
+from datetime import datetime
+from app import create_app, db, follow_bulk
+from app.models import User, Role, Post, Follow, TimelineEntry
+from .utils import QueryCountMixin
+
+
+class FollowBulkTestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_CACHE_PAGES'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.users = [User(email='u%d@example.com' % i, username='u%d' % i,
+                           password='cat', confirmed=True) for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.add(Post(body='hello', author=self.users[1]))
+        db.session.commit()
+        self.users[0].follow(self.users[2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def pairs(self):
+        return set(db.session.query(Follow.follower_id, Follow.followed_id))
+
+    def test_import_dedupes_and_updates_counters(self):
+        u = self.users
+        data = io.StringIO(
+            'follower,followed,timestamp\n'
+            'u0,u1,2015-01-02T03:04:05\n'
+            'u0,u1,\n'         # 批内重复
+            'u0,u2,\n'         # 已经关注
+            'u3,u3,\n'         # 关注自己
+            'u3,nobody,\n'
+            'u3,u1,\n'
+            'u4,u0,\n')
+        with self.assertMaxQueries(30):
+            stats = follow_bulk.follow_many(follow_bulk.read_pairs(data), 'username',
+                                            batch_size=4)
+        self.assertEqual(stats, {'read': 7, 'inserted': 3, 'existing': 1, 'duplicate': 1,
+                                 'self': 1, 'unknown': 1})
+        self.assertEqual(self.pairs(), set([(u[0].id, u[1].id), (u[0].id, u[2].id),
+                                            (u[3].id, u[1].id), (u[4].id, u[0].id)]))
+        f = Follow.query.get((u[0].id, u[1].id))
+        self.assertEqual(f.timestamp, datetime(2015, 1, 2, 3, 4, 5))
+        db.session.expire_all()
+        self.assertEqual(u[0].following_count, 2)
+        self.assertEqual(u[1].followers_count, 2)
+        self.assertTrue(u[0].is_following(u[1]))
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[3].id).count(), 1)
+
+    def test_match_is_exact(self):
+        u = self.users
+        # u0 -> u2 已存在，但不在要查的两对里（两个 IN 的笛卡尔积会把它查出来）
+        pairs = [(u[0].id, u[1].id), (u[3].id, u[2].id)]
+        self.assertEqual(db.session.query(Follow).filter(Follow.match(pairs)).all(), [])
+        pairs.append((u[0].id, u[2].id))
+        self.assertEqual(db.session.query(Follow.follower_id, Follow.followed_id)
+                         .filter(Follow.match(pairs)).all(), [(u[0].id, u[2].id)])
+
+    def test_backfill_is_per_pair(self):
+        u = self.users
+        self.app.config['FLASKY_TIMELINE_BACKFILL'] = 2
+        for i in range(3):
+            db.session.add(Post(body='more %d' % i, author=u[1]))
+        db.session.add(Post(body='from u2', author=u[2]))
+        db.session.commit()
+        before = TimelineEntry.query.filter_by(user_id=u[0].id).count()
+        # 一批里的关注只补各自作者最新的 2 篇，u0 原来关注 u2 的时间线不受影响
+        with self.assertMaxQueries(12):
+            follow_bulk.follow_many([(u[0].id, u[1].id, None), (u[3].id, u[2].id, None),
+                                     (u[4].id, u[1].id, None)])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[0].id).count(),
+                         before + 2)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[3].id).count(), 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[4].id).count(), 2)
+        follow_bulk.unfollow_many([(u[0].id, u[1].id, None), (u[4].id, u[2].id, None)])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[0].id).count(), before)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u[4].id).count(), 2)
+
+    def test_malformed_rows(self):
+        u = self.users
+        data = ('follower,followed,timestamp\n'
+                'u0,u1,\n'
+                ',u1,\n'
+                'u3,u1,yesterday\n'
+                'u4,u1,,extra\n'
+                'u4,u0,\n')
+        with self.assertRaisesRegex(ValueError, '^line 3: '):
+            list(follow_bulk.read_pairs(io.StringIO(data)))
+        errors = []
+        stats = follow_bulk.follow_many(follow_bulk.read_pairs(io.StringIO(data),
+                                                               errors=errors),
+                                        'username')
+        self.assertEqual([line for line, message in errors], [3, 4, 5])
+        self.assertEqual((stats['read'], stats['inserted']), (2, 2))
+        # 修好后重跑同一个文件，已导入的行算作 existing
+        fixed = data.replace('\n,u1', '\nu2,u1').replace('yesterday', '') \
+            .replace(',extra', '')
+        stats = follow_bulk.follow_many(follow_bulk.read_pairs(io.StringIO(fixed)),
+                                        'username')
+        self.assertEqual((stats['inserted'], stats['existing']), (3, 2))
+        errors = []
+        rows = list(follow_bulk.read_pairs(io.StringIO(
+            '[%d, %d]\n{"follower": 1}\nnope\n[true, 2]\n[[1], 2]\n' % (u[0].id, u[1].id)),
+            'jsonl', errors))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual([line for line, message in errors], [2, 3, 4, 5])
+        with self.assertRaisesRegex(ValueError, 'missing columns: followed'):
+            list(follow_bulk.read_pairs(io.StringIO('follower,target\n1,2\n')))
+
+    def test_unfollow(self):
+        u = self.users
+        data = io.StringIO('[%d, %d]\n[%d, %d]\n' % (u[0].id, u[2].id, u[0].id, u[1].id))
+        stats = follow_bulk.unfollow_many(follow_bulk.read_pairs(data, 'jsonl'))
+        self.assertEqual((stats['deleted'], stats['missing']), (1, 1))
+        self.assertEqual(self.pairs(), set())
+        db.session.expire_all()
+        self.assertEqual((u[0].following_count, u[2].followers_count), (0, 0))
+
+    def test_export_round_trip(self):
+        u = self.users
+        follow_bulk.follow_many([(a.id, b.id, None) for a in u for b in u])
+        expected = self.pairs()
+        self.assertEqual(len(expected), 20)
+        out = io.StringIO()
+        with self.assertMaxQueries(5):
+            count = follow_bulk.write_pairs(out, follow_bulk.iter_follows(batch_size=6),
+                                            'jsonl')
+        self.assertEqual(count, 20)
+        out.seek(0)
+        self.assertEqual(follow_bulk.unfollow_many(
+            follow_bulk.read_pairs(out, 'jsonl'))['deleted'], 20)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        out.seek(0)
+        stats = follow_bulk.follow_many(follow_bulk.read_pairs(out, 'jsonl'))
+        self.assertEqual(stats['inserted'], 20)
+        self.assertEqual(self.pairs(), expected)
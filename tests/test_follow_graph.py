@@ -0,0 +1,97 @@
+import unittest
+from app import create_app, db, follow_graph
+from app.models import User, Role
+from .utils import QueryCountMixin
+
+
+class FollowGraphTestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_FOLLOW_CACHE_THRESHOLD'] = 3
+        self.app.config['FLASKY_CACHE_PAGES'] = False
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        follow_graph.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.users = [User(email='u%d@example.com' % i, username='u%d' % i,
+                           password='cat', confirmed=True) for i in range(6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        u = self.users
+        # u0 -> u1, u2；u1 -> u0, u3, u4；u2 -> u3
+        for a, b in [(0, 1), (0, 2), (1, 0), (1, 3), (1, 4), (2, 3)]:
+            u[a].follow(u[b])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def ids(self, *indexes):
+        return set(self.users[i].id for i in indexes)
+
+    def test_batched_checks(self):
+        u = self.users
+        everyone = [x.id for x in u]
+        with self.assertMaxQueries(1):
+            self.assertEqual(follow_graph.is_following_many(u[0], everyone), self.ids(1, 2))
+        with self.assertMaxQueries(1):
+            self.assertEqual(follow_graph.followed_by_many(u[0], everyone), self.ids(1))
+        self.assertEqual(follow_graph.relationship(u[0], u[1]), (True, True))
+        self.assertEqual(follow_graph.relationship(u[0], u[3]), (False, False))
+        self.assertTrue(u[2].is_followed_by(u[0]))
+
+    def test_graph_queries(self):
+        u = self.users
+        self.assertEqual(follow_graph.mutual(u[0]), [u[1].id])
+        self.assertEqual(set(follow_graph.known_followers(u[0], u[3])), self.ids(1, 2))
+        # u0 关注的 u1、u2 都关注了 u3，u4 只有 u1 关注
+        self.assertEqual(follow_graph.suggestions(u[0]), [(u[3].id, 2), (u[4].id, 1)])
+        self.assertEqual(follow_graph.suggested_users(u[0], 1), [u[3]])
+
+    def test_hot_accounts_are_cached_and_invalidated(self):
+        u = self.users
+        hot = u[1]      # 关注了 3 个人，达到阈值
+        everyone = [x.id for x in u]
+        self.assertEqual(follow_graph.is_following_many(hot, everyone), self.ids(0, 3, 4))
+        with self.assertMaxQueries(0):
+            self.assertEqual(follow_graph.is_following_many(hot, everyone),
+                             self.ids(0, 3, 4))
+        hot.follow(u[5])
+        self.assertTrue(hot.is_following(u[5]))     # 还没提交也能看到
+        db.session.commit()
+        self.assertEqual(follow_graph.is_following_many(hot, everyone),
+                         self.ids(0, 3, 4, 5))
+        hot.unfollow(u[0])
+        db.session.commit()
+        self.assertEqual(follow_graph.is_following_many(hot, everyone),
+                         self.ids(3, 4, 5))
+
+    def test_follow_checks_database_not_cache(self):
+        from app.models import Follow
+        u = self.users
+        hot = u[1]
+        everyone = [x.id for x in u]
+        self.assertEqual(follow_graph.is_following_many(hot, everyone), self.ids(0, 3, 4))
+        # 别的进程提交的关注，本进程的缓存还不知道
+        db.session.execute(Follow.__table__.insert(),
+                           {'follower_id': hot.id, 'followed_id': u[5].id})
+        db.session.commit()
+        self.assertFalse(hot.follow(u[5]))
+        db.session.commit()
+
+    def test_follower_list_shows_follow_back(self):
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'email': 'u0@example.com',
+                                              'password': 'cat'})
+        with self.assertMaxQueries(8):
+            response = self.client.get('/followed_by/u3')
+        self.assertIn(b'Following', response.data)
+        response = self.client.get('/followed_by/u0')
+        self.assertIn(b'Follows you', response.data)
+        self.assertEqual(self.client.get('/follow/u1').status_code, 302)
+        self.assertEqual(self.client.get('/follow/u3').status_code, 302)
+        self.assertTrue(self.users[0].is_following(self.users[3]))
@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db, metrics
+from app.models import Role
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_request_latency_histogram(self):
+        self.client.get('/')
+        self.client.get('/')
+        text = self.scrape()
+        self.assertIn('# TYPE flasky_http_request_duration_seconds histogram', text)
+        self.assertIn('flasky_http_request_duration_seconds_count'
+                      '{blueprint="main",endpoint="main.index"} 2', text)
+        self.assertIn('flasky_http_request_duration_seconds_bucket'
+                      '{blueprint="main",endpoint="main.index",le="+Inf"} 2', text)
+        self.assertIn('flasky_http_requests_total'
+                      '{endpoint="main.index",method="GET",status="200"} 2', text)
+        self.assertIn('flasky_cache_hits_total{cache="cache"}', text)
+        self.assertIn('flasky_mail_queue_depth 0', text)
+
+    def test_remote_addresses_are_refused(self):
+        response = self.client.get('/metrics',
+                                   environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_token_is_required_when_set(self):
+        # 反向代理后面所有请求都来自 127.0.0.1，只能靠令牌
+        self.app.config['FLASKY_METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_processes_are_aggregated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['FLASKY_METRICS_DIR'] = directory
+        metrics.init_app(self.app)
+        metrics.inc('flasky_uploads_total', 2)
+        # 另一个已经退出的进程留下的文件：计数器相加，瞬时值丢弃
+        other = metrics.registry.snapshot()
+        other['pid'] = 2 ** 22 + 1
+        other['gauges'] = [['flasky_mail_queue_depth', [], 7],
+                           ['flasky_mail_sent_total', [], 3]]
+        with open(os.path.join(directory, '%d.json' % other['pid']), 'w') as f:
+            json.dump(other, f)
+        text = self.scrape()
+        self.assertIn('flasky_uploads_total 4', text)
+        self.assertIn('flasky_mail_queue_depth{pid="%d"} 0' % os.getpid(), text)
+        self.assertNotIn('pid="%d"' % other['pid'], text)
+        self.assertIn('flasky_mail_sent_total 3', text)
+
+    def test_gauges_are_labelled_by_pid(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['FLASKY_METRICS_DIR'] = directory
+        metrics.init_app(self.app)
+        # 还活着的另一个进程（这里借用父进程），连接池大小不能和本进程的相加
+        other = metrics.registry.snapshot()
+        other['pid'] = os.getppid()
+        other['counters'] = other['histograms'] = []
+        other['gauges'] = [['flasky_db_pool_size', [], 5]]
+        with open(os.path.join(directory, '%d.json' % other['pid']), 'w') as f:
+            json.dump(other, f)
+        text = self.scrape()
+        self.assertIn('flasky_db_pool_size{pid="%d"} 5' % other['pid'], text)
@@ -0,0 +1,88 @@
+import unittest
+from app import create_app, db, search
+from app.models import User, Role, Post, Comment
+from .utils import QueryCountMixin
+
+
+class ModerationTestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        moderator = Role.query.filter_by(name='Moderator').first()
+        self.mod = User(email='mod@example.com', username='mod', password='cat',
+                        confirmed=True, role=moderator)
+        db.session.add(self.mod)
+        self.post = Post(body='hello', author=self.mod)
+        db.session.add(self.post)
+        self.comments = [Comment(body='comment%d' % i, post=self.post, author=self.mod)
+                         for i in range(5)]
+        db.session.add_all(self.comments)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        self.client.post('/auth/login', data={'email': 'mod@example.com',
+                                              'password': 'cat'})
+
+    def test_new_comments_are_pending_and_visible(self):
+        self.assertIsNone(self.comments[0].disabled)
+        self.assertEqual(self.post.comment_count, 5)
+        self.assertEqual(Comment.query.filter(Comment.pending()).count(), 5)
+
+    def test_bulk_moderation_is_one_update(self):
+        ids = [c.id for c in self.comments[:3]]
+        with self.assertMaxQueries(4):
+            self.assertEqual(Comment.moderate(ids, True), 3)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(self.post.comment_count, 2)
+        self.assertEqual(search.query('comment', 'comment1').items, [])
+        # 已经是这个状态的评论不算
+        self.assertEqual(Comment.moderate(ids + [self.comments[3].id], True), 1)
+        self.assertEqual(Comment.moderate(ids, False), 3)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(self.post.comment_count, 4)
+        self.assertIs(self.comments[0].disabled, False)
+        self.assertEqual(search.query('comment', 'comment1').items,
+                         [self.comments[1].id])
+
+    def test_single_toggle_keeps_count(self):
+        c = self.comments[0]
+        c.disabled = True
+        db.session.commit()
+        self.assertEqual(self.post.comment_count, 4)
+        db.session.expire(c)
+        c.disabled = True       # 旧值没有加载时重新数
+        db.session.commit()
+        self.assertEqual(self.post.comment_count, 4)
+        db.session.delete(c)
+        db.session.commit()
+        self.assertEqual(self.post.comment_count, 4)
+        Post.refresh_comment_counts()
+        db.session.commit()
+        self.assertEqual(self.post.comment_count, 4)
+
+    def test_queue_view(self):
+        self.login()
+        response = self.client.get('/moderate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'name="ids"'), 5)
+        ids = [str(c.id) for c in self.comments[:2]]
+        response = self.client.post('/moderate?state=pending',
+                                    data={'action': 'disable', 'ids': ids})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/moderate')
+        self.assertEqual(response.data.count(b'name="ids"'), 3)
+        response = self.client.get('/moderate?state=disabled')
+        self.assertEqual(response.data.count(b'name="ids"'), 2)
+        self.assertEqual(self.client.get('/moderate?state=bogus').status_code, 404)
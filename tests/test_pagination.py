@@ -0,0 +1,111 @@
+import base64
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Role, Post
+from app.pagination import keyset_paginate, keyset_tail, encode_cursor, decode_cursor, \
+    CountCache
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        start = datetime(2017, 1, 1)
+        # 两篇文章时间相同，用 id 区分先后
+        for i in range(7):
+            db.session.add(Post(body='post %d' % i, author=u,
+                                timestamp=start + timedelta(minutes=i // 2)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, **kwargs):
+        return keyset_paginate(Post.query, (Post.timestamp, Post.id),
+                               per_page=3, **kwargs)
+
+    def test_cursor_round_trip(self):
+        values = (datetime(2017, 1, 2, 3, 4, 5, 6), 42)
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+        self.assertIsNone(decode_cursor('not a cursor'))
+
+    def test_malformed_cursors_are_rejected(self):
+        one = encode_cursor((42,))
+        nested = base64.urlsafe_b64encode(b'[["v",{"a":1}],["v",2]]').decode('ascii')
+        self.assertIsNone(decode_cursor(one, 2))
+        self.assertIsNone(decode_cursor(nested))
+        self.assertIsNone(decode_cursor(base64.urlsafe_b64encode(b'{"v":1}').decode('ascii')))
+        # 游标不对时当作第一页
+        self.assertEqual([p.id for p in self.paginate(after=one).items],
+                         [p.id for p in self.paginate().items])
+        self.assertEqual(self.paginate(before=nested).items, self.paginate().items)
+        client = self.app.test_client()
+        self.assertEqual(client.get('/?after=' + one).status_code, 200)
+        response = client.get('/api/v1.0/posts/?after=' + one)
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/api/v1.0/posts/1/comments/?before=' + nested)
+        self.assertEqual(response.status_code, 400)
+
+    def test_walk_forward_and_back(self):
+        expected = [p.id for p in Post.query.order_by(
+            Post.timestamp.desc(), Post.id.desc()).all()]
+        seen = []
+        page = self.paginate()
+        self.assertFalse(page.has_prev)
+        pages = [page]
+        while True:
+            seen.extend(p.id for p in page.items)
+            if not page.has_next:
+                break
+            page = self.paginate(after=page.next_cursor)
+            pages.append(page)
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(pages), 3)
+
+        back = self.paginate(before=pages[-1].prev_cursor)
+        self.assertEqual([p.id for p in back.items],
+                         [p.id for p in pages[-2].items])
+        first = self.paginate(before=back.prev_cursor)
+        self.assertEqual([p.id for p in first.items],
+                         [p.id for p in pages[0].items])
+        self.assertFalse(first.has_prev)
+        self.assertTrue(first.has_next)
+
+    def test_tail_pages(self):
+        columns = (Post.timestamp, Post.id)
+        ascending = Post.query.order_by(Post.timestamp, Post.id).all()
+        last = keyset_tail(Post.query, columns, per_page=3)
+        self.assertEqual(last.items, ascending[-3:])
+        self.assertFalse(last.has_next)
+        anchor = ascending[3]
+        page = keyset_tail(Post.query, columns, until=(anchor.timestamp, anchor.id),
+                           per_page=3)
+        self.assertEqual(page.items, ascending[1:4])
+        # 游标可以接着用升序的 keyset_paginate 翻页
+        following = keyset_paginate(Post.query, columns, after=page.next_cursor,
+                                    per_page=3, descending=False)
+        self.assertEqual(following.items, ascending[4:7])
+        previous = keyset_paginate(Post.query, columns, before=page.prev_cursor,
+                                   per_page=3, descending=False)
+        self.assertEqual(previous.items, ascending[:1])
+
+    def test_count_cache_is_bounded(self):
+        counts = CountCache(max_size=3)
+        for i in range(10):
+            self.assertEqual(counts.get('followed_posts:%d' % i, Post.query), 7)
+        self.assertEqual(len(counts), 3)
+        # 最近用过的留下，过期的先丢
+        counts.get('followed_posts:7', Post.query)
+        counts.get('short', Post.query, ttl=-1)
+        counts.get('other', Post.query)
+        self.assertEqual(len(counts), 3)
+        self.assertIn('followed_posts:7', counts._counts)
+        self.assertNotIn('short', counts._counts)
@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.photo.storage import PhotoStorage, OffsetMismatch, UploadBusy, UploadTooLarge
+from app.photo.variants import Image, VariantPipeline, make_variants, variant_path
+from app.models import Photo
+
+
+class PhotoStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = PhotoStorage(self.root, chunk_size=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_identical_uploads_stored_once(self):
+        data = b'not really a png'
+        digest, size = self.storage.save(io.BytesIO(data))
+        self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(size, len(data))
+        self.assertEqual(self.storage.save(io.BytesIO(data)), (digest, size))
+        self.assertTrue(self.storage.path(digest).startswith(
+            os.path.join(self.root, 'objects', digest[:2], digest[2:4])))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'tmp')), [])
+
+    def test_resumable_upload(self):
+        upload_id = self.storage.start_upload(filename='a.png', size=6)
+        self.assertEqual(self.storage.append(upload_id, 0, io.BytesIO(b'abc')), 3)
+        with self.assertRaises(OffsetMismatch) as cm:
+            self.storage.append(upload_id, 0, io.BytesIO(b'abc'))
+        self.assertEqual(cm.exception.offset, 3)
+        self.storage.append(upload_id, 3, io.BytesIO(b'def'))
+        self.assertEqual(self.storage.upload_info(upload_id)['offset'], 6)
+        with self.assertRaises(UploadTooLarge):
+            self.storage.append(upload_id, 6, io.BytesIO(b'g'))
+        digest, size = self.storage.finish_upload(upload_id)
+        self.assertEqual(digest, hashlib.sha256(b'abcdef').hexdigest())
+        self.assertIsNone(self.storage.upload_info(upload_id))
+        with self.assertRaises(KeyError):
+            self.storage.append(upload_id, 6, io.BytesIO(b'g'))
+
+    def test_concurrent_append_is_rejected(self):
+        upload_id = self.storage.start_upload(filename='a.png', size=6)
+        with self.storage._locked(upload_id):
+            with self.assertRaises(UploadBusy):
+                self.storage.append(upload_id, 0, io.BytesIO(b'abc'))
+        self.assertEqual(self.storage.append(upload_id, 0, io.BytesIO(b'abc')), 3)
+
+
+class VariantTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_choose_smallest_sufficient_width(self):
+        pipeline = VariantPipeline(self.root, (640, 160, 320))
+        self.assertEqual([pipeline.choose(w) for w in (100, 161, 640, 641)],
+                         [160, 320, 640, None])
+        self.assertIsNone(pipeline.find('0' * 64, 100))
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_make_variants_skips_upscaling(self):
+        source = os.path.join(self.root, 'source.png')
+        Image.new('RGB', (400, 300), 'red').save(source)
+        digest = '0' * 64
+        self.assertEqual(make_variants(source, self.root, digest, (160, 320, 640)),
+                         [320, 160])
+        image = Image.open(variant_path(self.root, digest, 160))
+        self.assertEqual(image.size, (160, 120))
+
+
+class PhotoViewsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.root = tempfile.mkdtemp()
+        self.app.extensions['photo_storage'] = PhotoStorage(self.root)
+        self.app.extensions['photo_variants'] = VariantPipeline(self.root, (160, 320))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.root)
+
+    def test_form_upload(self):
+        response = self.client.post('/photo/', data={
+            'file': (io.BytesIO(b'GIF89a data'), 'cat.gif')})
+        self.assertEqual(response.status_code, 200)
+        photo = Photo.query.one()
+        self.assertEqual((photo.filename, photo.size), ('cat.gif', 11))
+        response = self.client.get('/photo/uploads/%s' % photo.sha256)
+        self.assertEqual(response.data, b'GIF89a data')
+        # 没有合适的缩略图时返回原图
+        response = self.client.get('/photo/uploads/%s?w=160' % photo.sha256)
+        self.assertEqual(response.data, b'GIF89a data')
+
+    def test_type_comes_from_content(self):
+        html = b'<script>alert(1)</script>'
+        self.client.post('/photo/', data={
+            'file': (io.BytesIO(html), 'x.png', 'text/html')})
+        self.assertEqual(Photo.query.count(), 0)
+        digest = hashlib.sha256(html).hexdigest()
+        self.assertFalse(os.path.exists(self.app.extensions['photo_storage'].path(digest)))
+        self.assertEqual(self.client.get('/photo/uploads/%s' % digest).status_code, 404)
+        # 声明的类型不算数，按文件头给 image/png
+        self.client.post('/photo/', data={
+            'file': (io.BytesIO(b'\x89PNG\r\n\x1a\n' + html), 'x.png', 'text/html')})
+        photo = Photo.query.one()
+        self.assertEqual(photo.content_type, 'image/png')
+        response = self.client.get('/photo/uploads/%s' % photo.sha256)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertEqual(response.headers['X-Content-Type-Options'], 'nosniff')
+
+    def test_chunked_upload(self):
+        response = self.client.post('/photo/resumable', data={
+            'filename': 'big.jpg', 'size': '10', 'content_type': 'text/html'})
+        self.assertEqual(response.status_code, 201)
+        url = response.headers['Location']
+        response = self.client.put(url, data=b'\xff\xd8\xff34',
+                                   headers={'Content-Range': 'bytes 0-4/10'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put(url, data=b'56789',
+                                   headers={'Content-Range': 'bytes 0-4/10'})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.put(url, data=b'56789',
+                                   headers={'Content-Range': 'bytes 5-9/10'})
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.query.one()
+        self.assertEqual(photo.sha256, hashlib.sha256(b'\xff\xd8\xff3456789').hexdigest())
+        self.assertEqual(photo.content_type, 'image/jpeg')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_conditional_and_range_requests(self):
+        self.client.post('/photo/', data={
+            'file': (io.BytesIO(b'\x89PNG\r\n\x1a\n01'), 'a.png')})
+        digest = Photo.query.one().sha256
+        url = '/photo/uploads/%s' % digest
+        response = self.client.get(url)
+        self.assertEqual(response.headers['ETag'], '"%s"' % digest)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response = self.client.get(url, headers={'If-None-Match': '"%s"' % digest})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers={'Range': 'bytes=2-4'})
+        self.assertEqual((response.status_code, response.data), (206, b'NG\r'))
+        # 缩略图还没有时给的原图不能长期缓存
+        response = self.client.get(url + '?w=160')
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+
+    def test_accel_redirect(self):
+        self.app.config['PHOTO_SENDFILE'] = 'x-accel-redirect'
+        self.client.post('/photo/', data={'file': (io.BytesIO(b'GIF89a'), 'a.gif')})
+        digest = Photo.query.one().sha256
+        response = self.client.get('/photo/uploads/%s' % digest)
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/_photos/objects/%s/%s/%s' % (digest[:2], digest[2:4], digest))
+        self.assertEqual(response.data, b'')
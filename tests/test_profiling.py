@@ -0,0 +1,59 @@
+import unittest
+from app import create_app, db, profiler
+from app.models import User, Role, Post
+from app.profiling import signature
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_PROFILE'] = True
+        self.app.config['FLASKY_CACHE_PAGES'] = False
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        profiler.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        admin = Role.query.filter_by(permissions=0xff).first()
+        self.admin = User(email='admin@example.com', username='admin', password='cat',
+                          confirmed=True, role=admin)
+        db.session.add(self.admin)
+        for i in range(3):
+            db.session.add(Post(body='post %d' % i, author=self.admin))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_signature_collapses_in_lists(self):
+        self.assertEqual(signature('SELECT *\n  FROM posts WHERE id IN (?, ?, ?)'),
+                         signature('SELECT * FROM posts WHERE id IN (?)'))
+
+    def test_headers_and_stats(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('sql;dur=', response.headers['Server-Timing'])
+        self.assertTrue(int(response.headers['X-Query-Count']) > 0)
+        row = profiler.stats.endpoint_table()[0]
+        self.assertEqual(row['endpoint'], 'main.index')
+        self.assertEqual(row['count'], 1)
+        self.assertTrue(row['template_ms'] > 0)
+        self.assertEqual(profiler.stats.slowest_requests()[0]['path'], '/')
+
+    def test_disabled(self):
+        self.app.config['FLASKY_PROFILE'] = False
+        response = self.client.get('/')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(profiler.stats.endpoint_table(), [])
+
+    def test_debug_page_is_admin_only(self):
+        self.assertEqual(self.client.get('/debug/profile').status_code, 302)
+        self.client.post('/auth/login', data={'email': 'admin@example.com',
+                                              'password': 'cat'})
+        response = self.client.get('/debug/profile?sort=queries')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'auth.login', response.data)
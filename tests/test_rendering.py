@@ -0,0 +1,86 @@
+import threading
+import unittest
+from app import create_app, db, renderer, cache
+from app.models import User, Role, Post, Comment
+from app.rendering import MarkdownRenderer, POST_TAGS
+
+
+class RenderingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.config['FLASKY_RENDER_ASYNC'] = False
+        renderer.join()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render_is_cached_and_sanitized(self):
+        r = MarkdownRenderer(POST_TAGS, cache_size=2)
+        html = r.render('**bold** <script>x</script> http://example.com')
+        self.assertIn('<strong>bold</strong>', html)
+        self.assertNotIn('<script>', html)
+        self.assertIn('<a href="http://example.com" rel="nofollow">', html)
+        self.assertEqual(r.render('**bold** <script>x</script> http://example.com'), html)
+        self.assertEqual((r.hits, r.misses), (1, 1))
+        r.render('a')
+        r.render('b')
+        self.assertEqual(len(r._cache), 2)
+
+    def test_threads_render_independently(self):
+        r = MarkdownRenderer(POST_TAGS, cache_size=0)
+        texts = ['*%d* see http://example.com/%d and <b>x</b>' % (i, i) for i in range(8)]
+        expected = [r.render(text) for text in texts]
+        results = [[] for text in texts]
+
+        def work(i):
+            for _ in range(30):
+                results[i].append(r.render(texts[i]))
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(texts))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i, html in enumerate(expected):
+            self.assertEqual(set(results[i]), set([html]))
+
+    def test_body_html_set_on_write(self):
+        p = Post(body='# title', author=self.user)
+        c = Comment(body='# title', post=p, author=self.user)
+        self.assertEqual(p.body_html, '<h1>title</h1>')
+        self.assertEqual(c.body_html, 'title')
+
+    def test_async_rendering(self):
+        self.app.config['FLASKY_RENDER_ASYNC'] = True
+        renderer.start_workers(self.app)
+        p = Post(body='*hi*', author=self.user)
+        db.session.add(p)
+        db.session.commit()
+        renderer.join()
+        db.session.expire_all()
+        self.assertEqual(p.body_html, '<p><em>hi</em></p>')
+        # 后台写回 body_html 不经过 session，要自己让文章的缓存（和 API 的 ETag）失效
+        version = cache.versions('post:%d' % p.id)
+        renderer._queue.put(('post', Post.__table__, p.id, p.body, ['post:%d' % p.id]))
+        renderer.join()
+        self.assertNotEqual(cache.versions('post:%d' % p.id), version)
+
+    def test_rerender(self):
+        p = Post(body='*hi*', author=self.user)
+        db.session.add(p)
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(body_html=None))
+        db.session.commit()
+        version = cache.versions('post:%d' % p.id)
+        self.assertEqual(renderer.rerender(Post, 'post', processes=2), 1)
+        db.session.expire_all()
+        self.assertEqual(p.body_html, '<p><em>hi</em></p>')
+        self.assertNotEqual(cache.versions('post:%d' % p.id), version)
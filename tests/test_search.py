@@ -0,0 +1,103 @@
+import unittest
+from app import create_app, db, search
+from app.models import User, Role, Post, Comment
+from app.search import tokenize
+
+
+class SearchTestCase(unittest.TestCase):
+    backend = 'fts5'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_SEARCH_BACKEND'] = self.backend
+        search.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat',
+                         about_me='I like flask')
+        db.session.add(self.john)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u'Flask 很好用'), ['flask', u'很好', u'好用'])
+
+    def test_incremental_index(self):
+        p = Post(body='python flask tutorial', author=self.john)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(search.query('post', 'Flask').items, [p.id])
+        p.body = 'django tutorial'
+        db.session.commit()
+        self.assertEqual(search.query('post', 'flask').items, [])
+        self.assertEqual(search.query('post', 'django').items, [p.id])
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(search.query('post', 'django').items, [])
+
+    def test_rollback_discards_index_changes(self):
+        db.session.add(Post(body='rolled back', author=self.john))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(search.query('post', 'rolled').items, [])
+
+    def test_disabled_comments_and_users(self):
+        p = Post(body='post', author=self.john)
+        c = Comment(body='spam spam', post=p, author=self.john)
+        db.session.add_all([p, c])
+        db.session.commit()
+        self.assertEqual(search.query('comment', 'spam').items, [c.id])
+        c.disabled = True
+        db.session.commit()
+        self.assertEqual(search.query('comment', 'spam').items, [])
+        self.assertEqual(search.query('user', 'flask').items, [self.john.id])
+
+    def test_ranking_and_cursor(self):
+        posts = [Post(body='flask ' * (i + 1) + 'filler ' * 20, author=self.john)
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        first = search.query('post', 'flask', per_page=2)
+        self.assertEqual(first.items, [posts[4].id, posts[3].id])
+        second = search.query('post', 'flask', after=first.next_cursor, per_page=2)
+        third = search.query('post', 'flask', after=second.next_cursor, per_page=2)
+        self.assertEqual(second.items + third.items,
+                         [posts[2].id, posts[1].id, posts[0].id])
+        self.assertFalse(third.has_next)
+
+    def test_all_terms_and_ties(self):
+        posts = [Post(body='red green', author=self.john) for i in range(3)]
+        posts.append(Post(body='red blue', author=self.john))
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(search.query('post', 'green red').items,
+                         [p.id for p in posts[:3]])
+        self.assertEqual(search.query('post', 'green nothing').items, [])
+        # 分数相同的按 id 翻页，不重复也不漏
+        seen, after = [], None
+        while True:
+            page = search.query('post', 'green', after=after, per_page=1)
+            seen.extend(page.items)
+            if not page.has_next:
+                break
+            after = page.next_cursor
+        self.assertEqual(seen, [p.id for p in posts[:3]])
+
+    def test_reindex_and_view(self):
+        db.session.add(Post(body='hello world', author=self.john))
+        db.session.commit()
+        search.backend.clear(db.session.connection())
+        self.assertEqual(search.reindex(db.session), 2)
+        db.session.commit()
+        response = self.app.test_client().get('/search?q=hello')
+        self.assertIn(b'hello world', response.data)
+
+
+class TableSearchTestCase(SearchTestCase):
+    backend = 'table'
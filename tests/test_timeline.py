@@ -0,0 +1,86 @@
+import unittest
+from datetime import datetime
+from app import create_app, db, timeline
+from app.models import User, Role, Post, TimelineEntry
+
+
+class TimelineTestCase(unittest.TestCase):
+    backend = 'sql'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_TIMELINE_BACKEND'] = self.backend
+        timeline.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat')
+        self.susan = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def timeline_ids(self, user):
+        query, columns = timeline.posts_for(user)
+        return sorted(p.id for p in query.all())
+
+    def test_fan_out_on_write(self):
+        old = Post(body='before follow', author=self.susan)
+        db.session.add(old)
+        db.session.commit()
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.timeline_ids(self.john), [old.id])
+
+        new = Post(body='after follow', author=self.susan)
+        db.session.add(new)
+        db.session.commit()
+        self.assertEqual(self.timeline_ids(self.john), [old.id, new.id])
+        self.assertEqual(self.timeline_ids(self.susan), [])
+
+        self.john.unfollow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.timeline_ids(self.john), [])
+
+    def test_popular_authors_fan_out_on_read(self):
+        self.app.config['FLASKY_FANOUT_THRESHOLD'] = 1
+        self.john.follow(self.susan)
+        db.session.commit()
+        timeline.popular_authors(refresh=True)
+        p = Post(body='hello', author=self.susan)
+        db.session.add(p)
+        db.session.commit()
+        if self.backend == 'sql':
+            self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertEqual(self.timeline_ids(self.john), [p.id])
+
+    def test_rebuild(self):
+        self.john.follow(self.susan)
+        db.session.commit()
+        p = Post(body='hello', author=self.susan)
+        db.session.add(p)
+        db.session.commit()
+        timeline.rebuild(db.session)
+        db.session.commit()
+        self.assertEqual(self.timeline_ids(self.john), [p.id])
+
+    def test_rebuild_keeps_latest_posts_per_author(self):
+        self.app.config['FLASKY_TIMELINE_BACKFILL'] = 2
+        self.john.follow(self.susan)
+        db.session.commit()
+        posts = [Post(body='post %d' % i, author=self.susan,
+                      timestamp=datetime(2020, 1, 1, i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(timeline.rebuild(db.session, batch_size=1), 2)
+        self.assertEqual(self.timeline_ids(self.john), [posts[2].id, posts[3].id])
+        self.assertEqual(self.timeline_ids(self.susan), [])
+
+
+class MemoryTimelineTestCase(TimelineTestCase):
+    backend = 'memory'
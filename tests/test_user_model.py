@@ -1,7 +1,22 @@
+import threading
 import unittest
-from app.models import User
+from app import create_app, db
+from app.models import User, Role
+from app.passwords import PasswordHasher, PasswordHashingBusy
 
 class UserModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
     def test_password_setter(self):
         u = User(password = 'cat')
         self.assertTrue(u.password_hash is not None)
@@ -20,3 +35,42 @@ class UserModelTestCase(unittest.TestCase):
         u = User(password='cat')
         u2 = User(password='cat')
         self.assertTrue(u.password_hash != u2.password_hash)
+
+    def test_password_method_is_configurable(self):
+        u = User(password='cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+
+    def test_outdated_hash_is_upgraded_on_login(self):
+        old = PasswordHasher('pbkdf2:sha256:500').hash('cat')
+        u = User(password_hash=old)
+        self.assertFalse(u.verify_password('dog'))
+        self.assertEqual(u.password_hash, old)
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.verify_password('cat'))
+
+    def test_hashing_in_worker_processes(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1)
+        self.addCleanup(hasher.shutdown)
+        pwhash = hasher.hash('cat')
+        self.assertTrue(hasher.verify(pwhash, 'cat'))
+        self.assertFalse(hasher.verify(pwhash, 'dog'))
+
+    def test_concurrent_hashing_is_bounded(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', concurrency=1, timeout=0.01)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(*args):
+            started.set()
+            release.wait(5)
+        worker = threading.Thread(target=hasher._run, args=(slow,))
+        worker.start()
+        started.wait(5)
+        try:
+            with self.assertRaises(PasswordHashingBusy):
+                hasher.hash('cat')
+        finally:
+            release.set()
+            worker.join()
+        self.assertTrue(hasher.hash('cat'))
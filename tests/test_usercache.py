@@ -0,0 +1,51 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Permission, load_user
+from .utils import QueryCountMixin
+
+
+class UserCacheTestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_loader_and_permissions_hit_cache(self):
+        load_user(str(self.user_id)).can(Permission.FOLLOW)
+        db.session.remove()
+        with self.assertMaxQueries(0):
+            u = load_user(str(self.user_id))
+            self.assertEqual(u.username, 'john')
+            self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+            self.assertFalse(u.is_administrator())
+
+    def test_invalidated_on_change(self):
+        u = load_user(str(self.user_id))
+        u.username = 'johnny'
+        u.role = Role.query.filter_by(name='Administrator').first()
+        db.session.add(u)
+        db.session.commit()
+        db.session.remove()
+        u = load_user(str(self.user_id))
+        self.assertEqual(u.username, 'johnny')
+        self.assertTrue(u.is_administrator())
+
+    def test_role_table_reloaded_on_role_change(self):
+        u = load_user(str(self.user_id))
+        self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
+        role = Role.query.get(u.role_id)
+        role.permissions |= Permission.MODERATE_COMMENTS
+        db.session.commit()
+        self.assertTrue(load_user(str(self.user_id)).can(Permission.MODERATE_COMMENTS))
@@ -0,0 +1,68 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from .utils import QueryCountMixin
+
+
+class ListingQueriesTestCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat') for i in range(5)]
+        db.session.add_all(users)
+        for i in range(20):
+            p = Post(body='post %d' % i, author=users[i % 5])
+            db.session.add(p)
+            db.session.add(Comment(body='comment', post=p, author=users[0]))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_comment_count_is_denormalized(self):
+        p = Post.query.first()
+        self.assertEqual(p.comment_count, 1)
+        db.session.delete(p.comments.first())
+        db.session.commit()
+        self.assertEqual(p.comment_count, 0)
+
+    def test_index_does_not_query_per_post(self):
+        with self.assertMaxQueries(3):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'1 Comments', response.data)
+
+    def test_post_page_does_not_query_per_comment(self):
+        p = Post.query.first()
+        for i in range(5):
+            db.session.add(Comment(body='more', post=p,
+                                   author=User.query.get(i + 1)))
+        db.session.commit()
+        with self.assertMaxQueries(5):
+            response = self.client.get('/post/%d' % p.id)
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_page_opens_at_latest_comment_without_counting(self):
+        self.app.config['FLASKY_CACHE_PAGES'] = False
+        p = Post.query.first()
+        comments = [Comment(body='reply %d' % i, post=p, author=User.query.get(1))
+                    for i in range(25)]
+        db.session.add_all(comments)
+        db.session.commit()
+        with self.assertMaxQueries(5) as counter:
+            response = self.client.get('/post/%d?comment=latest' % p.id)
+        self.assertFalse(any('count(' in s.lower() for s in counter.statements))
+        self.assertEqual(response.data.count(b'class="comment"'), 10)
+        self.assertIn(b'id="comment-%d"' % comments[-1].id, response.data)
+        self.assertNotIn(b'id="comment-%d"' % comments[-11].id, response.data)
+        response = self.client.get('/post/%d?comment=%d' % (p.id, comments[5].id))
+        self.assertIn(b'id="comment-%d"' % comments[5].id, response.data)
+        self.assertNotIn(b'id="comment-%d"' % comments[6].id, response.data)
+        self.assertIn(b'after=', response.data)
@@ -0,0 +1,14 @@
+from contextlib import contextmanager
+from app.profiling import QueryCounter
+
+
+class QueryCountMixin(object):
+    """给 TestCase 用的查询次数断言，防止 N+1 查询回归。"""
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        with QueryCounter() as counter:
+            yield counter
+        if counter.count > limit:
+            self.fail('%d queries executed, expected at most %d:\n%s' % (
+                counter.count, limit, '\n'.join(counter.statements)))